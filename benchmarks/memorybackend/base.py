@@ -0,0 +1,41 @@
+"""
+A minimal in-memory backend, so the benchmarks measure djangotoolbox's code
+instead of a datastore. Tables are dicts mapping primary keys to entities.
+"""
+from djangotoolbox.db.base import NonrelDatabaseFeatures, \
+    NonrelDatabaseOperations, NonrelDatabaseWrapper, NonrelDatabaseClient, \
+    NonrelDatabaseValidation, NonrelDatabaseIntrospection
+from djangotoolbox.db.creation import NonrelDatabaseCreation
+
+class DatabaseFeatures(NonrelDatabaseFeatures):
+    supports_dicts = True
+    distinguishes_insert_from_update = True
+    supports_set_lookups = True
+
+class DatabaseOperations(NonrelDatabaseOperations):
+    compiler_module = 'benchmarks.memorybackend.compiler'
+
+    def sql_flush(self, style, tables, sequences):
+        for table in tables:
+            self.connection.db.pop(table, None)
+        return []
+
+class DatabaseCreation(NonrelDatabaseCreation):
+    def create_test_db(self, verbosity=1, autoclobber=False):
+        self.connection.db.clear()
+        return self.connection.settings_dict['NAME']
+
+    def destroy_test_db(self, old_database_name, verbosity=1):
+        self.connection.db.clear()
+
+class DatabaseWrapper(NonrelDatabaseWrapper):
+    def __init__(self, *args, **kwargs):
+        super(DatabaseWrapper, self).__init__(*args, **kwargs)
+        self.features = DatabaseFeatures(self)
+        self.ops = DatabaseOperations(self)
+        self.client = NonrelDatabaseClient(self)
+        self.creation = DatabaseCreation(self)
+        self.validation = NonrelDatabaseValidation(self)
+        self.introspection = NonrelDatabaseIntrospection(self)
+        # db_table -> {pk: entity}
+        self.db = {}
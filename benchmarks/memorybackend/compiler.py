@@ -0,0 +1,63 @@
+from djangotoolbox.db.basecompiler import NonrelQuery, NonrelCompiler, \
+    NonrelInsertCompiler, NonrelUpdateCompiler, NonrelDeleteCompiler
+import itertools
+
+_ids = itertools.count(1)
+
+class MemoryQuery(NonrelQuery):
+    """Filters and orders with NonrelQuery's in-memory emulation."""
+    def __init__(self, compiler, fields):
+        super(MemoryQuery, self).__init__(compiler, fields)
+        self.table = self.connection.db.setdefault(
+            self.query.get_meta().db_table, {})
+        self._filters = None
+        self._ordering = False
+
+    def add_filters(self, filters):
+        self._filters = filters
+
+    def order_by(self, ordering):
+        self._ordering = bool(ordering)
+
+    def matching(self):
+        entities = self.table.values()
+        if self._filters is not None:
+            entities = [entity for entity in entities
+                        if self._matches_filters(entity, self._filters)]
+        if self._ordering:
+            entities.sort(cmp=self._order_in_memory)
+        return entities
+
+    def fetch(self, low_mark=0, high_mark=None):
+        return iter(self.matching()[low_mark:high_mark])
+
+    def count(self, limit=None):
+        return len(self.matching()[:limit])
+
+    def delete(self):
+        pk_column = self.query.get_meta().pk.column
+        for entity in self.matching():
+            del self.table[entity[pk_column]]
+
+class SQLCompiler(NonrelCompiler):
+    query_class = MemoryQuery
+
+class SQLInsertCompiler(NonrelInsertCompiler, SQLCompiler):
+    def insert(self, data, return_id=False):
+        meta = self.query.get_meta()
+        pk = data.get(meta.pk.column)
+        if pk is None:
+            pk = data[meta.pk.column] = _ids.next()
+        self.connection.db.setdefault(meta.db_table, {})[pk] = dict(data)
+        return pk
+
+class SQLUpdateCompiler(NonrelUpdateCompiler, SQLCompiler):
+    def update(self, values):
+        entities = self.build_query().matching()
+        for entity in entities:
+            for field, value in values:
+                entity[field.column] = value
+        return len(entities)
+
+class SQLDeleteCompiler(NonrelDeleteCompiler, SQLCompiler):
+    pass
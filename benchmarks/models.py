@@ -0,0 +1,21 @@
+from django.db import models
+from djangotoolbox.fields import ListField, DictField, EmbeddedModelField
+
+class Item(models.Model):
+    name = models.CharField(max_length=100)
+    number = models.IntegerField()
+    price = models.FloatField()
+    created = models.DateTimeField()
+    tags = ListField(models.CharField(max_length=50))
+    attributes = DictField(models.IntegerField())
+
+class Address(models.Model):
+    street = models.CharField(max_length=100)
+    city = models.CharField(max_length=100)
+    number = models.IntegerField()
+    created = models.DateTimeField()
+
+class Customer(models.Model):
+    address = EmbeddedModelField(Address)
+    compact_address = EmbeddedModelField(Address, compact=True)
+    untyped_address = EmbeddedModelField()
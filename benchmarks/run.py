@@ -0,0 +1,248 @@
+"""
+Benchmarks for the non-relational compiler and the field conversions.
+
+Run them from the repository's root directory with::
+
+    python -m benchmarks.run [--size 1000] [--repeat 5] [--output file.json]
+
+They use an in-memory backend (see :mod:`benchmarks.memorybackend`), so no
+datastore is needed. The results are written as JSON, so runs with e.g.
+different Django versions can be compared.
+"""
+import os
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'benchmarks.settings')
+
+from datetime import datetime, timedelta
+from optparse import OptionParser
+from time import time
+import platform
+import sys
+
+import django
+from django.db import connections, DEFAULT_DB_ALIAS
+from django.utils import simplejson
+from benchmarks.models import Item, Address, Customer
+
+DEFAULT_SIZES = (100, 1000, 10000)
+
+# name -> function(size) that prepares the data and returns the function
+# that gets timed
+BENCHMARKS = {}
+
+def benchmark(func):
+    BENCHMARKS[func.__name__] = func
+    return func
+
+def get_connection():
+    return connections[DEFAULT_DB_ALIAS]
+
+def clear_table(model):
+    get_connection().db.pop(model._meta.db_table, None)
+
+def make_item(index):
+    return Item(name='item%d' % index, number=index, price=index * 0.5,
+                created=datetime(2011, 1, 1) + timedelta(minutes=index),
+                tags=['tag%d' % (index % 10), 'tag%d' % (index % 7)],
+                attributes={'a': index, 'b': index % 3})
+
+def create_items(size):
+    clear_table(Item)
+    for index in xrange(size):
+        make_item(index).save()
+    return get_connection().db[Item._meta.db_table].values()
+
+def filtered_items(size):
+    return Item.objects.filter(number__gte=size // 2,
+                               name__startswith='item').order_by('-number')
+
+def filtered_count(size):
+    """Returns the number of items matched by :func:`filtered_items`."""
+    return size - size // 2
+
+def check_count(name, count, expected):
+    # A benchmark that silently works on the wrong number of rows (e.g. an
+    # empty result) would time something else
+    if count != expected:
+        raise AssertionError('%s: expected %d rows, got %d'
+                             % (name, expected, count))
+
+def make_customer(index):
+    address = Address(street='Street %d' % index,
+                      city='City %d' % (index % 50), number=index,
+                      created=datetime(2011, 1, 1))
+    return Customer(address=address, compact_address=address,
+                    untyped_address=address)
+
+@benchmark
+def query_build(size):
+    compiler = filtered_items(size).query.get_compiler(DEFAULT_DB_ALIAS)
+    def run():
+        for _ in xrange(size):
+            compiler.build_query()
+    return run
+
+@benchmark
+def filtering(size):
+    entities = create_items(size)
+    query = filtered_items(size).query.get_compiler(
+        DEFAULT_DB_ALIAS).build_query()
+    def run():
+        result = [entity for entity in entities
+                  if query._matches_filters(entity, query._filters)]
+        check_count('filtering', len(result), filtered_count(size))
+        return result
+    return run
+
+@benchmark
+def ordering(size):
+    entities = create_items(size)
+    query = filtered_items(size).query.get_compiler(
+        DEFAULT_DB_ALIAS).build_query()
+    def run():
+        result = sorted(entities, cmp=query._order_in_memory)
+        check_count('ordering', len(result), size)
+        return result
+    return run
+
+@benchmark
+def materialize(size):
+    entities = create_items(size)
+    compiler = Item.objects.all().query.get_compiler(DEFAULT_DB_ALIAS)
+    fields = compiler.get_fields()
+    converters = compiler._get_field_converters(fields, for_db=False)
+    def run():
+        result = [compiler._make_result(entity, fields, converters)
+                  for entity in entities]
+        check_count('materialize', len(result), size)
+        return result
+    return run
+
+@benchmark
+def fetch(size):
+    create_items(size)
+    queryset = filtered_items(size)
+    def run():
+        result = list(queryset.all())
+        check_count('fetch', len(result), filtered_count(size))
+        return result
+    return run
+
+@benchmark
+def insert(size):
+    items = [make_item(index) for index in xrange(size)]
+    def run():
+        clear_table(Item)
+        for item in items:
+            item.pk = None
+            item.save()
+        check_count('insert', len(get_connection().db[Item._meta.db_table]),
+                    size)
+    return run
+
+@benchmark
+def update(size):
+    create_items(size)
+    def run():
+        count = Item.objects.filter(number__lt=size // 2).update(
+            name='updated', tags=['a', 'b'], attributes={'c': 1})
+        check_count('update', count, size // 2)
+    return run
+
+def _embedded_encode(size, name):
+    field = Customer._meta.get_field(name)
+    connection = get_connection()
+    customers = [make_customer(index) for index in xrange(size)]
+    def run():
+        return [field.get_db_prep_save(field.pre_save(customer, True),
+                                       connection=connection)
+                for customer in customers]
+    return field, run
+
+def _embedded_decode(size, name):
+    field, encode = _embedded_encode(size, name)
+    values = encode()
+    def run():
+        # Dicts get modified by to_python(), so copy them
+        return [field.to_python(dict(value) if isinstance(value, dict)
+                                else value)
+                for value in values]
+    return run
+
+@benchmark
+def embedded_encode(size):
+    return _embedded_encode(size, 'address')[1]
+
+@benchmark
+def embedded_decode(size):
+    return _embedded_decode(size, 'address')
+
+@benchmark
+def embedded_encode_compact(size):
+    return _embedded_encode(size, 'compact_address')[1]
+
+@benchmark
+def embedded_decode_compact(size):
+    return _embedded_decode(size, 'compact_address')
+
+@benchmark
+def embedded_encode_untyped(size):
+    return _embedded_encode(size, 'untyped_address')[1]
+
+@benchmark
+def embedded_decode_untyped(size):
+    return _embedded_decode(size, 'untyped_address')
+
+def run_benchmark(name, size, repeat):
+    run = BENCHMARKS[name](size)
+    timings = []
+    for _ in xrange(repeat):
+        start = time()
+        run()
+        timings.append(time() - start)
+    return {
+        'name': name,
+        'size': size,
+        'repeat': repeat,
+        'min': min(timings),
+        'mean': sum(timings) / len(timings),
+        'max': max(timings),
+        'per_item': min(timings) / size,
+    }
+
+def main(argv=None):
+    parser = OptionParser(usage='%prog [options] [benchmark ...]')
+    parser.add_option('-s', '--size', type='int', action='append',
+                      dest='sizes', help='Number of entities (may be given '
+                      'multiple times, default: %s)' %
+                      ', '.join(map(str, DEFAULT_SIZES)))
+    parser.add_option('-r', '--repeat', type='int', default=5,
+                      help='Number of timed runs per benchmark and size')
+    parser.add_option('-o', '--output',
+                      help='Write the results to this file instead of stdout')
+    options, names = parser.parse_args(argv)
+    for name in names:
+        if name not in BENCHMARKS:
+            parser.error('Unknown benchmark %r (choose from %s)'
+                         % (name, ', '.join(sorted(BENCHMARKS))))
+
+    results = []
+    for name in names or sorted(BENCHMARKS):
+        for size in options.sizes or DEFAULT_SIZES:
+            results.append(run_benchmark(name, size, options.repeat))
+    report = {
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'timestamp': datetime.utcnow().isoformat(),
+        'results': results,
+    }
+
+    output = open(options.output, 'w') if options.output else sys.stdout
+    try:
+        simplejson.dump(report, output, indent=2)
+        output.write('\n')
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+if __name__ == '__main__':
+    main()
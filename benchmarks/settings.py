@@ -0,0 +1,13 @@
+DATABASES = {
+    'default': {
+        'ENGINE': 'benchmarks.memorybackend',
+        'NAME': 'benchmarks',
+    },
+}
+
+INSTALLED_APPS = (
+    'djangotoolbox',
+    'benchmarks',
+)
+
+DEBUG = False
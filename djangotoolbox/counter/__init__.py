@@ -0,0 +1,79 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import F
+from django.db.utils import IntegrityError
+from .models import CounterShard
+import random
+
+COUNTER_SHARDS = getattr(settings, 'COUNTER_SHARDS', 20)
+COUNTER_CACHE_TIMEOUT = getattr(settings, 'COUNTER_CACHE_TIMEOUT', 60)
+
+class ShardedCounter(object):
+    """
+    A counter that is split across `num_shards` :class:`CounterShard`
+    entities, so frequent increments don't all write the same entity.
+
+    Increments are added to a random shard. The value is the sum of all
+    shards with the counter's name and is cached for
+    ``COUNTER_CACHE_TIMEOUT`` seconds (increments update the cached value).
+
+    `num_shards` can be raised at any time (e.g. when writes start to
+    contend), because the value always includes all existing shards. It
+    should never be lowered, though, because shards above `num_shards` are
+    still counted but not written anymore.
+
+    Increments update the shard with an ``F('count') + delta`` expression,
+    so the backend has to support atomic ``F()`` updates. A shard gets
+    created by the first increment that doesn't find it. If the backend
+    doesn't raise ``IntegrityError`` for inserts of existing primary keys,
+    two first increments of the same shard can overwrite each other.
+
+    Add ``'djangotoolbox.counter'`` to ``INSTALLED_APPS`` to use it.
+    """
+    def __init__(self, name, num_shards=None):
+        self.name = name
+        self.num_shards = num_shards or COUNTER_SHARDS
+
+    @property
+    def cache_key(self):
+        return 'djangotoolbox.counter.%s' % self.name
+
+    def shard_key(self, index):
+        return '%s:%d' % (self.name, index)
+
+    def increment(self, delta=1):
+        key = self.shard_key(random.randrange(self.num_shards))
+        shard = CounterShard.objects.filter(pk=key)
+        if not shard.update(count=F('count') + delta):
+            try:
+                CounterShard.objects.create(key=key, name=self.name,
+                                            count=delta)
+            except IntegrityError:
+                # Another increment created the shard in the meantime
+                shard.update(count=F('count') + delta)
+        try:
+            if delta >= 0:
+                cache.incr(self.cache_key, delta)
+            elif cache.decr(self.cache_key, -delta) == 0:
+                # memcached doesn't go below zero, so the cached value
+                # might be wrong
+                cache.delete(self.cache_key)
+        except ValueError:
+            # Not cached, so the next read sums up the shards anyway
+            pass
+
+    def decrement(self, delta=1):
+        self.increment(-delta)
+
+    def get_value(self, use_cache=True):
+        value = cache.get(self.cache_key) if use_cache else None
+        if value is None:
+            value = sum(shard.count for shard in
+                        CounterShard.objects.filter(name=self.name))
+            cache.set(self.cache_key, value, COUNTER_CACHE_TIMEOUT)
+        return value
+    value = property(get_value)
+
+    def reset(self):
+        CounterShard.objects.filter(name=self.name).delete()
+        cache.delete(self.cache_key)
@@ -0,0 +1,8 @@
+from django.db import models
+
+class CounterShard(models.Model):
+    """One of the entities a :class:`~djangotoolbox.counter.ShardedCounter`
+    is split across."""
+    key = models.CharField(max_length=500, primary_key=True)
+    name = models.CharField(max_length=500, db_index=True)
+    count = models.IntegerField(default=0)
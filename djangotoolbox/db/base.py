@@ -18,15 +18,102 @@ class NonrelDatabaseFeatures(BaseDatabaseFeatures):
     supports_deleting_related_objects = False
     string_based_auto_field = False
     supports_dicts = False
+    # Whether the backend handles the contains_all, overlap and size lookups
+    # of iterable fields itself. If not, contains_all and overlap get
+    # rewritten into list membership filters.
+    supports_set_lookups = False
+    # Whether NonrelUpdateCompiler.update() can apply CollectionDeltas (only
+    # the items added to or removed from a collection) to existing entities
+    supports_collection_deltas = False
 
     def _supports_transactions(self):
         return False
 
 class NonrelDatabaseOperations(BaseDatabaseOperations):
+    # Collection types of iterable field db_types ('ListField:integer')
+    collection_types = {'ListField': list, 'SetField': set, 'DictField': dict}
+
     def __init__(self, connection):
         self.connection = connection
+        self._leaf_converters = {}
+        self._converters = {}
         super(NonrelDatabaseOperations, self).__init__()
 
+    def register_converter(self, db_type, for_db=None, from_db=None):
+        """
+        Registers the functions that convert values of the base `db_type`
+        (e.g. ``'decimal'`` or ``'datetime'``) to (`for_db`) and from
+        (`from_db`) the database. Parameters of the db_type are passed as
+        additional string arguments (``'decimal:10,2'`` results in
+        ``for_db(value, '10', '2')``). None values are never passed to
+        converters.
+
+        Converters of iterable fields' db_types are built from the item
+        types' converters (see :meth:`get_converter`), so backends only have
+        to register converters for leaf types. Converters registered for a
+        collection type (e.g. ``register_converter('SetField', for_db=list)``)
+        get the whole collection: after the items have been converted for
+        the database, and before they are converted from it.
+        """
+        if for_db is not None:
+            self._leaf_converters[db_type, True] = for_db
+        if from_db is not None:
+            self._leaf_converters[db_type, False] = from_db
+        self._converters.clear()
+
+    def get_converter(self, db_type, for_db=True):
+        """
+        Returns a function that converts values of `db_type` to (or from)
+        the database, or None if they don't have to be converted.
+
+        The db_type is parsed only once; the result is cached.
+        """
+        key = (db_type, for_db)
+        try:
+            return self._converters[key]
+        except KeyError:
+            converter = self._converters[key] = \
+                self._build_converter(db_type, for_db)
+            return converter
+
+    def _build_converter(self, db_type, for_db):
+        if ':' in db_type:
+            base_type, params = db_type.split(':', 1)
+        else:
+            base_type, params = db_type, None
+
+        converter = self._leaf_converters.get((base_type, for_db))
+        collection_type = self.collection_types.get(base_type)
+        if collection_type is not None:
+            items = self._build_items_converter(collection_type,
+                params and self.get_converter(params, for_db))
+            if converter is None:
+                return items
+            if items is None:
+                container = converter
+            elif for_db:
+                container = lambda values: converter(items(values))
+            else:
+                container = lambda values: items(converter(values))
+            return lambda values: values if values is None else \
+                container(values)
+
+        if converter is None:
+            return None
+        if params is not None:
+            leaf, args = converter, tuple(params.split(','))
+            converter = lambda value: leaf(value, *args)
+        return lambda value: value if value is None else converter(value)
+
+    def _build_items_converter(self, collection_type, item):
+        if item is None:
+            return None
+        if collection_type is dict:
+            return lambda values: values if values is None else \
+                dict((key, item(value)) for key, value in values.iteritems())
+        return lambda values: values if values is None else \
+            collection_type(map(item, values))
+
     def quote_name(self, name):
         return name
 
@@ -1,5 +1,7 @@
 from datetime import date, time, datetime
+from decimal import Decimal
 from django.conf import settings
+from django.db.models import Q
 from django.db.models.fields import NOT_PROVIDED
 from django.db.models.sql import aggregates as sqlaggregates
 from django.db.models.sql.compiler import SQLCompiler
@@ -7,21 +9,117 @@ from django.db.models.sql.constants import LOOKUP_SEP, MULTI, SINGLE
 from django.db.models.sql.where import AND, OR
 from django.db.utils import DatabaseError, IntegrityError
 from django.utils.tree import Node
+from djangotoolbox.db import cache as entity_cache, querycache
+from djangotoolbox.db.batch import get_current_batch
+from djangotoolbox.db.profiler import get_query_profile, profiled
+from djangotoolbox.db.utils import get_pk_filter, normalize_pk
+from djangotoolbox.fields import SET_LOOKUPS, ITERABLE_LOOKUPS, NestedLookup, \
+    CollectionDelta, TrigramIndexField, trigrams
+from itertools import ifilter, islice
+from operator import itemgetter
 import random
 
 EMULATED_OPS = {
     'exact': lambda x, y: y in x if isinstance(x, (list,tuple)) else x == y,
     'iexact': lambda x, y: x.lower() == y.lower(),
+    'contains': lambda x, y: y in x,
+    'icontains': lambda x, y: y.lower() in x.lower(),
     'startswith': lambda x, y: x.startswith(y),
     'istartswith': lambda x, y: x.lower().startswith(y.lower()),
+    'endswith': lambda x, y: x.endswith(y),
+    'iendswith': lambda x, y: x.lower().endswith(y.lower()),
     'isnull': lambda x, y: x is None if y else x is not None,
     'in': lambda x, y: x in y,
     'lt': lambda x, y: x < y,
     'lte': lambda x, y: x <= y,
     'gt': lambda x, y: x > y,
     'gte': lambda x, y: x >= y,
+    # The values of these lookups are converted to frozensets once per query
+    # (see NonrelQuery._decode_match_child), so matching is O(len(x))
+    'contains_all': lambda x, y: len(y.intersection(x)) == len(y),
+    'overlap': lambda x, y: not y.isdisjoint(x),
+    'size': lambda x, y: len(x) == y,
 }
 
+# Lookups whose values are lists of items (all other lookups get single items)
+LIST_VALUE_LOOKUPS = ('in', 'range', 'year', 'contains_all', 'overlap')
+
+# Separates the column names of nested lookups (see NestedQ) in the column
+# passed to NonrelQuery.add_filter, e.g. 'address.city'
+NESTED_COLUMN_SEP = '.'
+
+class _AnyOf(list):
+    """
+    The values of a nested key in the items of a collection. Filters match
+    if they match any of the values.
+    """
+
+def _get_nested_value(value, path):
+    for key in path:
+        if isinstance(key, (int, long)):
+            # Positions inside compact EmbeddedModelField values
+            if not isinstance(value, (list, tuple)) or key >= len(value):
+                return None
+            value = value[key]
+        elif isinstance(value, dict):
+            value = value.get(key)
+        elif isinstance(value, (list, tuple)):
+            # Collections match if any of their items matches
+            value = _AnyOf(item.get(key) for item in value
+                          if isinstance(item, dict))
+        else:
+            return None
+    return value
+
+def _matches_value(entity_value, lookup_type, value):
+    if entity_value is None:
+        if isinstance(value, (datetime, date, time)):
+            return lookup_type in ('lt', 'lte')
+        elif lookup_type in ('startswith', 'contains', 'endswith', 'iexact',
+                             'istartswith', 'icontains', 'iendswith') \
+                or lookup_type in ITERABLE_LOOKUPS:
+            return False
+    return EMULATED_OPS[lookup_type](entity_value, value)
+
+class _UncacheableFilter(Exception):
+    """Raised for filter values that can't be part of a query cache key."""
+
+# Filter values of these types are used in query cache keys as they are
+_KEY_TYPES = (type(None), bool, int, long, float, basestring, Decimal, date,
+              time)
+
+def _make_value_key(value):
+    if isinstance(value, _KEY_TYPES):
+        return value
+    if isinstance(value, (list, tuple)):
+        return tuple(map(_make_value_key, value))
+    if isinstance(value, (set, frozenset)):
+        return ('set',) + tuple(sorted(map(_make_value_key, value)))
+    if isinstance(value, NestedLookup):
+        return ('nested', value.path, value.lookup_type,
+                _make_value_key(value.value))
+    raise _UncacheableFilter(value)
+
+def _make_where_key(node):
+    """
+    Returns a representation of a where tree that can be used in query cache
+    keys, or raises _UncacheableFilter.
+    """
+    if isinstance(node, Node):
+        return (node.connector, node.negated,
+                tuple(map(_make_where_key, node.children)))
+    if not isinstance(node, tuple) or len(node) != 4 or \
+            not hasattr(node[0], 'col'):
+        raise _UncacheableFilter(node)
+    constraint, lookup_type, _, value = node
+    return (constraint.alias, constraint.col, lookup_type,
+            _make_value_key(value))
+
+def _make_column_getter(column, path):
+    if not path:
+        return itemgetter(column)
+    return lambda entity: _get_nested_value(entity.get(column), path)
+
 class NonrelQuery(object):
     # ----------------------------------------------
     # Public API
@@ -32,6 +130,10 @@ class NonrelQuery(object):
         self.connection = compiler.connection
         self.query = self.compiler.query
         self._negated = False
+        self._match_children = {}
+        # (getter, lookup_type, value) triples of filters that were replaced
+        # by index filters and have to be checked in memory
+        self._verifications = []
 
     def fetch(self, low_mark=0, high_mark=None):
         raise NotImplementedError('Not implemented')
@@ -75,7 +177,16 @@ class NonrelQuery(object):
                 continue
 
             column, lookup_type, db_type, value = self._decode_child(child)
-            self.add_filter(column, lookup_type, self._negated, db_type, value)
+            if (lookup_type in ('contains', 'icontains') and
+                    not self._negated and
+                    self._add_trigram_filter(column, lookup_type, value)):
+                continue
+            if (lookup_type in ITERABLE_LOOKUPS and
+                    not self.connection.features.supports_set_lookups):
+                self._add_set_filter(column, lookup_type, db_type, value)
+            else:
+                self.add_filter(column, lookup_type, self._negated, db_type,
+                                value)
 
         if filters.negated:
             self._negated = not self._negated
@@ -83,6 +194,66 @@ class NonrelQuery(object):
     # ----------------------------------------------
     # Internal API for reuse by subclasses
     # ----------------------------------------------
+    def fetch_verified(self, low_mark=0, high_mark=None):
+        """
+        Like :meth:`fetch`, but checks filters that were replaced by index
+        filters in memory. Used by the compiler instead of :meth:`fetch`.
+        """
+        if not self._verifications:
+            return self.fetch(low_mark, high_mark)
+        return islice(ifilter(self._verify, self.fetch()), low_mark, high_mark)
+
+    def count_verified(self, limit=None):
+        """Like :meth:`count`, but see :meth:`fetch_verified`."""
+        if not self._verifications:
+            return self.count(limit)
+        return sum(1 for _ in islice(ifilter(self._verify, self.fetch()), limit))
+
+    def _verify(self, entity):
+        for getter, lookup_type, value in self._verifications:
+            entity_value = getter(entity)
+            if entity_value is None or \
+                    not EMULATED_OPS[lookup_type](entity_value, value):
+                return False
+        return True
+
+    def _add_trigram_filter(self, column, lookup_type, value):
+        """
+        Replaces a contains/icontains filter on a field with a
+        :class:`~djangotoolbox.fields.TrigramIndexField` by filters on its
+        trigrams. Returns False if the filter can't use an index.
+        """
+        if not isinstance(value, basestring) or len(value) < 3 or \
+                column not in [field.column for field in self.fields]:
+            return False
+        for field in self.query.get_meta().fields:
+            if isinstance(field, TrigramIndexField) and \
+                    field.source_field.column == column:
+                break
+        else:
+            return False
+        db_type = field.db_type(connection=self.connection)
+        for trigram in trigrams(value):
+            self.add_filter(field.column, 'exact', False, db_type, trigram)
+        self._verifications.append((itemgetter(column), lookup_type, value))
+        return True
+
+    def _add_set_filter(self, column, lookup_type, db_type, value):
+        """
+        Rewrites set lookups into list membership filters for backends that
+        don't support them natively (features.supports_set_lookups).
+        """
+        if lookup_type == 'size':
+            raise DatabaseError("This database doesn't support 'size' lookups.")
+        if self._negated:
+            raise DatabaseError("This database doesn't support negated '%s' "
+                                "lookups." % lookup_type)
+        if lookup_type == 'contains_all':
+            for item in value:
+                self.add_filter(column, 'exact', False, db_type, item)
+        else:
+            self.add_filter(column, 'in', False, db_type, list(value))
+
     def _decode_child(self, child):
         constraint, lookup_type, annotation, value = child
         packed, value = constraint.process(lookup_type, value, self.connection)
@@ -90,13 +261,18 @@ class NonrelQuery(object):
         if alias and alias != self.query.model._meta.db_table:
             raise DatabaseError("This database doesn't support JOINs "
                                 "and multi-table inheritance.")
+        if isinstance(value, NestedLookup):
+            column = NESTED_COLUMN_SEP.join(
+                map(str, (column,) + value.column_path))
+            lookup_type, annotation = value.lookup_type, value.annotation
+            db_type, value = value.db_type, value.value
         value = self._normalize_lookup_value(value, annotation, lookup_type)
         return column, lookup_type, db_type, value
 
     def _normalize_lookup_value(self, value, annotation, lookup_type):
         # Django fields always return a list (see Field.get_db_prep_lookup)
         # except if get_db_prep_lookup got overridden by a subclass
-        if lookup_type not in ('in', 'range', 'year') and isinstance(value, (tuple, list)):
+        if lookup_type not in LIST_VALUE_LOOKUPS and isinstance(value, (tuple, list)):
             if len(value) > 1:
                 raise DatabaseError('Filter lookup type was: %s. Expected the '
                                 'filters value not to be a list. Only "in"-filters '
@@ -145,36 +321,13 @@ class NonrelQuery(object):
             if isinstance(child, Node):
                 submatch = self._matches_filters(entity, child)
             else:
-                constraint, lookup_type, annotation, value = child
-                packed, value = constraint.process(lookup_type, value, self.connection)
-                alias, column, db_type = packed
-                if alias != self.query.model._meta.db_table:
-                    raise DatabaseError("This database doesn't support JOINs "
-                                        "and multi-table inheritance.")
-
-                # Django fields always return a list (see Field.get_db_prep_lookup)
-                # except if get_db_prep_lookup got overridden by a subclass
-                if lookup_type != 'in' and isinstance(value, (tuple, list)):
-                    if len(value) > 1:
-                        raise DatabaseError('Filter lookup type was: %s. '
-                            'Expected the filters value not to be a list. '
-                            'Only "in"-filters can be used with lists.'
-                            % lookup_type)
-                    elif lookup_type == 'isnull':
-                        value = annotation
-                    else:
-                        value = value[0]
-
-                if entity[column] is None:
-                    if isinstance(value, (datetime, date, time)):
-                        submatch = lookup_type in ('lt', 'lte')
-                    elif lookup_type in ('startswith', 'contains', 'endswith', 'iexact',
-                                         'istartswith', 'icontains', 'iendswith'):
-                        submatch = False
-                    else:
-                        submatch = EMULATED_OPS[lookup_type](entity[column], value)
+                get_value, lookup_type, value = self._decode_match_child(child)
+                entity_value = get_value(entity)
+                if isinstance(entity_value, _AnyOf):
+                    submatch = any(_matches_value(item, lookup_type, value)
+                                   for item in entity_value)
                 else:
-                    submatch = EMULATED_OPS[lookup_type](entity[column], value)
+                    submatch = _matches_value(entity_value, lookup_type, value)
 
             if filters.connector == OR and submatch:
                 result = True
@@ -187,6 +340,37 @@ class NonrelQuery(object):
             return not result
         return result
 
+    def _decode_match_child(self, child):
+        """
+        Decodes a filter for in-memory matching. This is done only once per
+        query, no matter how many entities get matched against the filter.
+
+        Returns a function that gets the filtered value from an entity, the
+        lookup type and the lookup value.
+        """
+        key = id(child)
+        if key in self._match_children:
+            return self._match_children[key]
+
+        constraint, lookup_type, annotation, value = child
+        packed, value = constraint.process(lookup_type, value, self.connection)
+        alias, column, db_type = packed
+        if alias and alias != self.query.model._meta.db_table:
+            raise DatabaseError("This database doesn't support JOINs "
+                                "and multi-table inheritance.")
+        path = ()
+        if isinstance(value, NestedLookup):
+            path, lookup_type = value.column_path, value.lookup_type
+            annotation, value = value.annotation, value.value
+
+        value = self._normalize_lookup_value(value, annotation, lookup_type)
+        if lookup_type in SET_LOOKUPS:
+            value = frozenset(value)
+
+        result = _make_column_getter(column, path), lookup_type, value
+        self._match_children[key] = result
+        return result
+
     def _order_in_memory(self, lhs, rhs):
         for order in self.compiler._get_ordering():
             if LOOKUP_SEP in order:
@@ -222,12 +406,42 @@ class NonrelCompiler(SQLCompiler):
         """
         Returns an iterator over the results from executing this query.
         """
+        profile = get_query_profile(self)
+        if profile is not None:
+            return profile.profile_results(self, self._results_iter())
+        return self._results_iter()
+
+    def _results_iter(self):
         self.check_query()
+        self._flush_write_batch()
         fields = self.get_fields()
+        converters = self._get_field_converters(fields, for_db=False)
+        decoders = self._get_decoders(fields)
         low_mark = self.query.low_mark
         high_mark = self.query.high_mark
-        for entity in self.build_query(fields).fetch(low_mark, high_mark):
-            yield self._make_result(entity, fields)
+        entities = self._get_cached_entities(fields)
+        cache_entities = entities is None and self._caches_entities(fields)
+        cache_key = None
+        if entities is None:
+            cache_key = self._get_query_cache_key('results')
+            entities = cache_key and querycache.get_result(cache_key)
+        if entities is None:
+            entities = self.build_query(fields).fetch_verified(low_mark,
+                                                               high_mark)
+            if cache_key:
+                entities = list(entities)
+                querycache.set_result(cache_key, entities)
+        if cache_entities:
+            pk_field = self.query.get_meta().pk
+            pk_index = fields.index(pk_field)
+        for entity in entities:
+            result = self._make_result(entity, fields, converters)
+            if cache_entities:
+                entity_cache.store_entity(self.using, self.query.model,
+                    normalize_pk(pk_field, result[pk_index]), entity)
+            for index, decode in decoders:
+                result[index] = decode(result[index])
+            yield result
 
     def has_results(self):
         return self.get_count(check_exists=True)
@@ -254,33 +468,201 @@ class NonrelCompiler(SQLCompiler):
     # ----------------------------------------------
     # Additional NonrelCompiler API
     # ----------------------------------------------
-    def _make_result(self, entity, fields):
+    def convert_value_from_db(self, db_type, value):
+        """
+        Converts a value loaded from the database using the converters
+        registered with the backend's ``DatabaseOperations`` (see
+        :meth:`NonrelDatabaseOperations.register_converter`).
+        """
+        converter = self.connection.ops.get_converter(db_type, for_db=False)
+        return value if converter is None else converter(value)
+
+    def convert_value_for_db(self, db_type, value):
+        """
+        Converts a value for the database using the converters registered
+        with the backend's ``DatabaseOperations``.
+        """
+        converter = self.connection.ops.get_converter(db_type, for_db=True)
+        return value if converter is None else converter(value)
+
+    def get_converter(self, db_type, for_db=True):
+        """
+        Returns a function that converts values of `db_type` to (or from)
+        the database, or None if they don't need to be converted.
+
+        Backends that override :meth:`convert_value_for_db` or
+        :meth:`convert_value_from_db` get their method bound to the db_type.
+        """
+        converters = self.__dict__.setdefault('_converters', {})
+        key = (db_type, for_db)
+        try:
+            return converters[key]
+        except KeyError:
+            pass
+        if for_db:
+            method = self.convert_value_for_db
+        else:
+            method = self.convert_value_from_db
+        if method.im_func is getattr(NonrelCompiler, method.__name__).im_func:
+            converter = self.connection.ops.get_converter(db_type, for_db)
+        else:
+            converter = lambda value: method(db_type, value)
+        converters[key] = converter
+        return converter
+
+    def _get_field_converters(self, fields, for_db=True):
+        return [self.get_converter(field.db_type(connection=self.connection),
+                                   for_db)
+                for field in fields]
+
+    def _make_result(self, entity, fields, converters=None):
+        if converters is None:
+            converters = self._get_field_converters(fields, for_db=False)
         result = []
-        for field in fields:
+        for field, convert in zip(fields, converters):
             value = entity.get(field.column, NOT_PROVIDED)
             if value is NOT_PROVIDED:
                 value = field.get_default()
-            else:
-                value = self.convert_value_from_db(field.db_type(connection=self.connection), value)
+            elif convert is not None:
+                value = convert(value)
             if value is None and not field.null:
                 raise IntegrityError("Non-nullable field %s can't be None!" % field.name)
             result.append(value)
         return result
 
+    def _get_decoders(self, fields):
+        """
+        Returns (index, decoder) pairs for the fields whose values have to be
+        decoded after loading them (e.g., compressed fields). This is done
+        once per query, so fields without a decoder don't cost anything.
+        """
+        decoders = []
+        for index, field in enumerate(fields):
+            get_decoder = getattr(field, 'get_db_decoder', None)
+            decoder = get_decoder and get_decoder()
+            if decoder is not None:
+                decoders.append((index, decoder))
+        return decoders
+
     def check_query(self):
         if (len([a for a in self.query.alias_map if self.query.alias_refcount[a]]) > 1
                 or self.query.distinct or self.query.extra or self.query.having):
             raise DatabaseError('This query is not supported by the database.')
 
+    @profiled('count')
     def get_count(self, check_exists=False):
         """
         Counts matches using the current filter constraints.
         """
-        if check_exists:
-            high_mark = 1
-        else:
-            high_mark = self.query.high_mark
-        return self.build_query().count(high_mark)
+        if not check_exists:
+            return self._get_count(self.query.high_mark)
+        batch = get_current_batch()
+        exists = batch and batch.get_pending_existence(self)
+        if exists is None:
+            exists = bool(self._get_count(1, check_exists=True))
+            if batch is not None:
+                # A following update of the entity doesn't have to check
+                # again (see WriteBatch.add_update)
+                batch.record_existence(self, exists)
+        return int(exists)
+
+    def _get_count(self, high_mark, check_exists=False):
+        self._flush_write_batch()
+        # Existence checks (e.g. in Model.save()) are only answered from the
+        # identity map. An outdated shared cache (which doesn't see the
+        # writes of other processes) would turn the save of a deleted entity
+        # into an update that doesn't affect any rows.
+        entities = self._get_cached_entities(self.get_fields(),
+                                             shared=not check_exists)
+        if entities is not None:
+            return len(entities[:high_mark])
+        cache_key = None
+        if not check_exists:
+            cache_key = self._get_query_cache_key(('count', high_mark))
+        count = cache_key and querycache.get_result(cache_key)
+        if count is None:
+            count = self.build_query().count_verified(high_mark)
+            if cache_key:
+                querycache.set_result(cache_key, count)
+        return count
+
+    def _get_query_cache_key(self, kind):
+        """
+        Returns the key of this query in the query result cache (see
+        :mod:`djangotoolbox.db.querycache`), or None if it can't be cached.
+        """
+        if querycache.query_cache is None:
+            return None
+        try:
+            query_key = (_make_where_key(self.query.where),
+                         tuple(self._get_ordering()),
+                         self.query.low_mark, self.query.high_mark,
+                         tuple(field.column for field in self.get_fields()))
+        except _UncacheableFilter:
+            # E.g. filters by model instances or subqueries
+            return None
+        return querycache.make_key(self.using, self.query.model, kind,
+                                   query_key)
+
+    def _caches_entities(self, fields):
+        # Only complete entities can be cached
+        return entity_cache.is_enabled() and \
+            list(fields) == self.query.get_meta().fields
+
+    def _get_cached_entities(self, fields, shared=True):
+        """
+        Returns the entities of queries that filter by primary key only from
+        the entity cache (see :mod:`djangotoolbox.db.cache`), or None. The
+        shared cache is only used if `shared` is True.
+        """
+        if self.query.low_mark or self.query.high_mark is not None or \
+                not self._caches_entities(fields):
+            return None
+        field, pks = get_pk_filter(self.query)
+        if field is None:
+            return None
+        unique_pks = []
+        for pk in pks:
+            pk = normalize_pk(field, pk)
+            if pk not in unique_pks:
+                unique_pks.append(pk)
+        entities = entity_cache.get_entities(self.using, self.query.model,
+                                             unique_pks, shared)
+        if entities is not None and len(entities) > 1:
+            self._order_entities(entities)
+        return entities
+
+    def _order_entities(self, entities):
+        meta = self.query.get_meta()
+        for order in reversed(self._get_ordering()):
+            column = meta.get_field(order.lstrip('-')).column
+            entities.sort(key=lambda entity: entity.get(column),
+                          reverse=order.startswith('-'))
+
+    def _invalidate_caches(self, pks=None):
+        """
+        Invalidates the cached query results of the model and removes the
+        entities with the given primary keys (or all entities of the model,
+        if None) from the entity cache.
+
+        Has to be called after the write, because results read before then
+        would otherwise be cached as current. Buffered writes are
+        invalidated when the :class:`~djangotoolbox.db.batch.WriteBatch`
+        executes them.
+        """
+        querycache.invalidate(self.using, self.query.model)
+        if not entity_cache.is_enabled():
+            return
+        if pks is not None:
+            pk_field = self.query.get_meta().pk
+            pks = [normalize_pk(pk_field, pk) for pk in pks]
+        entity_cache.invalidate(self.using, self.query.model, pks)
+
+    def _flush_write_batch(self):
+        # Reads have to see the writes buffered by a WriteBatch
+        batch = get_current_batch()
+        if batch is not None:
+            batch.flush_for_read(self)
 
     def build_query(self, fields=None):
         if fields is None:
@@ -358,6 +740,7 @@ class NonrelCompiler(SQLCompiler):
         return result
 
 class NonrelInsertCompiler(object):
+    @profiled('insert')
     def execute_sql(self, return_id=False):
         data = {}
         for (field, value), column in zip(self.query.values, self.query.columns):
@@ -365,10 +748,34 @@ class NonrelInsertCompiler(object):
                 if not field.null and value is None:
                     raise IntegrityError("You can't set %s (a non-nullable "
                                         "field) to None!" % field.name)
-                db_type = field.db_type(connection=self.connection)
-                value = self.convert_value_for_db(db_type, value)
+                convert = self.get_converter(
+                    field.db_type(connection=self.connection))
+                if convert is not None:
+                    value = convert(value)
             data[column] = value
-        return self.insert(data, return_id=return_id)
+        batch = get_current_batch()
+        if batch is not None and batch.add_insert(self, data, return_id):
+            return None
+        pks = [value for field, value in self.query.values
+               if field is not None and field.primary_key and value is not None]
+        try:
+            return self.insert(data, return_id=return_id)
+        finally:
+            if pks:
+                self._invalidate_caches(pks)
+            else:
+                # New entities with an auto-generated primary key can't be in
+                # the entity cache, but they change the results of queries
+                querycache.invalidate(self.using, self.query.model)
+
+    def insert_batch(self, entities):
+        """
+        Inserts several entities (dicts of column values, including the
+        primary key) at once. Used by :class:`~djangotoolbox.db.batch.WriteBatch`.
+        Backends that support bulk inserts should override this.
+        """
+        for data in entities:
+            self.insert(data, return_id=False)
 
     def insert(self, values, return_id):
         """
@@ -378,26 +785,121 @@ class NonrelInsertCompiler(object):
         raise NotImplementedError
 
 class NonrelUpdateCompiler(object):
+    @profiled('update')
     def execute_sql(self, result_type):
         values = []
-        for field, _, value in self.query.values:
+        deltas = []
+        for field, _, value in self._add_trigram_values(self.query.values):
+            if isinstance(value, CollectionDelta):
+                # Collections that were loaded from the database only have to
+                # be written if they changed (see AbstractIterableField)
+                deltas.append(value)
+                if value.unchanged:
+                    continue
+                if value.partial and \
+                        self.connection.features.supports_collection_deltas:
+                    values.append((field, self._convert_delta(field, value)))
+                    continue
+                value = value.collection
             if hasattr(value, 'prepare_database_save'):
                 value = value.prepare_database_save(field)
             else:
                 value = field.get_db_prep_save(value, connection=self.connection)
-            value = self.convert_value_for_db(
-                field.db_type(connection=self.connection),
-                value
-            )
+            convert = self.get_converter(
+                field.db_type(connection=self.connection))
+            if convert is not None:
+                value = convert(value)
             values.append((field, value))
-        return self.update(values)
+
+        batch = get_current_batch()
+        result = None
+        if values and batch is not None:
+            result = batch.add_update(self, values)
+        if result is None and values:
+            try:
+                result = self.update(values)
+            finally:
+                self._invalidate_caches(get_pk_filter(self.query)[1])
+        elif result is None:
+            result = self.get_count()
+        for delta in deltas:
+            delta.collection.reset_changes()
+        return result
+
+    def _add_trigram_values(self, values):
+        """
+        Adds the new trigrams of updated fields that are indexed by a
+        :class:`~djangotoolbox.fields.TrigramIndexField`.
+        """
+        updated = dict((field.name, value) for field, _, value in values)
+        for field in self.query.get_meta().fields:
+            if not isinstance(field, TrigramIndexField) or \
+                    field.source not in updated or field.name in updated:
+                continue
+            value = updated[field.source]
+            if hasattr(value, 'evaluate'):
+                raise DatabaseError("Can't update %s with an expression, "
+                                    "because it's indexed by %s"
+                                    % (field.source, field.name))
+            value = field.source_field.to_python(value)
+            values = values + [(field, None, trigrams(value or u''))]
+        return values
+
+    def _convert_delta(self, field, delta):
+        item_field = field.item_field
+        convert_item = self.get_converter(
+            item_field.db_type(connection=self.connection))
+        def convert(value):
+            value = item_field.get_db_prep_save(value, connection=self.connection)
+            if convert_item is not None:
+                value = convert_item(value)
+            return value
+        if isinstance(delta.added, dict):
+            added = dict((key, convert(value))
+                         for key, value in delta.added.iteritems())
+            return CollectionDelta(delta.collection, added, delta.removed)
+        return CollectionDelta(delta.collection, map(convert, delta.added),
+                               map(convert, delta.removed))
 
     def update(self, values):
         """
-        :param values: A list of (field, new-value) pairs
+        :param values: A list of (field, new-value) pairs. If the backend
+                       supports collection deltas, new-value may also be a
+                       CollectionDelta with converted items for iterable
+                       fields.
         """
         raise NotImplementedError
 
+    def update_batch(self, updates):
+        """
+        Updates several entities by primary key. `updates` is a list of
+        (pk, values) pairs, with values as passed to :meth:`update`. Used by
+        :class:`~djangotoolbox.db.batch.WriteBatch`.
+        """
+        from django.db.models.sql.subqueries import UpdateQuery
+        for pk, values in updates:
+            query = UpdateQuery(self.query.model)
+            query.add_q(Q(pk=pk))
+            query.get_compiler(self.using).update(values)
+
 class NonrelDeleteCompiler(object):
+    @profiled('delete')
     def execute_sql(self, result_type=MULTI):
-        self.build_query([self.query.get_meta().pk]).delete()
+        batch = get_current_batch()
+        if batch is not None and batch.add_delete(self):
+            return
+        try:
+            self.build_query([self.query.get_meta().pk]).delete()
+        finally:
+            self._invalidate_caches(get_pk_filter(self.query)[1])
+
+    def delete_batch(self, pks):
+        """
+        Deletes the entities with the given primary keys. Used by
+        :class:`~djangotoolbox.db.batch.WriteBatch`.
+        """
+        from django.db.models.sql.subqueries import DeleteQuery
+        query = DeleteQuery(self.query.model)
+        query.add_q(Q(pk__in=pks))
+        compiler = query.get_compiler(self.using)
+        compiler.build_query([self.query.get_meta().pk]).delete()
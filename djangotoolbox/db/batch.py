@@ -0,0 +1,266 @@
+"""
+Request-scoped write batching for non-relational backends.
+
+Inside a :class:`WriteBatch` block (or a request handled with
+:class:`WriteBatchMiddleware`), inserts of entities with a primary key and
+updates and deletes by primary key aren't executed right away. They're
+collected per entity (e.g. an insert followed by two updates of the same
+entity results in a single insert) and executed at the end of the block,
+one batch per model, via the compilers' ``insert_batch``, ``update_batch``
+and ``delete_batch`` methods, which backends can override to use bulk
+operations.
+
+Reads and other writes of a model first execute the model's buffered
+writes, so they always see them. Reads by primary key only do so if one
+of the requested entities has buffered writes, and existence checks by
+primary key (e.g. in ``Model.save()``) are answered from buffered inserts
+and deletes. Inserts of entities without a primary key (the backend has to
+return the new id) and updates with expressions (e.g. ``F('n') + 1``) are
+executed immediately.
+
+Updates still return the number of affected entities, so the first update
+of an entity that isn't buffered has to know whether it exists. Usually,
+that's known from the existence check ``Model.save()`` made right before.
+
+If the block raises an exception, buffered writes are discarded.
+"""
+from djangotoolbox.db import cache as entity_cache, querycache
+from djangotoolbox.db.utils import get_pk_filter, normalize_pk
+from djangotoolbox.fields import CollectionDelta
+import threading
+
+_local = threading.local()
+
+# Entity states
+INSERT, UPDATE, DELETE = 'insert', 'update', 'delete'
+
+def get_current_batch():
+    """Returns the active :class:`WriteBatch` of this thread, or None."""
+    return getattr(_local, 'batch', None)
+
+def _get_pk_filter(query, lookup_types=('exact', 'in')):
+    """
+    Returns the (normalized) primary keys `query` is filtered by, or None if
+    it has any other filters.
+    """
+    field, pks = get_pk_filter(query, lookup_types)
+    if field is None:
+        return None
+    return [normalize_pk(field, pk) for pk in pks]
+
+class WriteBatch(object):
+    """
+    Context manager that buffers writes until the end of the block. Nested
+    blocks join the outermost one.
+    """
+    def __init__(self):
+        self._depth = 0
+        # (using, model) -> {pk: (state, values)}, where values is a dict of
+        # column values for inserts and a list of (field, value) pairs
+        # for updates. The primary keys are normalized (see normalize_pk),
+        # because the values in the insert data are already converted for
+        # the database.
+        self._pending = {}
+        # (using, model) -> {pk: exists} of the entities whose existence was
+        # checked (e.g. by Model.save() right before an update)
+        self._existence = {}
+        self._flushing = False
+
+    def __enter__(self):
+        batch = get_current_batch()
+        if batch is None:
+            batch = _local.batch = self
+        batch._depth += 1
+        return batch
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        batch = get_current_batch()
+        batch._depth -= 1
+        if batch._depth:
+            return
+        _local.batch = None
+        if exc_type is None:
+            batch.flush()
+        else:
+            batch.discard()
+
+    def _entities(self, compiler):
+        return self._pending.setdefault(
+            (compiler.using, compiler.query.model), {})
+
+    def add_insert(self, compiler, data, return_id):
+        """
+        Buffers an insert. Returns False if the insert has to be executed
+        right away.
+        """
+        pk_field = compiler.query.get_meta().pk
+        if self._flushing or return_id or data.get(pk_field.column) is None:
+            # A new entity doesn't depend on the buffered writes
+            return False
+        pk = normalize_pk(pk_field, [value
+            for field, value in compiler.query.values
+            if field is not None and field.primary_key][0])
+        if self._entities(compiler).get(pk, (None, None))[0] == DELETE:
+            # The entity still exists until the delete is executed
+            self.flush(compiler.query.model, compiler.using)
+        self._entities(compiler)[pk] = (INSERT, data)
+        return True
+
+    def add_update(self, compiler, values):
+        """
+        Buffers an update by primary key. Returns the number of updated
+        entities, or None if the update has to be executed right away.
+        """
+        pks = not self._flushing and \
+            _get_pk_filter(compiler.query, ('exact',))
+        # Partial collection updates and expressions can't be merged
+        if not pks or [value for _, value in values
+                       if isinstance(value, CollectionDelta) or
+                          hasattr(value, 'evaluate')]:
+            self.flush(compiler.query.model, compiler.using)
+            return None
+        entities = self._entities(compiler)
+        state, pending = entities.get(pks[0], (None, None))
+        if state is None:
+            # Model.save() usually has checked this already
+            existence = self._existence.setdefault(
+                (compiler.using, compiler.query.model), {})
+            if pks[0] not in existence:
+                compiler.get_count(check_exists=True)
+            if not existence.pop(pks[0], False):
+                return 0
+            state, pending = UPDATE, []
+        if state == INSERT:
+            pending = pending.copy()
+            pending.update((field.column, value) for field, value in values)
+        elif state == UPDATE:
+            updated = set(field for field, _ in values)
+            pending = [(field, value) for field, value in pending
+                       if field not in updated] + list(values)
+        else:
+            # The entity has been deleted
+            return 0
+        entities[pks[0]] = (state, pending)
+        return 1
+
+    def add_delete(self, compiler):
+        """
+        Buffers a delete by primary keys. Returns False if the delete has to
+        be executed right away.
+        """
+        pks = not self._flushing and _get_pk_filter(compiler.query)
+        if not pks:
+            self.flush(compiler.query.model, compiler.using)
+            return False
+        entities = self._entities(compiler)
+        for pk in pks:
+            entities[pk] = (DELETE, None)
+        return True
+
+    def get_pending_existence(self, compiler):
+        """
+        Returns whether the entities `compiler`'s query is filtered by (by
+        primary key) exist, if that's known from buffered inserts and
+        deletes, or None otherwise.
+        """
+        entities = self._pending.get((compiler.using, compiler.query.model))
+        pks = entities and not self._flushing and \
+            _get_pk_filter(compiler.query)
+        if not pks:
+            return None
+        states = [entities.get(pk, (None, None))[0] for pk in pks]
+        if INSERT in states:
+            return True
+        if all(state == DELETE for state in states):
+            return False
+        return None
+
+    def record_existence(self, compiler, exists):
+        """
+        Records whether the entity `compiler`'s query is filtered by (by
+        primary key) exists, as found by an existence check.
+        """
+        pks = not self._flushing and _get_pk_filter(compiler.query, ('exact',))
+        if pks:
+            self._existence.setdefault(
+                (compiler.using, compiler.query.model), {})[pks[0]] = exists
+
+    def flush_for_read(self, compiler):
+        """
+        Executes the buffered writes of the model `compiler` reads from,
+        unless the query is filtered by primary keys without buffered writes.
+        """
+        entities = self._pending.get((compiler.using, compiler.query.model))
+        if not entities:
+            return
+        pks = _get_pk_filter(compiler.query)
+        if pks is not None and not [pk for pk in pks if pk in entities]:
+            return
+        self.flush(compiler.query.model, compiler.using)
+
+    def flush(self, model=None, using=None):
+        """
+        Executes the buffered writes (only those of `model` in the database
+        `using`, if given).
+        """
+        if self._flushing:
+            return
+        keys = [key for key in self._pending
+                if model is None or key == (using, model)]
+        self._flushing = True
+        try:
+            for key in keys:
+                # Other writes might have changed which entities exist
+                self._existence.pop(key, None)
+                self._flush_model(key, self._pending.pop(key))
+        finally:
+            self._flushing = False
+
+    def _flush_model(self, (using, model), entities):
+        from django.db.models.sql.subqueries import InsertQuery, UpdateQuery, \
+            DeleteQuery
+        inserts, updates, deletes = [], [], []
+        for pk, (state, values) in entities.iteritems():
+            if state == INSERT:
+                inserts.append(values)
+            elif state == UPDATE:
+                updates.append((pk, values))
+            else:
+                deletes.append(pk)
+        if inserts:
+            InsertQuery(model).get_compiler(using).insert_batch(inserts)
+        if updates:
+            UpdateQuery(model).get_compiler(using).update_batch(updates)
+        if deletes:
+            DeleteQuery(model).get_compiler(using).delete_batch(deletes)
+        # Results and entities cached (e.g. by other threads) since the writes
+        # were buffered are outdated now
+        querycache.invalidate(using, model)
+        entity_cache.invalidate(using, model, list(entities))
+
+    def discard(self):
+        self._pending.clear()
+        self._existence.clear()
+
+class WriteBatchMiddleware(object):
+    """
+    Buffers the writes of each request in a :class:`WriteBatch`. Writes are
+    executed before the response is returned and discarded if the view
+    raises an exception.
+    """
+    def process_request(self, request):
+        request._write_batch = WriteBatch()
+        request._write_batch.__enter__()
+
+    def process_response(self, request, response):
+        batch = getattr(request, '_write_batch', None)
+        if batch is not None:
+            del request._write_batch
+            batch.__exit__(None, None, None)
+        return response
+
+    def process_exception(self, request, exception):
+        batch = getattr(request, '_write_batch', None)
+        if batch is not None:
+            del request._write_batch
+            batch.__exit__(type(exception), exception, None)
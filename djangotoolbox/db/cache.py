@@ -0,0 +1,143 @@
+"""
+Entity caching for non-relational backends.
+
+Queries that only filter by primary key (``get(pk=...)``,
+``filter(pk__in=...)``) are answered from the cache if all requested
+entities are cached. Entities loaded by any query that selects all fields
+get cached. Inserts, updates and deletes invalidate the affected entities
+(or all entities of the model, if the affected primary keys aren't known).
+
+There are two caches, both disabled by default:
+
+* The identity map caches entities for the duration of an
+  :class:`IdentityMap` block or of a request handled with
+  :class:`IdentityMapMiddleware`.
+* The shared cache is a process-wide LRU cache of ``ENTITY_CACHE_SIZE``
+  entities, which are kept for at most ``ENTITY_CACHE_TIMEOUT`` seconds.
+  Writes of other processes don't invalidate it, so only use it for models
+  that rarely change or that can be slightly outdated. Existence checks
+  (e.g. in ``Model.save()``) are never answered from it.
+"""
+from django.conf import settings
+from djangotoolbox.utils import LRUCache
+from copy import deepcopy
+import threading
+
+ENTITY_CACHE_SIZE = getattr(settings, 'ENTITY_CACHE_SIZE', 0)
+ENTITY_CACHE_TIMEOUT = getattr(settings, 'ENTITY_CACHE_TIMEOUT', 60)
+
+_local = threading.local()
+shared_cache = ENTITY_CACHE_SIZE and \
+    LRUCache(ENTITY_CACHE_SIZE, ENTITY_CACHE_TIMEOUT) or None
+
+# Invalidating all entities of a model increments its generation, which is
+# part of the cache keys, so the old keys are never used again
+_generations = {}
+
+def get_identity_map():
+    """Returns the active :class:`IdentityMap` of this thread, or None."""
+    return getattr(_local, 'identity_map', None)
+
+def is_enabled():
+    return shared_cache is not None or get_identity_map() is not None
+
+def _get_caches(shared=True):
+    caches = []
+    identity_map = get_identity_map()
+    if identity_map is not None:
+        caches.append(identity_map)
+    if shared and shared_cache is not None:
+        caches.append(shared_cache)
+    return caches
+
+def _key(using, model, pk):
+    table = model._meta.db_table
+    return using, table, _generations.get((using, table), 0), pk
+
+def get_entities(using, model, pks, shared=True):
+    """
+    Returns copies of the cached entities with the given primary keys, or
+    None if any of them isn't cached. The shared cache is only used if
+    `shared` is True.
+    """
+    caches = _get_caches(shared)
+    entities = []
+    for pk in pks:
+        key = _key(using, model, pk)
+        for cache in caches:
+            entity = cache.get(key)
+            if entity is not None:
+                break
+        else:
+            return None
+        entities.append(entity)
+    # Loaded model instances mustn't share (mutable) values with the cache
+    return deepcopy(entities)
+
+def store_entity(using, model, pk, entity):
+    key = _key(using, model, pk)
+    # Loaded model instances mustn't share (mutable) values with the cache
+    entity = deepcopy(entity)
+    for cache in _get_caches():
+        cache.set(key, entity)
+
+def invalidate(using, model, pks=None):
+    """
+    Removes the entities with the given primary keys from the caches, or
+    all entities of `model` if `pks` is None.
+    """
+    if pks is None:
+        key = (using, model._meta.db_table)
+        _generations[key] = _generations.get(key, 0) + 1
+        return
+    for cache in _get_caches():
+        for pk in pks:
+            cache.delete(_key(using, model, pk))
+
+class IdentityMap(object):
+    """
+    Context manager that caches the entities loaded in the block. Nested
+    blocks share the outermost block's cache.
+    """
+    def __init__(self):
+        self._depth = 0
+        self._entities = {}
+
+    def __enter__(self):
+        identity_map = get_identity_map()
+        if identity_map is None:
+            identity_map = _local.identity_map = self
+        identity_map._depth += 1
+        return identity_map
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        identity_map = get_identity_map()
+        identity_map._depth -= 1
+        if not identity_map._depth:
+            _local.identity_map = None
+            identity_map.clear()
+
+    def get(self, key, default=None):
+        return self._entities.get(key, default)
+
+    def set(self, key, value):
+        self._entities[key] = value
+
+    def delete(self, key):
+        self._entities.pop(key, None)
+
+    def clear(self):
+        self._entities.clear()
+
+class IdentityMapMiddleware(object):
+    """Caches the entities loaded during each request in an :class:`IdentityMap`."""
+    def process_request(self, request):
+        request._identity_map = IdentityMap()
+        request._identity_map.__enter__()
+
+    def process_response(self, request, response):
+        identity_map = getattr(request, '_identity_map', None)
+        if identity_map is not None:
+            del request._identity_map
+            identity_map.__exit__(None, None, None)
+        return response
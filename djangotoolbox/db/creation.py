@@ -1,5 +1,42 @@
 from django.db.backends.creation import BaseDatabaseCreation
 
+ASCENDING = 'asc'
+DESCENDING = 'desc'
+
+class IndexSpec(object):
+    """
+    Describes an index a backend should create for a model.
+
+    :param columns: A tuple of (column, direction) pairs, where direction is
+                    :data:`ASCENDING` or :data:`DESCENDING`
+    :param unique: Whether the combination of values has to be unique
+    :param multi_valued: A tuple of the columns that store iterables (e.g.
+                         ``ListField``\s), whose index entries are the
+                         single items (so membership lookups can use it)
+    """
+    def __init__(self, columns, unique=False, multi_valued=()):
+        self.columns = tuple(columns)
+        self.unique = unique
+        self.multi_valued = tuple(multi_valued)
+
+    @property
+    def name(self):
+        return '__'.join('%s_%s' % column for column in self.columns)
+
+    def __eq__(self, other):
+        return isinstance(other, IndexSpec) and \
+            (self.columns, self.unique, self.multi_valued) == \
+            (other.columns, other.unique, other.multi_valued)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.columns, self.unique))
+
+    def __repr__(self):
+        return '<IndexSpec %s%s>' % (self.name, self.unique and ' unique' or '')
+
 class NonrelDatabaseCreation(BaseDatabaseCreation):
     data_types = {
         'AutoField':         'integer',
@@ -35,5 +72,65 @@ class NonrelDatabaseCreation(BaseDatabaseCreation):
     def sql_create_model(self, *args, **kwargs):
         return [], {}
 
-    def sql_indexes_for_model(self, *args, **kwargs):
+    def sql_indexes_for_model(self, model, *args, **kwargs):
         return []
+
+    def create_indexes(self, model, index_specs):
+        """
+        Creates (or verifies) the given indexes of `model`. Backends that
+        need index definitions override this. The default does nothing.
+
+        ``syncdb`` (and thus test database creation) calls this with the
+        :meth:`index_specs_for_model` of the models it created (see
+        :mod:`djangotoolbox.management`).
+        """
+        pass
+
+    def index_specs_for_model(self, model):
+        """
+        Returns the :class:`IndexSpec`\s of `model`:
+
+        * single-column indexes of fields with ``db_index`` or ``unique``
+        * unique composite indexes for ``Meta.unique_together``
+        * a composite index for ``Meta.ordering`` if it orders by more than
+          one field or descending
+        """
+        # Importing fields at module level would import django.db.models
+        # while the backend gets loaded
+        from djangotoolbox.fields import AbstractIterableField
+        opts = model._meta
+        specs = []
+        def add(columns, unique=False):
+            multi_valued = [column for column, _ in columns
+                            if column in iterable_columns]
+            spec = IndexSpec(columns, unique, multi_valued)
+            if spec not in specs:
+                specs.append(spec)
+
+        iterable_columns = set(field.column for field in opts.local_fields
+                               if isinstance(field, AbstractIterableField))
+        for field in opts.local_fields:
+            if field.primary_key:
+                continue
+            if field.db_index or field.unique:
+                add([(field.column, ASCENDING)], field.unique)
+
+        for field_names in opts.unique_together:
+            add([(opts.get_field(name).column, ASCENDING)
+                 for name in field_names], unique=True)
+
+        columns = []
+        for name in opts.ordering:
+            direction = ASCENDING
+            if name.startswith('-'):
+                name, direction = name[1:], DESCENDING
+            if name == '?' or '__' in name:
+                # Random and related orderings can't use an index
+                columns = []
+                break
+            if name == 'pk':
+                name = opts.pk.name
+            columns.append((opts.get_field(name).column, direction))
+        if len(columns) > 1 or (columns and columns[0][1] == DESCENDING):
+            add(columns)
+        return specs
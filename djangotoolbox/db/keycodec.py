@@ -0,0 +1,233 @@
+"""
+Order-preserving encoding of values into byte strings.
+
+For values of the same type, comparing the encoded strings bytewise gives
+the same order as comparing the values, so key-value stores can answer
+range filters (``lt``, ``gte``, ...) and orderings with plain key ranges.
+Values of different types are ordered by type (None first).
+
+Supported types are None, bools, ints and longs, floats, Decimals, dates,
+datetimes and times (all naive), strings, unicode strings and tuples.
+Encodings of several values can be concatenated to composite keys (see
+:func:`encode_key`), which sort by their first value, then by their second
+value and so on.
+"""
+from binascii import hexlify, unhexlify
+from decimal import Decimal
+import datetime
+import struct
+
+NONE = '\x01'
+FALSE = '\x02'
+TRUE = '\x03'
+NEGATIVE_INT = '\x04'
+POSITIVE_INT = '\x05'  # and zero
+FLOAT = '\x06'
+NEGATIVE_DECIMAL = '\x07'
+ZERO_DECIMAL = '\x08'
+POSITIVE_DECIMAL = '\x09'
+DATE = '\x0a'
+DATETIME = '\x0b'
+TIME = '\x0c'
+STRING = '\x0d'
+UNICODE = '\x0e'
+TUPLE = '\x0f'
+
+# Strings end with END and contain \x00 bytes escaped as \x00\xff, so a
+# string sorts before all strings it's a prefix of
+STRING_END = '\x00\x01'
+STRING_ESCAPED_NULL = '\x00\xff'
+TUPLE_END = '\x00'
+
+_DATE = struct.Struct('>HBB')
+_DATETIME = struct.Struct('>HBBBBBI')
+_TIME = struct.Struct('>BBBI')
+_DOUBLE = struct.Struct('>d')
+_UINT64 = struct.Struct('>Q')
+_EXPONENT = struct.Struct('>H')
+_EXPONENT_BIAS = 0x8000
+
+_complement_table = ''.join(chr(255 - i) for i in range(256))
+
+def _complement(data):
+    return data.translate(_complement_table)
+
+def _int_to_bytes(value):
+    digits = '%x' % value
+    return unhexlify('0' * (len(digits) % 2) + digits)
+
+def _encode_int(value):
+    if value >= 0:
+        data = _int_to_bytes(value)
+        return POSITIVE_INT + chr(len(data)) + data
+    data = _int_to_bytes(-value)
+    return NEGATIVE_INT + chr(255 - len(data)) + _complement(data)
+
+def _encode_float(value):
+    bits = _UINT64.unpack(_DOUBLE.pack(value))[0]
+    if bits & (1 << 63):
+        bits ^= 0xffffffffffffffff
+    else:
+        bits |= 1 << 63
+    return FLOAT + _UINT64.pack(bits)
+
+def _encode_decimal(value):
+    if not value.is_finite():
+        raise ValueError("Can't encode %r" % value)
+    if not value:
+        return ZERO_DECIMAL
+    sign, digits, _ = value.normalize().as_tuple()
+    # The value is 0.<digits> * 10 ** exponent
+    data = _EXPONENT.pack(value.adjusted() + 1 + _EXPONENT_BIAS) + \
+        ''.join(map(str, digits))
+    if sign:
+        return NEGATIVE_DECIMAL + _complement(data) + '\xff'
+    return POSITIVE_DECIMAL + data + '\x00'
+
+def _encode_string(value):
+    return value.replace('\x00', STRING_ESCAPED_NULL) + STRING_END
+
+def encode(value):
+    """Returns the order-preserving encoding of `value`."""
+    if value is None:
+        return NONE
+    if isinstance(value, bool):
+        return value and TRUE or FALSE
+    if isinstance(value, (int, long)):
+        return _encode_int(value)
+    if isinstance(value, float):
+        return _encode_float(value)
+    if isinstance(value, Decimal):
+        return _encode_decimal(value)
+    # datetime is a subclass of date
+    if isinstance(value, datetime.datetime):
+        return DATETIME + _DATETIME.pack(value.year, value.month, value.day,
+            value.hour, value.minute, value.second, value.microsecond)
+    if isinstance(value, datetime.date):
+        return DATE + _DATE.pack(value.year, value.month, value.day)
+    if isinstance(value, datetime.time):
+        return TIME + _TIME.pack(value.hour, value.minute, value.second,
+                                 value.microsecond)
+    if isinstance(value, unicode):
+        return UNICODE + _encode_string(value.encode('utf-8'))
+    if isinstance(value, str):
+        return STRING + _encode_string(value)
+    if isinstance(value, tuple):
+        return TUPLE + ''.join(map(encode, value)) + TUPLE_END
+    raise TypeError("Can't encode values of type %r" % type(value))
+
+def encode_key(*values):
+    """Returns the composite key of `values`."""
+    return ''.join(map(encode, values))
+
+def _decode_string(data, pos):
+    parts = []
+    while True:
+        end = data.index('\x00', pos)
+        parts.append(data[pos:end])
+        if data[end + 1] == '\x01':
+            return '\x00'.join(parts), end + 2
+        pos = end + 2
+
+def _decode(data, pos):
+    tag = data[pos]
+    pos += 1
+    if tag == NONE:
+        return None, pos
+    if tag in (FALSE, TRUE):
+        return tag == TRUE, pos
+    if tag == POSITIVE_INT:
+        length = ord(data[pos])
+        end = pos + 1 + length
+        return int(hexlify(data[pos + 1:end]) or '0', 16), end
+    if tag == NEGATIVE_INT:
+        length = 255 - ord(data[pos])
+        end = pos + 1 + length
+        return -int(hexlify(_complement(data[pos + 1:end])), 16), end
+    if tag == FLOAT:
+        bits = _UINT64.unpack_from(data, pos)[0]
+        if bits & (1 << 63):
+            bits &= ~(1 << 63)
+        else:
+            bits ^= 0xffffffffffffffff
+        return _DOUBLE.unpack(_UINT64.pack(bits))[0], pos + 8
+    if tag == ZERO_DECIMAL:
+        return Decimal(0), pos
+    if tag in (POSITIVE_DECIMAL, NEGATIVE_DECIMAL):
+        if tag == POSITIVE_DECIMAL:
+            end = data.index('\x00', pos + 2)
+            raw = data[pos:end]
+        else:
+            end = data.index('\xff', pos + 2)
+            raw = _complement(data[pos:end])
+        exponent = _EXPONENT.unpack(raw[:2])[0] - _EXPONENT_BIAS
+        digits = tuple(map(int, raw[2:]))
+        return Decimal((tag == NEGATIVE_DECIMAL, digits,
+                        exponent - len(digits))), end + 1
+    if tag == DATETIME:
+        return datetime.datetime(*_DATETIME.unpack_from(data, pos)), \
+            pos + _DATETIME.size
+    if tag == DATE:
+        return datetime.date(*_DATE.unpack_from(data, pos)), pos + _DATE.size
+    if tag == TIME:
+        return datetime.time(*_TIME.unpack_from(data, pos)), pos + _TIME.size
+    if tag == STRING:
+        return _decode_string(data, pos)
+    if tag == UNICODE:
+        value, pos = _decode_string(data, pos)
+        return value.decode('utf-8'), pos
+    if tag == TUPLE:
+        values = []
+        while data[pos] != TUPLE_END:
+            value, pos = _decode(data, pos)
+            values.append(value)
+        return tuple(values), pos + 1
+    raise ValueError('Invalid type tag %r at position %d' % (tag, pos - 1))
+
+def decode(data):
+    """Decodes a value encoded with :func:`encode`."""
+    value, pos = _decode(data, 0)
+    if pos != len(data):
+        raise ValueError('Trailing data after position %d' % pos)
+    return value
+
+def decode_key(data):
+    """Decodes a composite key into a tuple of its values."""
+    values = []
+    pos = 0
+    while pos < len(data):
+        value, pos = _decode(data, pos)
+        values.append(value)
+    return tuple(values)
+
+def encode_many(values):
+    """Encodes all `values` (e.g. the values of an ``in`` filter)."""
+    return map(encode, values)
+
+def decode_many(keys):
+    """Decodes all `keys`."""
+    return map(decode, keys)
+
+def key_range(lookup_type, value):
+    """
+    Returns the half-open range (start, end) of the keys that match a
+    filter, where None means unbounded. Supports the ``exact``, ``lt``,
+    ``lte``, ``gt``, ``gte`` and ``range`` lookups (`value` is a pair of
+    values for ``range``).
+    """
+    if lookup_type == 'range':
+        return encode(value[0]), encode(value[1]) + '\x00'
+    key = encode(value)
+    # key + '\x00' is the smallest key that's greater than key
+    if lookup_type == 'exact':
+        return key, key + '\x00'
+    if lookup_type == 'lt':
+        return None, key
+    if lookup_type == 'lte':
+        return None, key + '\x00'
+    if lookup_type == 'gt':
+        return key + '\x00', None
+    if lookup_type == 'gte':
+        return key, None
+    raise ValueError("Lookup type %r can't be expressed as a key range"
+                     % lookup_type)
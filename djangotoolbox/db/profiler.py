@@ -0,0 +1,276 @@
+"""
+Per-phase query profiling for non-relational backends.
+
+Inside a :class:`Profiler` block (or a request profiled by
+:class:`QueryProfilerMiddleware`), the compilers record the calls, wall time
+and CPU time of each phase of each query, aggregated by model and query
+shape (the filtered columns, lookup types and ordering, without values):
+
+* ``build_query``: creating the backend query, including ``add_filters()``
+* ``fetch``: getting the entities from the backend
+* ``convert:<field>``: converting the values of a field from the database
+* ``make_result``: creating the result rows (includes the conversions)
+* ``model_init``: the time the caller spends per row, which for querysets
+  is mostly ``Model.__init__``
+* ``count``, ``insert``, ``update`` and ``delete``: whole queries
+
+When no profiler is active, each query only checks a thread-local
+attribute.
+
+:class:`QueryProfilerMiddleware` profiles the requests selected by
+``QUERY_PROFILE_SAMPLE_RATE`` (e.g. 0.01 for 1%) and, from ``INTERNAL_IPS``
+or with ``DEBUG``, those with a ``QUERY_PROFILE_PARAM`` GET parameter. It
+adds a summary to an ``X-Query-Profile`` response header and accumulates
+the reports in Django's cache (use a shared cache backend with multiple
+processes), from where the ``query_profile`` management command prints them.
+"""
+from django.conf import settings
+from threading import Lock
+import random
+import threading
+import time
+
+QUERY_PROFILE_SAMPLE_RATE = getattr(settings, 'QUERY_PROFILE_SAMPLE_RATE', 0)
+QUERY_PROFILE_PARAM = getattr(settings, 'QUERY_PROFILE_PARAM',
+                              'profile_queries')
+QUERY_PROFILE_TIMEOUT = getattr(settings, 'QUERY_PROFILE_TIMEOUT', 24*60*60)
+REPORT_CACHE_KEY = 'djangotoolbox.db.profiler:report'
+
+# CPU time of the process
+_cpu_time = getattr(time, 'process_time', None) or time.clock
+
+_local = threading.local()
+_report_lock = Lock()
+
+def get_profiler():
+    """Returns the active :class:`Profiler` of this thread, or None."""
+    return getattr(_local, 'profiler', None)
+
+def get_query_profile(compiler):
+    """
+    Returns a :class:`QueryProfile` for recording the phases of `compiler`'s
+    query, or None if no profiler is active.
+    """
+    profiler = getattr(_local, 'profiler', None)
+    if profiler is None:
+        return None
+    return QueryProfile(profiler, compiler)
+
+def profiled(phase):
+    """Decorator for compiler methods that records them as `phase`."""
+    def decorator(func):
+        def wrapper(compiler, *args, **kwargs):
+            profile = get_query_profile(compiler)
+            if profile is None:
+                return func(compiler, *args, **kwargs)
+            return profile.call(phase, func, compiler, *args, **kwargs)
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+    return decorator
+
+def get_query_shape(compiler):
+    """
+    Returns a description of a query's filters and ordering without the
+    filter values, e.g. ``"number__gte AND name__startswith ORDER BY
+    -number"``.
+    """
+    query = compiler.query
+    shape = _get_where_shape(query.where)
+    ordering = compiler._get_ordering()
+    if ordering:
+        shape += ' ORDER BY ' + ', '.join(ordering)
+    if query.low_mark or query.high_mark is not None:
+        shape += ' SLICED'
+    return shape.strip() or 'ALL'
+
+def _get_where_shape(node):
+    parts = []
+    for child in node.children:
+        if isinstance(child, tuple):
+            constraint, lookup_type = child[:2]
+            column = constraint.field and constraint.field.name or \
+                constraint.col
+            parts.append('%s__%s' % (column, lookup_type))
+        elif hasattr(child, 'children'):
+            part = _get_where_shape(child)
+            if part:
+                parts.append(len(child.children) > 1 and
+                             '(%s)' % part or part)
+    shape = (' %s ' % node.connector).join(parts)
+    if shape and node.negated:
+        shape = 'NOT ' + shape
+    return shape
+
+class QueryProfile(object):
+    """Records the phases of a single query in a :class:`Profiler`."""
+    def __init__(self, profiler, compiler):
+        self.profiler = profiler
+        meta = compiler.query.get_meta()
+        self.model = '%s.%s' % (meta.app_label, meta.object_name)
+        self.shape = get_query_shape(compiler)
+
+    def add(self, phase, wall, cpu, calls=1):
+        self.profiler.add(self.model, self.shape, phase, wall, cpu, calls)
+
+    def call(self, phase, func, *args, **kwargs):
+        wall, cpu = time.time(), _cpu_time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.add(phase, time.time() - wall, _cpu_time() - cpu)
+
+    def wrap(self, phase, func):
+        def wrapper(*args, **kwargs):
+            return self.call(phase, func, *args, **kwargs)
+        return wrapper
+
+    def profile_results(self, compiler, results):
+        """
+        Returns an iterator over `results`, a (not yet started) generator
+        that produces `compiler`'s result rows, and records its phases.
+        """
+        build_query = compiler.build_query
+        get_field_converters = compiler._get_field_converters
+        def build_query_wrapper(*args, **kwargs):
+            query = self.call('build_query', build_query, *args, **kwargs)
+            fetch = query.fetch_verified
+            query.fetch_verified = lambda *args, **kwargs: self.iterate(
+                'fetch', self.call('fetch', fetch, *args, **kwargs))
+            return query
+        def get_field_converters_wrapper(fields, for_db=True):
+            converters = get_field_converters(fields, for_db)
+            return [convert and self.wrap('convert:%s' % field.name, convert)
+                    for field, convert in zip(fields, converters)]
+        compiler.build_query = build_query_wrapper
+        compiler._get_field_converters = get_field_converters_wrapper
+        compiler._make_result = self.wrap('make_result', compiler._make_result)
+        try:
+            for result in results:
+                wall, cpu = time.time(), _cpu_time()
+                yield result
+                self.add('model_init', time.time() - wall, _cpu_time() - cpu)
+        finally:
+            for name in ('build_query', '_get_field_converters',
+                         '_make_result'):
+                compiler.__dict__.pop(name, None)
+
+    def iterate(self, phase, iterable):
+        """
+        Adds the time needed for getting each item of `iterable` to `phase`
+        (if given), without counting additional calls.
+        """
+        iterator = iter(iterable)
+        while True:
+            wall, cpu = time.time(), _cpu_time()
+            try:
+                item = iterator.next()
+            except StopIteration:
+                return
+            finally:
+                if phase is not None:
+                    self.add(phase, time.time() - wall, _cpu_time() - cpu, 0)
+            yield item
+
+class Profiler(object):
+    """
+    Context manager that profiles the queries executed in the block.
+    Nested blocks share the outermost block's profiler.
+    """
+    def __init__(self):
+        self._depth = 0
+        # (model, shape, phase) -> [calls, wall time, cpu time]
+        self.stats = {}
+
+    def __enter__(self):
+        profiler = get_profiler()
+        if profiler is None:
+            profiler = _local.profiler = self
+        profiler._depth += 1
+        return profiler
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        profiler = get_profiler()
+        profiler._depth -= 1
+        if not profiler._depth:
+            _local.profiler = None
+
+    def add(self, model, shape, phase, wall, cpu, calls=1):
+        stats = self.stats.get((model, shape, phase))
+        if stats is None:
+            self.stats[(model, shape, phase)] = [calls, wall, cpu]
+        else:
+            stats[0] += calls
+            stats[1] += wall
+            stats[2] += cpu
+
+    def get_phase_totals(self):
+        """Returns {phase: [calls, wall time, cpu time]} of all queries."""
+        totals = {}
+        for (_, _, phase), (calls, wall, cpu) in self.stats.iteritems():
+            if phase.startswith('convert:'):
+                phase = 'convert'
+            total = totals.setdefault(phase, [0, 0, 0])
+            total[0] += calls
+            total[1] += wall
+            total[2] += cpu
+        return totals
+
+    def summary(self):
+        """
+        Returns the phase totals as a string like
+        ``"fetch=2/1.52/1.03; make_result=40/0.50/0.49"`` (calls, wall time
+        and cpu time in milliseconds).
+        """
+        return '; '.join('%s=%d/%.2f/%.2f' % (phase, calls, wall * 1000,
+                                               cpu * 1000)
+                         for phase, (calls, wall, cpu)
+                         in sorted(self.get_phase_totals().items()))
+
+def get_report():
+    """Returns the accumulated profiler stats of all profiled requests."""
+    from django.core.cache import cache
+    return cache.get(REPORT_CACHE_KEY) or {}
+
+def save_report(profiler):
+    """Adds `profiler`'s stats to the accumulated report."""
+    from django.core.cache import cache
+    # The lock only protects against other threads of this process
+    with _report_lock:
+        report = get_report()
+        for key, (calls, wall, cpu) in profiler.stats.iteritems():
+            stats = report.setdefault(key, [0, 0, 0])
+            stats[0] += calls
+            stats[1] += wall
+            stats[2] += cpu
+        cache.set(REPORT_CACHE_KEY, report, QUERY_PROFILE_TIMEOUT)
+
+def clear_report():
+    from django.core.cache import cache
+    cache.delete(REPORT_CACHE_KEY)
+
+class QueryProfilerMiddleware(object):
+    """
+    Profiles the queries of sampled requests (see the module's
+    documentation).
+    """
+    def process_request(self, request):
+        if self._is_profiled(request):
+            request._query_profiler = Profiler()
+            request._query_profiler.__enter__()
+
+    def process_response(self, request, response):
+        profiler = getattr(request, '_query_profiler', None)
+        if profiler is not None:
+            del request._query_profiler
+            profiler.__exit__(None, None, None)
+            response['X-Query-Profile'] = profiler.summary()
+            save_report(profiler)
+        return response
+
+    def _is_profiled(self, request):
+        if QUERY_PROFILE_SAMPLE_RATE and \
+                random.random() < QUERY_PROFILE_SAMPLE_RATE:
+            return True
+        return QUERY_PROFILE_PARAM in request.GET and (settings.DEBUG or
+            request.META.get('REMOTE_ADDR') in settings.INTERNAL_IPS)
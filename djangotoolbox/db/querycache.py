@@ -0,0 +1,127 @@
+"""
+Query result caching for non-relational backends.
+
+If enabled with the ``QUERY_CACHE`` setting, the results (and counts) of
+queries get cached. The cache keys contain a generation number of the
+queried model, which is incremented after every insert, update and delete
+of the model, so cached results of a model become unreachable as soon as
+the write is done. Queries that started before the write store their
+results under the old generation, so they can't be returned later.
+
+``QUERY_CACHE`` may be ``'local'`` (a process-wide LRU cache of
+``QUERY_CACHE_SIZE`` results), ``'django'`` (Django's cache framework,
+shared by all processes) or the import path of a class with the same
+methods as :class:`LocalQueryCache`. Results are kept for at most
+``QUERY_CACHE_TIMEOUT`` seconds.
+
+The ``'local'`` cache only sees the writes of its own process, so with
+several processes it can return results that are up to
+``QUERY_CACHE_TIMEOUT`` seconds old. Use ``'django'`` (with a cache
+backend shared by all processes) if that's not acceptable.
+"""
+from django.conf import settings
+from django.utils.hashcompat import md5_constructor
+from django.utils.importlib import import_module
+from djangotoolbox.utils import LRUCache
+from copy import deepcopy
+from time import time
+
+QUERY_CACHE = getattr(settings, 'QUERY_CACHE', None)
+QUERY_CACHE_SIZE = getattr(settings, 'QUERY_CACHE_SIZE', 1000)
+QUERY_CACHE_TIMEOUT = getattr(settings, 'QUERY_CACHE_TIMEOUT', 60)
+
+class LocalQueryCache(object):
+    """
+    Keeps the results in a process-wide :class:`~djangotoolbox.utils.LRUCache`.
+    Writes of other processes don't invalidate it.
+    """
+    def __init__(self, max_size=QUERY_CACHE_SIZE, timeout=QUERY_CACHE_TIMEOUT):
+        self._results = LRUCache(max_size, timeout)
+        self._generations = {}
+
+    def get_generation(self, model_key):
+        return self._generations.get(model_key, 0)
+
+    def increment_generation(self, model_key):
+        self._generations[model_key] = self.get_generation(model_key) + 1
+
+    def get(self, key):
+        return self._results.get(key)
+
+    def set(self, key, value):
+        self._results.set(key, value)
+
+class DjangoQueryCache(object):
+    """Keeps the results in Django's cache."""
+    def __init__(self, timeout=QUERY_CACHE_TIMEOUT,
+                 key_prefix='djangotoolbox.query'):
+        from django.core.cache import cache
+        self.cache = cache
+        self.timeout = timeout
+        self.key_prefix = key_prefix
+
+    def _generation_key(self, model_key):
+        return '%s:generation:%s:%s' % ((self.key_prefix,) + model_key)
+
+    def get_generation(self, model_key):
+        key = self._generation_key(model_key)
+        generation = self.cache.get(key)
+        if generation is None:
+            # The generation might have been evicted, so start with a
+            # number that's greater than all previous generations
+            self.cache.add(key, int(time() * 1000))
+            generation = self.cache.get(key)
+        return generation
+
+    def increment_generation(self, model_key):
+        try:
+            self.cache.incr(self._generation_key(model_key))
+        except ValueError:
+            # Not cached, so get_generation() will start a new one
+            pass
+
+    def get(self, key):
+        return self.cache.get('%s:%s' % (self.key_prefix, key))
+
+    def set(self, key, value):
+        self.cache.set('%s:%s' % (self.key_prefix, key), value, self.timeout)
+
+def _get_query_cache():
+    if not QUERY_CACHE:
+        return None
+    if QUERY_CACHE == 'local':
+        return LocalQueryCache()
+    if QUERY_CACHE == 'django':
+        return DjangoQueryCache()
+    module, name = QUERY_CACHE.rsplit('.', 1)
+    return getattr(import_module(module), name)()
+
+query_cache = _get_query_cache()
+
+def _model_key(using, model):
+    return using, model._meta.db_table
+
+def make_key(using, model, kind, query_key):
+    """
+    Returns the cache key of a query (`query_key` is a representation of
+    its filters, ordering etc. with a stable ``repr()``) or None if caching
+    is disabled.
+    """
+    if query_cache is None:
+        return None
+    generation = query_cache.get_generation(_model_key(using, model))
+    return '%s:%s' % (generation, md5_constructor(
+        repr((using, model._meta.db_table, kind, query_key))).hexdigest())
+
+def get_result(key):
+    value = query_cache.get(key)
+    # Loaded model instances mustn't share (mutable) values with the cache
+    return value if value is None else deepcopy(value)
+
+def set_result(key, value):
+    query_cache.set(key, deepcopy(value))
+
+def invalidate(using, model):
+    """Makes the cached results of `model`'s queries unreachable."""
+    if query_cache is not None:
+        query_cache.increment_generation(_model_key(using, model))
@@ -0,0 +1,33 @@
+from django.core.exceptions import ValidationError
+from django.utils.tree import Node
+
+def get_pk_filter(query, lookup_types=('exact', 'in')):
+    """
+    Returns the primary key field and the list of primary keys `query` is
+    filtered by, or (None, None) if it has any other filters.
+    """
+    node = query.where
+    while isinstance(node, Node):
+        if node.negated or len(node.children) != 1:
+            return None, None
+        node = node.children[0]
+    if not isinstance(node, tuple) or len(node) != 4:
+        return None, None
+    constraint, lookup_type, _, value = node
+    field = getattr(constraint, 'field', None)
+    if field is None or not field.primary_key or \
+            lookup_type not in lookup_types:
+        return None, None
+    if lookup_type == 'exact':
+        value = [value]
+    return field, list(value)
+
+def normalize_pk(field, value):
+    """
+    Converts a primary key value to its Python type, so the values of
+    filters and of loaded entities can be compared.
+    """
+    try:
+        return field.to_python(value)
+    except ValidationError:
+        return value
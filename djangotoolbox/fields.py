@@ -1,14 +1,247 @@
 # All fields except for BlobField written by Jonas Haag <jonas@lophus.org>
 
 from django.db import models
+from django.db.models import Q
+from django.db.models.sql.constants import LOOKUP_SEP, QUERY_TERMS
 from django.core.exceptions import ValidationError
+from django.utils import simplejson
 from django.utils.importlib import import_module
+from array import array
+from decimal import Decimal
+import bz2
+import datetime
+import sys
+import weakref
+import zlib
 
 __all__ = ('RawField', 'ListField', 'DictField', 'SetField',
-           'BlobField', 'EmbeddedModelField')
+           'BlobField', 'EmbeddedModelField', 'NestedQ', 'DenormalizedField',
+           'TrigramIndexField')
 
 EMPTY_ITER = ()
 
+# Lookups supported by iterable fields in addition to Django's own lookups:
+#   contains_all: the collection contains all of the given items
+#   overlap:      the collection contains at least one of the given items
+#   size:         the collection has the given number of items
+# These aren't added to Django's QUERY_TERMS (which would affect all models
+# and e.g. relations to a field named "size"), so use NestedQ for them.
+SET_LOOKUPS = ('contains_all', 'overlap')
+ITERABLE_LOOKUPS = SET_LOOKUPS + ('size',)
+
+# Compression codecs available via the fields' `compress` option. The first
+# item is the codec id stored in the value's header.
+COMPRESSION_CODECS = {
+    'zlib': ('\x01', zlib.compress, zlib.decompress),
+    'bz2': ('\x02', bz2.compress, bz2.decompress),
+}
+DEFAULT_COMPRESS_THRESHOLD = 1024
+_DECOMPRESSORS = dict((codec_id, decompress)
+                      for codec_id, _, decompress in COMPRESSION_CODECS.values())
+
+class Compressor(object):
+    """
+    Compresses and decompresses values of fields with a `compress` option.
+
+    Values are prefixed with a header, so values that were stored before
+    compression got enabled (or that were too small to be compressed) can
+    still be read back.
+    """
+    MAGIC = '\x00dtc'
+    UNCOMPRESSED = '\x00'
+
+    def __init__(self, codec='zlib', threshold=DEFAULT_COMPRESS_THRESHOLD):
+        if codec is True:
+            codec = 'zlib'
+        if codec not in COMPRESSION_CODECS:
+            raise ValueError('Unknown compression codec %r. Available codecs: '
+                             '%s' % (codec, ', '.join(COMPRESSION_CODECS)))
+        self.codec_id, self._compress, _ = COMPRESSION_CODECS[codec]
+        self.threshold = threshold
+
+    def compress(self, data, header_required=True):
+        """
+        Compresses `data` if it's at least `threshold` bytes long.
+
+        If `header_required` is False, small values are returned unchanged
+        unless they could be mistaken for a compressed value.
+        """
+        if len(data) >= self.threshold:
+            return self.MAGIC + self.codec_id + self._compress(data)
+        if header_required or data.startswith(self.MAGIC):
+            return self.MAGIC + self.UNCOMPRESSED + data
+        return data
+
+    def decompress(self, data):
+        if not data.startswith(self.MAGIC):
+            return data
+        header_length = len(self.MAGIC) + 1
+        codec_id = data[header_length - 1]
+        if codec_id == self.UNCOMPRESSED:
+            return data[header_length:]
+        return _DECOMPRESSORS[codec_id](data[header_length:])
+
+# Default array typecodes of packed ListFields by the item field's internal type
+PACKED_TYPECODES = {
+    'IntegerField': 'i',
+    'PositiveIntegerField': 'i',
+    'SmallIntegerField': 'h',
+    'PositiveSmallIntegerField': 'h',
+    'FloatField': 'd',
+}
+
+# Packed values are always stored in little-endian byte order
+_SWAP_PACKED_BYTES = sys.byteorder != 'little'
+
+def _encode_json_value(value):
+    # The item fields' to_python() converts the strings back
+    if isinstance(value, datetime.datetime):
+        return value.isoformat(' ')
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    if isinstance(value, (set, frozenset)):
+        return list(value)
+    raise TypeError("%r can't be stored in a compressed collection" % value)
+
+def _pop_compressor(kwargs):
+    codec = kwargs.pop('compress', None)
+    threshold = kwargs.pop('compress_threshold', DEFAULT_COMPRESS_THRESHOLD)
+    if not codec:
+        return None
+    return Compressor(codec, threshold)
+
+class NestedLookup(object):
+    """
+    Lookup value for a key nested inside a :class:`DictField` or
+    :class:`EmbeddedModelField`. Use :class:`NestedQ` to create these.
+
+    The field's ``get_db_prep_lookup`` resolves the key path into a path of
+    column names and returns a resolved copy, from which the backend gets
+    the column path (`column_path`), the lookup type, the converted lookup
+    value and the leaf's `db_type`.
+
+    If `lookup_type` is None, the last key of the path is one of the
+    :data:`ITERABLE_LOOKUPS`. It's used as the lookup type if it's applied
+    to a :class:`ListField` or :class:`SetField` (whose embedded items don't
+    have a field of that name) and as a key otherwise.
+    """
+    def __init__(self, path, lookup_type, value):
+        self.path = tuple(path)
+        self.lookup_type = lookup_type
+        self.value = value
+        self.column_path = None
+        self.db_type = None
+        # Same as WhereNode.add()
+        if isinstance(value, datetime.datetime):
+            self.annotation = datetime.datetime
+        else:
+            self.annotation = bool(value)
+
+    def resolve(self, field, connection):
+        columns = []
+        lookup_type = self.lookup_type
+        for index, key in enumerate(self.path):
+            if lookup_type is None and index == len(self.path) - 1 and \
+                    _is_iterable_lookup(field, key):
+                lookup_type = key
+                break
+            # Keys of collection items match if any of the items matches
+            in_collection = False
+            while isinstance(field, (ListField, SetField)):
+                field = field.item_field
+                in_collection = True
+            if isinstance(field, EmbeddedModelField) and field.compact:
+                # Compact values are looked up by position (after the
+                # version), which is only possible outside of collections
+                if field.embedded_model is None or in_collection:
+                    raise TypeError("Can't look up key %r in a compact "
+                        "untyped or nested EmbeddedModelField" % key)
+                if has_older_embedded_manifests(field.embedded_model):
+                    # Their values have the key at other positions
+                    raise TypeError("Can't look up key %r in a compact "
+                        "EmbeddedModelField while older versions of %s are "
+                        "registered. Re-save the values stored with older "
+                        "versions and remove the register_embedded_manifest() "
+                        "calls." % (key, field.embedded_model.__name__))
+                field = field.embedded_model._meta.get_field(key)
+                columns.append(1 + get_embedded_manifest(
+                    field.model).positions[field.column])
+            elif isinstance(field, EmbeddedModelField) and \
+                    field.embedded_model is not None:
+                field = field.embedded_model._meta.get_field(key)
+                columns.append(field.column)
+            elif isinstance(field, (EmbeddedModelField, DictField)):
+                columns.append(key)
+                field = getattr(field, 'item_field', None)
+            elif field is None or isinstance(field, RawField):
+                columns.append(key)
+                field = None
+            else:
+                raise TypeError("Can't look up key %r in a %s"
+                                % (key, field.__class__.__name__))
+
+        if field is None:
+            field = RawField()
+        lookup_type = lookup_type or 'exact'
+        resolved = NestedLookup(self.path, lookup_type,
+            field.get_db_prep_lookup(lookup_type, self.value,
+                                     connection=connection))
+        resolved.annotation = self.annotation
+        resolved.column_path = tuple(columns)
+        resolved.db_type = field.db_type(connection=connection)
+        return resolved
+
+def _is_iterable_lookup(field, name):
+    if name not in ITERABLE_LOOKUPS or \
+            not isinstance(field, (ListField, SetField)):
+        return False
+    while isinstance(field, (ListField, SetField)):
+        field = field.item_field
+    if isinstance(field, EmbeddedModelField) and \
+            field.embedded_model is not None:
+        return name not in [f.name for f in field.embedded_model._meta.fields]
+    return True
+
+class NestedQ(Q):
+    """
+    A ``Q`` object that supports lookups on keys nested inside
+    :class:`DictField`\s and :class:`EmbeddedModelField`\s:
+
+        Model.objects.filter(NestedQ(address__city='Berlin',
+                                     stats__visits__gt=100))
+
+    The first part of each lookup is the field name, the last part may be a
+    lookup type (``exact`` is the default) and the parts in between are keys
+    (or field names of embedded models). Lookups without keys are passed
+    through unchanged, so ``NestedQ`` objects can be combined like any other
+    ``Q`` object.
+
+    ``NestedQ`` also provides the :data:`ITERABLE_LOOKUPS` of
+    :class:`ListField`\s and :class:`SetField`\s:
+
+        Model.objects.filter(NestedQ(tags__contains_all=['a', 'b']))
+
+    On other fields (e.g. :class:`DictField`\s) their names are keys.
+    """
+    def __init__(self, *args, **kwargs):
+        children = list(args)
+        for lookup, value in kwargs.items():
+            parts = lookup.split(LOOKUP_SEP)
+            lookup_type = 'exact'
+            if len(parts) > 1 and parts[-1] in QUERY_TERMS:
+                lookup_type = parts.pop()
+            elif len(parts) > 1 and parts[-1] in ITERABLE_LOOKUPS:
+                # Depends on the field (see NestedLookup.resolve)
+                lookup_type = None
+            if len(parts) < 2:
+                children.append((lookup, value))
+            else:
+                children.append((parts[0],
+                                 NestedLookup(parts[1:], lookup_type, value)))
+        super(NestedQ, self).__init__(*children)
+
 class _HandleAssignment(object):
     """
     A placeholder class that provides a way to set the attribute on the model.
@@ -24,6 +257,246 @@ class _HandleAssignment(object):
     def __set__(self, obj, value):
         obj.__dict__[self.field.name] = self.field.to_python(value)
 
+class _TrackAssignment(object):
+    """
+    Descriptor for iterable fields that track changes. Makes sure a tracked
+    collection is only treated as unchanged by the model instance it was
+    loaded into.
+    """
+    def __init__(self, field):
+        self.field = field
+
+    def __get__(self, obj, type=None):
+        if obj is None:
+            raise AttributeError('Can only be accessed via an instance.')
+        return obj.__dict__[self.field.name]
+
+    def __set__(self, obj, value):
+        if isinstance(value, TrackedCollection):
+            if value._owner is None:
+                value._owner = weakref.ref(obj)
+            elif value._owner() is not obj:
+                value = self.field._type(value)
+        obj.__dict__[self.field.name] = value
+
+class CollectionDelta(object):
+    """
+    Returned by the ``pre_save`` method of iterable fields for collections
+    loaded from the database when an existing entity gets updated.
+
+    If only items were added to (or removed from) the collection, `added`
+    and `removed` contain those items (for dicts `added` is a dict of new or
+    changed items and `removed` a list of keys). Otherwise they are None and
+    the whole collection has to be written.
+    """
+    def __init__(self, collection, added=None, removed=None):
+        self.collection = collection
+        self.added = added
+        self.removed = removed
+
+    @property
+    def unchanged(self):
+        return not self.collection.changed
+
+    @property
+    def partial(self):
+        return self.added is not None
+
+class TrackedCollection(object):
+    """
+    Mixin for collections that record whether (and how) they were changed
+    since they were loaded from the database.
+    """
+    _owner = None
+
+    def reset_changes(self):
+        """ Called once the collection has been saved. """
+        self.changed = False
+
+    def _mark_changed(self):
+        self.changed = True
+
+    def get_delta(self):
+        return CollectionDelta(self)
+
+    def __reduce__(self):
+        # Pickled (and copied) collections aren't tracked anymore
+        return (self._untracked_type, (self._untracked_type(self),))
+
+def _changes_collection(method):
+    def wrapper(self, *args, **kwargs):
+        self._mark_changed()
+        return method(self, *args, **kwargs)
+    wrapper.__name__ = method.__name__
+    return wrapper
+
+class TrackedList(TrackedCollection, list):
+    """ A ``list`` that records items appended to it. """
+    _untracked_type = list
+
+    def __init__(self, *args):
+        list.__init__(self, *args)
+        self.reset_changes()
+
+    def reset_changes(self):
+        self.changed = False
+        self._appended = []
+
+    def _mark_changed(self):
+        self.changed = True
+        self._appended = None
+
+    def get_delta(self):
+        if self.changed and self._appended is not None:
+            return CollectionDelta(self, list(self._appended), [])
+        return CollectionDelta(self)
+
+    def append(self, item):
+        list.append(self, item)
+        self.changed = True
+        if self._appended is not None:
+            self._appended.append(item)
+
+    def extend(self, items):
+        items = list(items)
+        list.extend(self, items)
+        self.changed = True
+        if self._appended is not None:
+            self._appended.extend(items)
+
+    def __iadd__(self, items):
+        self.extend(items)
+        return self
+
+    __setitem__ = _changes_collection(list.__setitem__)
+    __delitem__ = _changes_collection(list.__delitem__)
+    __setslice__ = _changes_collection(list.__setslice__)
+    __delslice__ = _changes_collection(list.__delslice__)
+    __imul__ = _changes_collection(list.__imul__)
+    insert = _changes_collection(list.insert)
+    pop = _changes_collection(list.pop)
+    remove = _changes_collection(list.remove)
+    reverse = _changes_collection(list.reverse)
+    sort = _changes_collection(list.sort)
+
+class TrackedSet(TrackedCollection, set):
+    """ A ``set`` that records items added to or removed from it. """
+    _untracked_type = set
+
+    def __init__(self, *args):
+        set.__init__(self, *args)
+        self.reset_changes()
+
+    def reset_changes(self):
+        self.changed = False
+        self._added = set()
+        self._removed = set()
+
+    def _mark_changed(self):
+        self.changed = True
+        self._added = self._removed = None
+
+    def get_delta(self):
+        if self.changed and self._added is not None:
+            return CollectionDelta(self, list(self._added), list(self._removed))
+        return CollectionDelta(self)
+
+    def add(self, item):
+        if item in self:
+            return
+        set.add(self, item)
+        self.changed = True
+        if self._added is not None:
+            self._removed.discard(item)
+            self._added.add(item)
+
+    def discard(self, item):
+        if item not in self:
+            return
+        set.discard(self, item)
+        self.changed = True
+        if self._added is not None:
+            self._added.discard(item)
+            self._removed.add(item)
+
+    def remove(self, item):
+        if item not in self:
+            raise KeyError(item)
+        self.discard(item)
+
+    def update(self, *iterables):
+        for items in iterables:
+            for item in items:
+                self.add(item)
+
+    def __ior__(self, items):
+        self.update(items)
+        return self
+
+    def difference_update(self, *iterables):
+        for items in iterables:
+            for item in items:
+                self.discard(item)
+
+    def __isub__(self, items):
+        self.difference_update(items)
+        return self
+
+    __iand__ = _changes_collection(set.__iand__)
+    __ixor__ = _changes_collection(set.__ixor__)
+    clear = _changes_collection(set.clear)
+    intersection_update = _changes_collection(set.intersection_update)
+    pop = _changes_collection(set.pop)
+    symmetric_difference_update = _changes_collection(
+        set.symmetric_difference_update)
+
+class TrackedDict(TrackedCollection, dict):
+    """ A ``dict`` that records the keys that were set or deleted. """
+    _untracked_type = dict
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.reset_changes()
+
+    def reset_changes(self):
+        self.changed = False
+        self._updated = set()
+        self._deleted = set()
+
+    def _mark_changed(self):
+        self.changed = True
+        self._updated = self._deleted = None
+
+    def get_delta(self):
+        if self.changed and self._updated is not None:
+            return CollectionDelta(self, dict((key, self[key])
+                                              for key in self._updated),
+                                   list(self._deleted))
+        return CollectionDelta(self)
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self.changed = True
+        if self._updated is not None:
+            self._deleted.discard(key)
+            self._updated.add(key)
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self.changed = True
+        if self._updated is not None:
+            self._updated.discard(key)
+            self._deleted.add(key)
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).iteritems():
+            self[key] = value
+
+    clear = _changes_collection(dict.clear)
+    pop = _changes_collection(dict.pop)
+    popitem = _changes_collection(dict.popitem)
+    setdefault = _changes_collection(dict.setdefault)
+
 class RawField(models.Field):
     """ Generic field to store anything your database backend allows you to. """
     def get_internal_type(self):
@@ -38,8 +511,32 @@ class AbstractIterableField(models.Field):
     If you do, the iterable items will be piped through the passed field's
     validation and conversion routines, converting the items to the
     appropriate data type.
+
+    In addition to the lookups supported by the item field, lists and sets
+    support the lookups in :data:`ITERABLE_LOOKUPS` via :class:`NestedQ`:
+
+        Model.objects.filter(NestedQ(tags__contains_all=['a', 'b']))
+        Model.objects.filter(NestedQ(tags__overlap=['a', 'b']))
+        Model.objects.filter(NestedQ(tags__size=2))
+
+    If the optional keyword argument `compress` is given (``True`` or the name
+    of a codec in :data:`COMPRESSION_CODECS`), the whole collection is stored
+    as a single compressed blob. Values smaller than `compress_threshold`
+    bytes are stored uncompressed. Compressed collections can't be queried.
+    They're encoded as JSON, so the item field's database values have to be
+    JSON-serializable (dates, times and decimals are stored as strings and
+    converted back by the item field).
+
+    Collections of simple values (e.g., strings or numbers) are loaded as
+    tracked collections (:class:`TrackedList` etc.) that record changes.
+    When an existing entity gets updated, unchanged collections aren't
+    written again and backends with ``supports_collection_deltas`` only get
+    the added and removed items.
     """
+    _tracked_type = None
+
     def __init__(self, item_field=None, *args, **kwargs):
+        self.compressor = _pop_compressor(kwargs)
         default = kwargs.get('default', None if kwargs.get('null') else EMPTY_ITER)
         if default is not None and not callable(default):
             # ensure a new object is created every time the default is accessed
@@ -61,12 +558,32 @@ class AbstractIterableField(models.Field):
         metaclass = getattr(self.item_field, '__metaclass__', None)
         if issubclass(metaclass, models.SubfieldBase):
             setattr(cls, self.name, _HandleAssignment(self))
+        elif self.tracks_changes:
+            setattr(cls, self.name, _TrackAssignment(self))
+
+    @property
+    def tracks_changes(self):
+        # Items of other types could be changed in place without us noticing
+        # and items with a custom pre_save() have to be saved every time
+        item_field = self.item_field
+        return (self._tracked_type is not None and
+                not getattr(self, 'packed', None) and
+                not isinstance(item_field, (RawField, BlobField,
+                                            AbstractIterableField,
+                                            EmbeddedModelField)) and
+                type(item_field).pre_save.im_func is models.Field.pre_save.im_func)
 
     @property
     def db_type_prefix(self):
         return self.__class__.__name__
 
+    @property
+    def stored_as_blob(self):
+        return self.compressor is not None
+
     def db_type(self, connection):
+        if self.stored_as_blob:
+            return BlobField().db_type(connection=connection)
         item_db_type = self.item_field.db_type(connection=connection)
         return '%s:%s' % (self.db_type_prefix, item_db_type)
 
@@ -79,6 +596,12 @@ class AbstractIterableField(models.Field):
         return self._convert(self.item_field.to_python, value)
 
     def pre_save(self, model_instance, add):
+        values = getattr(model_instance, self.attname)
+        if not add and isinstance(values, TrackedCollection):
+            if self.stored_as_blob:
+                return CollectionDelta(values)
+            return values.get_delta()
+
         class fake_instance(object):
             pass
         fake_instance = fake_instance()
@@ -91,19 +614,73 @@ class AbstractIterableField(models.Field):
             finally:
                 del self.item_field.attname
 
-        return self._convert(wrapper, getattr(model_instance, self.attname))
+        return self._convert(wrapper, values)
 
     def get_db_prep_value(self, value, connection, prepared=False):
-        return self._convert(self.item_field.get_db_prep_value, value,
-                             connection=connection, prepared=prepared)
+        return self._encode(self._convert(self.item_field.get_db_prep_value,
+            value, connection=connection, prepared=prepared))
 
     def get_db_prep_save(self, value, connection):
-        return self._convert(self.item_field.get_db_prep_save,
-                             value, connection=connection)
+        if isinstance(value, CollectionDelta) and not getattr(
+                connection.features, 'supports_collection_deltas', False):
+            # The backend (or code bypassing NonrelUpdateCompiler) needs the
+            # whole collection
+            value = value.collection
+        return self._encode(self._convert(self.item_field.get_db_prep_save,
+                                          value, connection=connection))
+
+    def _encode(self, values):
+        if self.compressor is None or values is None:
+            return values
+        # JSON instead of pickle, so loading data from the database can't
+        # execute code
+        return self.compressor.compress(simplejson.dumps(values,
+            separators=(',', ':'), default=_encode_json_value))
+
+    def _decode(self, value):
+        # Values stored before compression got enabled are still plain
+        # collections
+        if isinstance(value, str):
+            value = self.to_python(simplejson.loads(
+                self.compressor.decompress(value)))
+        return value
+
+    def _track(self, value):
+        if value is None:
+            return None
+        return self._tracked_type(value)
+
+    def _decode_and_track(self, value):
+        return self._track(self._decode(value))
+
+    def get_db_decoder(self):
+        """
+        Returns a function that has to be applied to values loaded from the
+        database or None if the values can be used as they are.
+        """
+        if self.tracks_changes:
+            if self.stored_as_blob:
+                return self._decode_and_track
+            return self._track
+        if self.stored_as_blob:
+            return self._decode
+        return None
 
     def get_db_prep_lookup(self, lookup_type, value, connection, prepared=False):
-        # TODO/XXX: Remove as_lookup_value() once we have a cleaner solution
-        # for dot-notation queries
+        if self.stored_as_blob:
+            raise TypeError('%ss stored as blobs (compressed or packed) do not '
+                            'support lookups' % self.__class__.__name__)
+
+        # Set lookups get here via NestedLookup.resolve()
+        if lookup_type in SET_LOOKUPS:
+            return self.item_field.get_db_prep_lookup('in', value,
+                connection=connection, prepared=prepared)
+        elif lookup_type == 'size':
+            return [value if prepared else int(value)]
+
+        if isinstance(value, NestedLookup):
+            return value.resolve(self, connection)
+        # Lookup objects of backends that predate NestedLookup
         if hasattr(value, 'as_lookup_value'):
             value = value.as_lookup_value(self, lookup_type, connection)
 
@@ -119,6 +696,31 @@ class AbstractIterableField(models.Field):
     def formfield(self, **kwargs):
         raise NotImplementedError('No form field implemented for %r' % type(self))
 
+# model -> attnames of its fields with tracked collections
+_tracked_attnames = {}
+
+def _reset_tracked_collections(sender, instance, created, **kwargs):
+    """
+    Marks the tracked collections of inserted entities as unchanged (after
+    updates, NonrelUpdateCompiler does that), so the next update doesn't
+    write the items added before the insert again.
+    """
+    if not created:
+        return
+    attnames = _tracked_attnames.get(sender)
+    if attnames is None:
+        attnames = _tracked_attnames[sender] = [
+            field.attname for field in sender._meta.fields
+            if isinstance(field, AbstractIterableField) and
+               field.tracks_changes]
+    for attname in attnames:
+        values = instance.__dict__.get(attname)
+        if isinstance(values, TrackedCollection):
+            values.reset_changes()
+
+models.signals.post_save.connect(_reset_tracked_collections,
+    dispatch_uid='djangotoolbox.fields.reset_tracked_collections')
+
 class ListField(AbstractIterableField):
     """
     Field representing a Python ``list``.
@@ -127,8 +729,15 @@ class ListField(AbstractIterableField):
     that is passed to :meth:`list.sort` as `key` argument. If `ordering` is
     given, the items in the list will be sorted before sending them to the
     database.
+
+    If the optional keyword argument `packed` is given, the list is
+    represented as an :class:`array.array` and stored as a single binary blob,
+    which is a lot more compact for long lists of numbers. `packed` may either
+    be an array typecode or ``True`` to use the default typecode for the item
+    field (see :data:`PACKED_TYPECODES`). Packed lists can't be queried.
     """
     _type = list
+    _tracked_type = TrackedList
     db_type_prefix = 'ListField'
 
     def __init__(self, *args, **kwargs):
@@ -136,21 +745,87 @@ class ListField(AbstractIterableField):
         if self.ordering is not None and not callable(self.ordering):
             raise TypeError("'ordering' has to be a callable or None, "
                             "not of type %r" %  type(self.ordering))
+        packed = kwargs.pop('packed', None)
         super(ListField, self).__init__(*args, **kwargs)
 
+        if packed is True:
+            internal_type = self.item_field.get_internal_type()
+            if internal_type not in PACKED_TYPECODES:
+                raise TypeError("Items of type %s can't be packed without an "
+                                "explicit array typecode" % internal_type)
+            packed = PACKED_TYPECODES[internal_type]
+        self.packed = packed or None
+        if self.packed:
+            self._type = lambda values=EMPTY_ITER: array(self.packed, values)
+
+    @property
+    def stored_as_blob(self):
+        return self.packed is not None or self.compressor is not None
+
     def pre_save(self, model_instance, add):
         values = getattr(model_instance, self.attname)
         if values is None:
             return None
-        if values and self.ordering:
-            values.sort(key=self.ordering)
+        # Unchanged tracked lists were already sorted when they were saved
+        if values and self.ordering and getattr(values, 'changed', True):
+            if isinstance(values, array):
+                values[:] = self._type(sorted(values, key=self.ordering))
+            else:
+                values.sort(key=self.ordering)
         return super(ListField, self).pre_save(model_instance, add)
 
+    def get_db_prep_value(self, value, connection, prepared=False):
+        if self.packed:
+            # The array constructor converts all items at once
+            return self._encode(value)
+        return super(ListField, self).get_db_prep_value(value,
+            connection=connection, prepared=prepared)
+
+    def get_db_prep_save(self, value, connection):
+        if self.packed:
+            return self._encode(value)
+        return super(ListField, self).get_db_prep_save(value,
+                                                       connection=connection)
+
+    def _encode(self, values):
+        if not self.packed or values is None:
+            return super(ListField, self)._encode(values)
+        if not isinstance(values, array) or values.typecode != self.packed:
+            try:
+                values = self._type(values)
+            except TypeError:
+                values = self._type(self.item_field.to_python(value)
+                                    for value in values)
+        if _SWAP_PACKED_BYTES:
+            values = self._type(values)
+            values.byteswap()
+        data = self.packed + values.tostring()
+        if self.compressor is not None:
+            data = self.compressor.compress(data, header_required=False)
+        return data
+
+    def _decode(self, value):
+        if not self.packed or value is None:
+            return super(ListField, self)._decode(value)
+        if not isinstance(value, str):
+            # Stored before packing got enabled
+            return self._type(value)
+        if self.compressor is not None:
+            value = self.compressor.decompress(value)
+        values = array(value[0])
+        values.fromstring(buffer(value, 1))
+        if _SWAP_PACKED_BYTES:
+            values.byteswap()
+        if values.typecode != self.packed:
+            values = self._type(values)
+        return values
+
 class SetField(AbstractIterableField):
     """
     Field representing a Python ``set``.
     """
     _type = set
+    _tracked_type = TrackedSet
     db_type_prefix = 'SetField'
 
 class DictField(AbstractIterableField):
@@ -163,6 +838,7 @@ class DictField(AbstractIterableField):
     Depending on the backend, keys that aren't strings might not be allowed.
     """
     _type = dict
+    _tracked_type = TrackedDict
     db_type_prefix = 'DictField'
 
     def _convert(self, func, values, *args, **kwargs):
@@ -175,6 +851,134 @@ class DictField(AbstractIterableField):
         if not isinstance(values, dict):
             raise ValidationError('Value is of type %r. Should be a dict.' % type(values))
 
+class DenormalizedField(DictField):
+    """
+    Field that keeps a copy of some attributes of the object referenced by
+    a ``ForeignKey`` of the same model, so the attributes can be displayed
+    without reading the related object:
+
+        class Post(models.Model):
+            author = models.ForeignKey(Author)
+            author_copy = DenormalizedField('author', ['name', 'avatar'])
+
+        post.author_copy['name']
+
+    The copy is a dict of the copied attributes plus the primary key (under
+    ``'pk'``) of the object they were copied from. It's refreshed when the
+    model instance is saved after the foreign key changed, and when the
+    related object gets saved. Copies that got out of sync (e.g. because the
+    related objects were changed with ``QuerySet.update``) can be refreshed
+    with the ``resync_denormalized`` management command.
+
+    :param fk_name: The name of the ``ForeignKey``
+    :param fields: The names of the related object's attributes to copy
+    """
+    def __init__(self, fk_name, fields, **kwargs):
+        self.fk_name = fk_name
+        self.copied_fields = tuple(fields)
+        kwargs.setdefault('null', True)
+        kwargs.setdefault('editable', False)
+        super(DenormalizedField, self).__init__(**kwargs)
+
+    def contribute_to_class(self, cls, name):
+        super(DenormalizedField, self).contribute_to_class(cls, name)
+        # The foreign key might not have been added to the model yet
+        models.signals.class_prepared.connect(self._connect_related_model,
+                                              sender=cls, weak=False)
+
+    def _connect_related_model(self, sender, **kwargs):
+        def _connect(field, related_model, model):
+            models.signals.post_save.connect(self._refresh_copies,
+                                             sender=related_model, weak=False)
+        from django.db.models.fields.related import add_lazy_relation
+        add_lazy_relation(sender, self, self.fk.rel.to, _connect)
+
+    @property
+    def fk(self):
+        return self.model._meta.get_field(self.fk_name)
+
+    def make_copy(self, related_instance):
+        """Returns the copy of `related_instance`'s attributes."""
+        if related_instance is None:
+            return None
+        copy = dict((name, getattr(related_instance, name))
+                    for name in self.copied_fields)
+        copy['pk'] = related_instance.pk
+        return copy
+
+    def pre_save(self, model_instance, add):
+        fk = self.fk
+        related_pk = getattr(model_instance, fk.attname)
+        copy = getattr(model_instance, self.attname)
+        if related_pk is None:
+            setattr(model_instance, self.attname, None)
+        elif copy is None or copy.get('pk') != related_pk or \
+                hasattr(model_instance, fk.get_cache_name()):
+            # Only read the related object if we don't have a copy of it
+            new_copy = self.make_copy(getattr(model_instance, fk.name))
+            if new_copy != copy:
+                setattr(model_instance, self.attname, new_copy)
+        return super(DenormalizedField, self).pre_save(model_instance, add)
+
+    def _refresh_copies(self, sender, instance, created, raw=False, **kwargs):
+        # New objects can't be referenced yet
+        if created or raw:
+            return
+        copy = self.make_copy(instance)
+        # Writes are much more expensive than reads, so only update the
+        # copies that changed
+        manager = self.model._default_manager
+        stale = [pk for pk, old_copy in manager.filter(
+                     **{self.fk_name: instance.pk}).values_list('pk', self.name)
+                 if old_copy != copy]
+        if stale:
+            manager.filter(pk__in=stale).update(**{self.name: copy})
+
+def trigrams(value):
+    """Returns the sorted list of lowercase trigrams of `value`."""
+    value = value.lower()
+    return sorted(set(value[i:i + 3] for i in xrange(len(value) - 2)))
+
+class TrigramIndexField(ListField):
+    """
+    Field that stores the trigrams of another string field of the same model
+    (updated whenever the model instance is saved), so ``contains`` and
+    ``icontains`` filters on that field don't need a full scan:
+
+        class Article(models.Model):
+            title = models.CharField(max_length=200)
+            title_trigrams = TrigramIndexField('title')
+
+    Filters with at least three characters get rewritten into filters on the
+    trigrams, and the resulting candidates are checked against the original
+    filter in memory (see :class:`djangotoolbox.db.basecompiler.NonrelQuery`).
+
+    Rows whose trigrams are missing or outdated aren't found by these
+    filters. ``QuerySet.update`` keeps the trigrams current (updates with
+    expressions like ``F()`` are refused), but rows that were saved before
+    the field was added, or written without Django, have to be indexed with
+    the ``resync_trigrams`` management command.
+
+    :param source: The name of the indexed field
+    """
+    def __init__(self, source, **kwargs):
+        self.source = source
+        kwargs.setdefault('editable', False)
+        kwargs.setdefault('db_index', True)
+        super(TrigramIndexField, self).__init__(
+            models.CharField(max_length=3), **kwargs)
+
+    @property
+    def source_field(self):
+        return self.model._meta.get_field(self.source)
+
+    def pre_save(self, model_instance, add):
+        value = getattr(model_instance, self.source_field.attname)
+        new_trigrams = trigrams(value or u'')
+        if new_trigrams != getattr(model_instance, self.attname):
+            setattr(model_instance, self.attname, new_trigrams)
+        return super(TrigramIndexField, self).pre_save(model_instance, add)
+
 class BlobField(models.Field):
     """
     A field for storing blobs of binary data.
@@ -184,7 +988,16 @@ class BlobField(models.Field):
 
     In the latter case, the object has to provide a ``read`` method from which
     the blob is read.
+
+    If the optional keyword argument `compress` is given (``True`` or the name
+    of a codec in :data:`COMPRESSION_CODECS`), blobs of at least
+    `compress_threshold` bytes are stored compressed. Blobs that were stored
+    uncompressed can still be read.
     """
+    def __init__(self, *args, **kwargs):
+        self.compressor = _pop_compressor(kwargs)
+        super(BlobField, self).__init__(*args, **kwargs)
+
     def get_internal_type(self):
         return 'BlobField'
 
@@ -199,9 +1012,26 @@ class BlobField(models.Field):
 
     def get_db_prep_value(self, value, connection, prepared=False):
         if hasattr(value, 'read'):
-            return value.read()
+            value = value.read()
         else:
-            return str(value)
+            value = str(value)
+        if self.compressor is not None:
+            value = self.compressor.compress(value, header_required=False)
+        return value
+
+    def _decompress(self, value):
+        if value is None:
+            return None
+        return self.compressor.decompress(value)
+
+    def get_db_decoder(self):
+        """
+        Returns a function that has to be applied to values loaded from the
+        database or None if the values can be used as they are.
+        """
+        if self.compressor is not None:
+            return self._decompress
+        return None
 
     def get_db_prep_lookup(self, lookup_type, value, connection, prepared=False):
         raise TypeError("BlobFields do not support lookups")
@@ -209,21 +1039,88 @@ class BlobField(models.Field):
     def value_to_string(self, obj):
         return str(self._get_val_from_obj(obj))
 
+class EmbeddedManifest(object):
+    """
+    The columns of an embedded model in the order in which compact
+    :class:`EmbeddedModelField`\s store their values. The version is a
+    checksum of the column names, so it changes whenever fields get added,
+    removed or reordered.
+    """
+    def __init__(self, model, columns):
+        self.model = model
+        self.columns = tuple(columns)
+        self.version = zlib.crc32(','.join(self.columns)) & 0xffffffff
+        self.positions = dict((column, index)
+                              for index, column in enumerate(self.columns))
+        fields = dict((field.column, field) for field in model._meta.fields)
+        # Columns of removed fields map to None and are skipped on decode
+        self.fields = [fields.get(column) for column in self.columns]
+
+_manifests = {}
+
+def get_embedded_manifest(model, version=None):
+    """
+    Returns the :class:`EmbeddedManifest` of `model` with the given
+    `version`, or the current one if no version is given.
+    """
+    if model not in _manifests:
+        manifest = EmbeddedManifest(model,
+            [field.column for field in model._meta.fields])
+        _manifests[model] = _manifests[model, manifest.version] = manifest
+    if version is None:
+        return _manifests[model]
+    try:
+        return _manifests[model, version]
+    except KeyError:
+        raise ValueError("Unknown manifest version %r for compact %s values. "
+                         "Use register_embedded_manifest() to register the "
+                         "columns of older versions of the model."
+                         % (version, model.__name__))
+
+def has_older_embedded_manifests(model):
+    """
+    Returns whether older versions of `model` are registered (see
+    :func:`register_embedded_manifest`).
+    """
+    current = get_embedded_manifest(model).version
+    return any(key[0] is model and key[1] != current
+               for key in _manifests if isinstance(key, tuple))
+
+def register_embedded_manifest(model, columns):
+    """
+    Registers an older column list of `model` so that compact values that
+    were stored before the model changed can still be read.
+    """
+    manifest = EmbeddedManifest(model, columns)
+    _manifests[model, manifest.version] = manifest
+    return manifest
+
 class EmbeddedModelField(models.Field):
     """
     Field that allows you to embed a model instance.
 
     :param model: (optional) The model class that shall be embedded
                   (may also be passed as string similar to relation fields)
+    :param compact: (optional) Store the embedded instance as a list of its
+                    column values (prefixed with the manifest version and,
+                    for untyped fields, the model's app label and name)
+                    instead of a dict keyed by column names. Values stored in
+                    the default format can still be read. Nested lookups
+                    (see :class:`NestedQ`) aren't possible while older
+                    versions of the model are registered, because their
+                    values store the keys at other positions.
     """
     __metaclass__ = models.SubfieldBase
 
     def __init__(self, model=None, *args, **kwargs):
         self.embedded_model = model
+        self.compact = kwargs.pop('compact', False)
         kwargs.setdefault('default', None)
         super(EmbeddedModelField, self).__init__(*args, **kwargs)
 
     def db_type(self, connection):
+        if self.compact:
+            return 'ListField:RawField'
         return 'DictField:RawField'
 
     def _set_model(self, model):
@@ -260,6 +1157,9 @@ class EmbeddedModelField(models.Field):
         for field in embedded_instance._meta.fields:
             add = not embedded_instance._entity_exists
             value = field.pre_save(embedded_instance, add)
+            if isinstance(value, CollectionDelta):
+                # The embedded instance is always written as a whole
+                value = value.collection
             if field.primary_key and value is None:
                 # exclude unset pks ({"id" : None})
                 continue
@@ -270,37 +1170,78 @@ class EmbeddedModelField(models.Field):
     def get_db_prep_value(self, (embedded_instance, value_list), **kwargs):
         if value_list is None:
             return None
-        values = dict((field.column, field.get_db_prep_value(value, **kwargs))
-                      for field, value in value_list)
-        if self.embedded_model is None:
-            values.update({'_module' : embedded_instance.__class__.__module__,
-                           '_model'  : embedded_instance.__class__.__name__})
+        if self.compact:
+            values = self._encode_compact(embedded_instance, value_list, kwargs)
+        else:
+            values = dict((field.column, field.get_db_prep_value(value, **kwargs))
+                          for field, value in value_list)
+            if self.embedded_model is None:
+                values.update({'_module' : embedded_instance.__class__.__module__,
+                               '_model'  : embedded_instance.__class__.__name__})
         # This instance will exist in the db very soon.
         embedded_instance._entity_exists = True
         return values
 
-    # TODO/XXX: Remove this once we have a cleaner solution
     def get_db_prep_lookup(self, lookup_type, value, connection, prepared=False):
+        if isinstance(value, NestedLookup):
+            return value.resolve(self, connection)
+        # Lookup objects of backends that predate NestedLookup
         if hasattr(value, 'as_lookup_value'):
             value = value.as_lookup_value(self, lookup_type, connection)
         return value
 
+    def _encode_compact(self, embedded_instance, value_list, kwargs):
+        meta = embedded_instance._meta
+        manifest = get_embedded_manifest(embedded_instance.__class__)
+        header = [manifest.version]
+        if self.embedded_model is None:
+            header.append('%s.%s' % (meta.app_label, meta.object_name))
+        values = [None] * len(manifest.columns)
+        for field, value in value_list:
+            values[manifest.positions[field.column]] = \
+                field.get_db_prep_value(value, **kwargs)
+        return header + values
+
+    def _decode_compact(self, values):
+        version, values = values[0], values[1:]
+        if self.embedded_model is None:
+            label, values = values[0], values[1:]
+            model = models.get_model(*label.split('.', 1))
+            if model is None:
+                raise ValueError("Can't find embedded model %r" % label)
+        else:
+            model = self.embedded_model
+        manifest = get_embedded_manifest(model, version)
+        return model, zip(manifest.fields, values)
+
     def to_python(self, values):
-        if not isinstance(values, dict):
+        if self.compact and isinstance(values, (list, tuple)):
+            model, items = self._decode_compact(values)
+        elif isinstance(values, dict):
+            model, items = self._decode_dict(values)
+        else:
             return values
 
+        data = {}
+        for field, value in items:
+            if field is None:
+                continue
+            decode = getattr(field, 'get_db_decoder', None)
+            decode = decode and decode()
+            if decode is not None:
+                value = decode(value)
+            # TODO/XXX: str(...) is a workaround for old Python releases.
+            # Remove this someday.
+            data[str(field.attname)] = value
+        return model(__entity_exists=True, **data)
+
+    def _decode_dict(self, values):
         module, model = values.pop('_module', None), values.pop('_model', None)
         if module is not None:
             model = getattr(import_module(module), model)
         else:
             model = self.embedded_model
 
-        data = {}
-        for field in model._meta.fields:
-            try:
-                # TODO/XXX: str(...) is a workaround for old Python releases.
-                # Remove this someday.
-                data[str(field.attname)] = values[field.column]
-            except KeyError:
-                pass
-        return model(__entity_exists=True, **data)
+        return model, [(field, values[field.column])
+                       for field in model._meta.fields
+                       if field.column in values]
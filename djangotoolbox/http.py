@@ -1,26 +1,168 @@
 from django.conf import settings
 from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models.query import QuerySet
 from django.http import HttpResponse
-from django.utils import simplejson
+from django.utils import datetime_safe, simplejson
 from django.utils.encoding import force_unicode
 from django.utils.functional import Promise
+from django.utils.hashcompat import md5_constructor
+from django.utils.importlib import import_module
+from decimal import Decimal
+import datetime
+
+# These produce the same output as DjangoJSONEncoder.default(), but without
+# its isinstance() chain
+
+def _encode_promise(encoder, obj):
+    return force_unicode(obj)
+
+def _encode_datetime(encoder, obj):
+    return datetime_safe.new_datetime(obj).strftime('%s %s' % (
+        encoder.DATE_FORMAT, encoder.TIME_FORMAT))
+
+def _encode_date(encoder, obj):
+    return datetime_safe.new_date(obj).strftime(encoder.DATE_FORMAT)
+
+def _encode_time(encoder, obj):
+    return obj.strftime(encoder.TIME_FORMAT)
+
+def _encode_decimal(encoder, obj):
+    return str(obj)
+
+# Checked in this order, because datetime is a subclass of date
+_TYPE_HANDLERS = (
+    (Promise, _encode_promise),
+    (datetime.datetime, _encode_datetime),
+    (datetime.date, _encode_date),
+    (datetime.time, _encode_time),
+    (Decimal, _encode_decimal),
+)
 
 class LazyEncoder(DjangoJSONEncoder):
+    """
+    Encodes lazy translations (and everything DjangoJSONEncoder supports).
+    Objects the JSON module can't encode natively are dispatched by type.
+    """
+    # (encoder class, type) -> function(encoder, obj)
+    _handlers = {}
+
     def default(self, obj):
-        if isinstance(obj, Promise):
-            return force_unicode(obj)
-        return super(LazyEncoder, self).default(obj)
+        key = (self.__class__, type(obj))
+        try:
+            handler = self._handlers[key]
+        except KeyError:
+            handler = self._handlers[key] = self.get_handler(type(obj))
+        return handler(self, obj)
+
+    def get_handler(self, cls):
+        """
+        Returns the function that encodes instances of `cls`. Subclasses
+        can override this to add support for other types.
+        """
+        for base, handler in _TYPE_HANDLERS:
+            if issubclass(cls, base):
+                return handler
+        return DjangoJSONEncoder.default.im_func
+
+def _get_default_encoder():
+    path = getattr(settings, 'JSON_ENCODER', None)
+    if path is None:
+        return LazyEncoder
+    module, name = path.rsplit('.', 1)
+    return getattr(import_module(module), name)
+
+# The JSONEncoder subclass used for encoding responses. django.utils.simplejson
+# already uses the C-accelerated simplejson or json module if installed.
+default_encoder = _get_default_encoder()
+
+def make_etag(value):
+    """Returns a (quoted) ETag for the given string."""
+    return '"%s"' % md5_constructor(value).hexdigest()
+
+def _set_etag(response, etag, version):
+    if version is not None:
+        response['ETag'] = make_etag(str(version))
+    elif etag:
+        response['ETag'] = make_etag(response.content)
+
+class LazyJSON(object):
+    """
+    Response content that encodes `pyobj` (or the result of calling it)
+    when it's needed for the first time. The result is kept, because
+    HttpResponse doesn't cache its content and middleware might read it
+    more than once.
+    """
+    def __init__(self, pyobj, encoder):
+        self.pyobj = pyobj
+        self.encoder = encoder
+        self._content = None
+
+    def __iter__(self):
+        if self._content is None:
+            pyobj = self.pyobj
+            if callable(pyobj):
+                pyobj = pyobj()
+            self._content = simplejson.dumps(pyobj, cls=self.encoder)
+            self.pyobj = None
+        return iter((self._content,))
 
 class JSONResponse(HttpResponse):
-    def __init__(self, pyobj, **kwargs):
-        super(JSONResponse, self).__init__(
-            simplejson.dumps(pyobj, cls=LazyEncoder),
+    """
+    Returns `pyobj` as JSON.
+
+    With ``etag=True`` the response gets an ETag that's computed from its
+    content. Alternatively, pass a `version` that changes whenever the data
+    changes (e.g. a counter incremented on every write). Then `pyobj` may be
+    a function returning the data, which gets called (and the result
+    encoded) only if the response's content is actually needed, i.e., not
+    if :class:`~djangotoolbox.middleware.ETagMiddleware` answers the request
+    with "304 Not Modified".
+    """
+    def __init__(self, pyobj, encoder=None, etag=False, version=None,
+                 **kwargs):
+        encoder = encoder or default_encoder
+        if version is None:
+            content = simplejson.dumps(pyobj, cls=encoder)
+        else:
+            content = LazyJSON(pyobj, encoder)
+        super(JSONResponse, self).__init__(content,
             content_type='application/json; charset=%s' %
                             settings.DEFAULT_CHARSET,
             **kwargs)
+        _set_etag(self, etag, version)
+
+class StreamingJSONResponse(HttpResponse):
+    """
+    Returns a JSON list of the items of an iterable (e.g. a generator or a
+    queryset of values), encoded one item at a time while the response is
+    sent. This way, the whole list and its JSON representation never have
+    to be in memory at once.
+    """
+    def __init__(self, iterable, encoder=None, **kwargs):
+        super(StreamingJSONResponse, self).__init__(
+            self.iter_json(iterable, (encoder or default_encoder)()),
+            content_type='application/json; charset=%s' %
+                            settings.DEFAULT_CHARSET,
+            **kwargs)
+
+    def iter_json(self, iterable, encoder):
+        if isinstance(iterable, QuerySet):
+            # Don't fill the queryset's result cache
+            iterable = iterable.iterator()
+        yield '['
+        separator = ''
+        for item in iterable:
+            yield separator + encoder.encode(item)
+            separator = ', '
+        yield ']'
 
 class TextResponse(HttpResponse):
-    def __init__(self, string='', **kwargs):
+    """
+    Returns `string` as plain text. `etag` and `version` set an ETag like
+    in :class:`JSONResponse`.
+    """
+    def __init__(self, string='', etag=False, version=None, **kwargs):
         super(TextResponse, self).__init__(string,
             content_type='text/plain; charset=%s' % settings.DEFAULT_CHARSET,
             **kwargs)
+        _set_etag(self, etag, version)
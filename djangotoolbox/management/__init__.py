@@ -0,0 +1,24 @@
+from django.db import connections, DEFAULT_DB_ALIAS
+from django.db.models import get_models, signals
+from djangotoolbox.db.creation import NonrelDatabaseCreation
+
+def create_indexes(app, created_models, verbosity, db=DEFAULT_DB_ALIAS,
+                   **kwargs):
+    """
+    Creates the indexes of the models ``syncdb`` created on a
+    non-relational database.
+    """
+    creation = connections[db].creation
+    if not isinstance(creation, NonrelDatabaseCreation):
+        return
+    for model in get_models(app):
+        opts = model._meta
+        if model not in created_models or not opts.managed or opts.proxy:
+            continue
+        if verbosity >= 2:
+            print 'Creating indexes for %s.%s model' % (opts.app_label,
+                                                         opts.object_name)
+        creation.create_indexes(model, creation.index_specs_for_model(model))
+
+signals.post_syncdb.connect(create_indexes,
+    dispatch_uid='djangotoolbox.management.create_indexes')
@@ -0,0 +1,37 @@
+from django.core.management.base import NoArgsCommand
+from django.utils import simplejson
+from djangotoolbox.db.profiler import get_report, clear_report
+from optparse import make_option
+
+class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        make_option('--limit', type='int', default=50,
+            help='Number of (model, query shape, phase) entries to show, '
+                 'sorted by wall time (default: 50, 0 for all)'),
+        make_option('--json', action='store_true', default=False,
+            help='Output the report as JSON'),
+        make_option('--reset', action='store_true', default=False,
+            help='Clear the report after showing it'),
+    )
+    help = ("Shows the query profiles accumulated by QueryProfilerMiddleware "
+            "(see djangotoolbox.db.profiler).")
+
+    def handle_noargs(self, **options):
+        entries = sorted(get_report().iteritems(),
+                         key=lambda (key, stats): stats[1], reverse=True)
+        if options['limit']:
+            entries = entries[:options['limit']]
+        if options['json']:
+            self.stdout.write(simplejson.dumps(
+                [{'model': model, 'shape': shape, 'phase': phase,
+                  'calls': calls, 'wall': wall, 'cpu': cpu}
+                 for (model, shape, phase), (calls, wall, cpu) in entries],
+                indent=2) + '\n')
+        else:
+            self.stdout.write('%10s %10s %8s  %-20s %-16s %s\n' % (
+                'wall (ms)', 'cpu (ms)', 'calls', 'model', 'phase', 'query'))
+            for (model, shape, phase), (calls, wall, cpu) in entries:
+                self.stdout.write('%10.2f %10.2f %8d  %-20s %-16s %s\n' % (
+                    wall * 1000, cpu * 1000, calls, model, phase, shape))
+        if options['reset']:
+            clear_report()
@@ -0,0 +1,71 @@
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+from django.db import models
+from djangotoolbox.fields import DenormalizedField
+
+BATCH_SIZE = 100
+
+class Command(BaseCommand):
+    args = '[appname[.ModelName] ...]'
+    help = ("Refreshes the copies stored in DenormalizedFields of the given "
+            "apps or models (or of all installed models). Can be run as a "
+            "cronjob after the related objects were changed in bulk.")
+
+    def handle(self, *labels, **options):
+        verbosity = int(options.get('verbosity', 1))
+        for model in self._get_models(labels):
+            fields = [field for field in model._meta.fields
+                      if isinstance(field, DenormalizedField)]
+            if not fields:
+                continue
+            updated = 0
+            batch = []
+            for instance in model._default_manager.all().iterator():
+                batch.append(instance)
+                if len(batch) == BATCH_SIZE:
+                    updated += self._resync(model, fields, batch)
+                    batch = []
+            updated += self._resync(model, fields, batch)
+            if verbosity > 0:
+                self.stdout.write('%s.%s: %d updated\n' % (
+                    model._meta.app_label, model._meta.object_name, updated))
+
+    def _get_models(self, labels):
+        if not labels:
+            return models.get_models()
+        result = []
+        for label in labels:
+            if '.' in label:
+                model = models.get_model(*label.split('.', 1))
+                if model is None:
+                    raise CommandError('Unknown model: %s' % label)
+                result.append(model)
+            else:
+                try:
+                    result.extend(models.get_models(models.get_app(label)))
+                except ImproperlyConfigured, e:
+                    raise CommandError(e)
+        return result
+
+    def _resync(self, model, fields, batch):
+        # Read the related objects of the whole batch at once
+        related = {}
+        for field in fields:
+            fk = field.fk
+            pks = set(getattr(instance, fk.attname) for instance in batch)
+            pks.discard(None)
+            related[field] = pks and \
+                fk.rel.to._default_manager.in_bulk(list(pks)) or {}
+
+        updated = 0
+        for instance in batch:
+            values = {}
+            for field in fields:
+                copy = field.make_copy(related[field].get(
+                    getattr(instance, field.fk.attname)))
+                if copy != getattr(instance, field.attname):
+                    values[field.name] = copy
+            if values:
+                model._default_manager.filter(pk=instance.pk).update(**values)
+                updated += 1
+        return updated
@@ -0,0 +1,31 @@
+from djangotoolbox.fields import TrigramIndexField, trigrams
+from .resync_denormalized import Command as ResyncCommand
+
+class Command(ResyncCommand):
+    args = '[appname[.ModelName] ...]'
+    help = ("Rebuilds the trigrams stored in TrigramIndexFields of the given "
+            "apps or models (or of all installed models), e.g. after adding "
+            "a TrigramIndexField to a model that already has data.")
+
+    def handle(self, *labels, **options):
+        verbosity = int(options.get('verbosity', 1))
+        for model in self._get_models(labels):
+            fields = [field for field in model._meta.fields
+                      if isinstance(field, TrigramIndexField)]
+            if not fields:
+                continue
+            updated = 0
+            for instance in model._default_manager.all().iterator():
+                values = {}
+                for field in fields:
+                    value = getattr(instance, field.source_field.attname)
+                    new_trigrams = trigrams(value or u'')
+                    if new_trigrams != getattr(instance, field.attname):
+                        values[field.name] = new_trigrams
+                if values:
+                    model._default_manager.filter(pk=instance.pk).update(
+                        **values)
+                    updated += 1
+            if verbosity > 0:
+                self.stdout.write('%s.%s: %d updated\n' % (
+                    model._meta.app_label, model._meta.object_name, updated))
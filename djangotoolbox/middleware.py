@@ -1,6 +1,7 @@
 from django.conf import settings
-from django.http import HttpResponseRedirect
+from django.http import HttpResponseRedirect, HttpResponseNotModified
 from django.utils.cache import patch_cache_control
+from djangotoolbox.utils import make_prefix_matcher
 
 LOGIN_REQUIRED_PREFIXES = getattr(settings, 'LOGIN_REQUIRED_PREFIXES', ())
 NO_LOGIN_REQUIRED_PREFIXES = getattr(settings, 'NO_LOGIN_REQUIRED_PREFIXES', ())
@@ -10,6 +11,13 @@ NON_REDIRECTED_PATHS = getattr(settings, 'NON_REDIRECTED_PATHS', ())
 NON_REDIRECTED_BASE_PATHS = tuple(path.rstrip('/') + '/'
                                   for path in NON_REDIRECTED_PATHS)
 
+_is_login_required = make_prefix_matcher(LOGIN_REQUIRED_PREFIXES)
+_is_no_login_required = make_prefix_matcher(NO_LOGIN_REQUIRED_PREFIXES)
+_allowed_domains = frozenset(ALLOWED_DOMAINS or ())
+_non_redirected_paths = frozenset(NON_REDIRECTED_PATHS)
+_is_non_redirected_path = make_prefix_matcher(
+    ('/_ah/',) + NON_REDIRECTED_BASE_PATHS)
+
 class LoginRequiredMiddleware(object):
     """
     Redirects to login page if request path begins with a
@@ -17,14 +25,12 @@ class LoginRequiredMiddleware(object):
     NO_LOGIN_REQUIRED_PREFIXES which take precedence.
     """
     def process_request(self, request):
-        for prefix in NO_LOGIN_REQUIRED_PREFIXES:
-            if request.path.startswith(prefix):
-                return None
-        for prefix in LOGIN_REQUIRED_PREFIXES:
-            if request.path.startswith(prefix) and \
-                    not request.user.is_authenticated():
-                from django.contrib.auth.views import redirect_to_login
-                return redirect_to_login(request.get_full_path())
+        if _is_no_login_required(request.path):
+            return None
+        if _is_login_required(request.path) and \
+                not request.user.is_authenticated():
+            from django.contrib.auth.views import redirect_to_login
+            return redirect_to_login(request.get_full_path())
         return None
 
 class RedirectMiddleware(object):
@@ -40,23 +46,52 @@ class RedirectMiddleware(object):
         if (settings.DEBUG or host == 'testserver' or
                 not ALLOWED_DOMAINS or
                 request.META.get('HTTP_X_APPENGINE_CRON') == 'true' or
-                request.path.startswith('/_ah/') or
-                request.path in NON_REDIRECTED_PATHS or
-                request.path.startswith(NON_REDIRECTED_BASE_PATHS)):
+                request.path in _non_redirected_paths or
+                _is_non_redirected_path(request.path)):
             return
-        if host not in settings.ALLOWED_DOMAINS:
-            return HttpResponseRedirect('http://' + settings.ALLOWED_DOMAINS[0]
+        if host not in _allowed_domains:
+            return HttpResponseRedirect('http://' + ALLOWED_DOMAINS[0]
                                         + request.path)
 
 class NoHistoryCacheMiddleware(object):
     """
     If user is authenticated we disable browser caching of pages in history.
+    Responses with an ETag may still be cached privately, but they have to
+    be revalidated on every request.
     """
     def process_response(self, request, response):
         if 'Expires' not in response and \
                 'Cache-Control' not in response and \
                 hasattr(request, 'session') and \
                 request.user.is_authenticated():
-            patch_cache_control(response,
-                no_store=True, no_cache=True, must_revalidate=True, max_age=0)
+            if 'ETag' in response:
+                patch_cache_control(response, private=True, no_cache=True,
+                                    must_revalidate=True, max_age=0)
+            else:
+                patch_cache_control(response, no_store=True, no_cache=True,
+                                    must_revalidate=True, max_age=0)
+        return response
+
+class ETagMiddleware(object):
+    """
+    Answers GET and HEAD requests with "304 Not Modified" if the response's
+    ETag matches the request's If-None-Match header. Unlike Django's
+    ConditionalGetMiddleware this never reads the response's content, so
+    the content of responses with a `version`
+    (see :class:`~djangotoolbox.http.JSONResponse`) isn't even generated.
+    """
+    def process_response(self, request, response):
+        if request.method not in ('GET', 'HEAD') or \
+                response.status_code != 200 or 'ETag' not in response:
+            return response
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+        if not if_none_match:
+            return response
+        etags = [etag.strip() for etag in if_none_match.split(',')]
+        if '*' in etags or response['ETag'] in etags:
+            not_modified = HttpResponseNotModified()
+            for header in ('ETag', 'Cache-Control', 'Expires', 'Vary'):
+                if header in response:
+                    not_modified[header] = response[header]
+            return not_modified
         return response
@@ -1,58 +1,165 @@
 from django.conf import settings
 from django.core.cache import cache
 from django.contrib.sites.models import Site
-from djangotoolbox.utils import make_tls_property
+from django.db.models.signals import post_save, post_delete
+from djangotoolbox.utils import TLSProperty, LRUCache
+from collections import deque
+from threading import Lock
+from time import time
 
 _default_site_id = getattr(settings, 'SITE_ID', None)
-SITE_ID = settings.__class__.SITE_ID = make_tls_property()
+# Each request (thread) has its own SITE_ID
+SITE_ID = settings.__class__.SITE_ID = TLSProperty()
+
+# Number of domains whose SITE_ID gets cached in each process
+SITE_CACHE_SIZE = getattr(settings, 'SITE_CACHE_SIZE', 1000)
+SITE_CACHE_TIMEOUT = getattr(settings, 'SITE_CACHE_TIMEOUT', 5*60)
+# Domains without a Site get cached for a shorter time
+SITE_NEGATIVE_CACHE_TIMEOUT = getattr(settings,
+                                      'SITE_NEGATIVE_CACHE_TIMEOUT', 60)
+CREATE_SITES_AUTOMATICALLY = getattr(settings, 'CREATE_SITES_AUTOMATICALLY',
+                                     True)
+# Maximum number of Sites each process creates automatically per minute
+SITE_CREATION_LIMIT = getattr(settings, 'SITE_CREATION_LIMIT', 10)
+# Load all Sites into memory when the middleware gets initialized. Only
+# use this if the Site table is small.
+PRELOAD_SITES = getattr(settings, 'PRELOAD_SITES', False)
+
+_site_ids = LRUCache(SITE_CACHE_SIZE)
+# Concurrent lookups of the same domain wait for each other, so only one
+# of them goes to the cache and datastore
+_lookup_locks = [Lock() for i in range(64)]
+_creation_lock = Lock()
+_creation_times = deque()
+_not_cached = object()
+# Stored in the shared cache for domains without a Site. It has to survive
+# pickling, and None can't be told apart from a cache miss.
+_NO_SITE = 'djangotoolbox.sites:no-site'
+# domain -> SITE_ID of all Sites if they're preloaded. The dict is never
+# modified, but replaced as a whole when Sites change.
+_domain_map = None
+_domain_map_lock = Lock()
+
+def get_domain(request):
+    """Returns the lowercase domain of the request (with non-default port)."""
+    host = request.get_host().lower()
+    if ':' in host:
+        domain, port = host.rsplit(':', 1)
+        # Ignore port if it's 80 or 443
+        if port in ('80', '443'):
+            host = domain
+    return host
+
+def get_site_id(domain):
+    """Returns the SITE_ID of `domain`."""
+    domain_map = _domain_map
+    if domain_map is not None:
+        site_id = domain_map.get(domain, _not_cached)
+        if site_id is not _not_cached:
+            return site_id
+        if not CREATE_SITES_AUTOMATICALLY:
+            return _default_site_id
+    site_id = _site_ids.get(domain, _not_cached)
+    if site_id is not _not_cached:
+        return site_id
+    with _lookup_locks[hash(domain) % len(_lookup_locks)]:
+        # Another thread might have looked it up in the meantime
+        site_id = _site_ids.get(domain, _not_cached)
+        if site_id is _not_cached:
+            site_id = _lookup_site_id(domain)
+    return site_id
+
+def clear_site_id_cache():
+    _site_ids.clear()
+
+def load_domain_map():
+    """
+    Loads all Sites into memory, so domains can be resolved without
+    accessing the cache or datastore.
+    """
+    global _domain_map
+    with _domain_map_lock:
+        domain_map = {}
+        fallbacks = {}
+        for site in Site.objects.all():
+            domain = site.domain.lower()
+            domain_map[domain] = site.pk
+            fallbacks[_get_fallback_domain(domain)] = site.pk
+        for domain, site_id in fallbacks.items():
+            domain_map.setdefault(domain, site_id)
+        _domain_map = domain_map
+
+def _refresh_domain_map(sender, instance, **kwargs):
+    # Only Sites changed by this process are seen here
+    if _domain_map is not None:
+        load_domain_map()
+    clear_site_id_cache()
+    domain = instance.domain.lower()
+    cache.delete_many([_get_cache_key(domain),
+                       _get_cache_key(_get_fallback_domain(domain))])
+
+post_save.connect(_refresh_domain_map, sender=Site,
+                  dispatch_uid='djangotoolbox.sites.dynamicsite')
+post_delete.connect(_refresh_domain_map, sender=Site,
+                    dispatch_uid='djangotoolbox.sites.dynamicsite')
+
+def _get_cache_key(domain):
+    return 'Site:domain:%s' % domain
+
+def _lookup_site_id(domain):
+    cache_key = _get_cache_key(domain)
+    site_id = cache.get(cache_key)
+    if site_id is None:
+        site = _get_or_create_site(domain)
+        site_id = _NO_SITE if site is None else site.pk
+        cache.set(cache_key, site_id, _get_cache_timeout(site_id))
+    timeout = _get_cache_timeout(site_id)
+    if site_id == _NO_SITE:
+        site_id = _default_site_id
+    _site_ids.set(domain, site_id, timeout)
+    return site_id
+
+def _get_cache_timeout(site_id):
+    if site_id == _NO_SITE:
+        return SITE_NEGATIVE_CACHE_TIMEOUT
+    return SITE_CACHE_TIMEOUT
+
+def _get_fallback_domain(domain):
+    # Fall back to with/without 'www.'
+    if domain.startswith('www.'):
+        return domain[4:]
+    return 'www.' + domain
+
+def _get_or_create_site(domain):
+    for candidate in (domain, _get_fallback_domain(domain)):
+        try:
+            return Site.objects.get(domain=candidate)
+        except Site.DoesNotExist:
+            pass
+
+    # Add site if it doesn't exist
+    if CREATE_SITES_AUTOMATICALLY and _may_create_site():
+        site = Site(domain=domain, name=domain)
+        site.save()
+        return site
+    return None
+
+def _may_create_site():
+    now = time()
+    with _creation_lock:
+        while _creation_times and _creation_times[0] <= now - 60:
+            _creation_times.popleft()
+        if len(_creation_times) >= SITE_CREATION_LIMIT:
+            return False
+        _creation_times.append(now)
+        return True
 
 class DynamicSiteIDMiddleware(object):
     """Sets settings.SITE_ID based on request's domain"""
+    def __init__(self):
+        if PRELOAD_SITES and _domain_map is None:
+            load_domain_map()
+
     def process_request(self, request):
-        # Ignore port if it's 80 or 443
-        if ':' in request.get_host():
-            domain, port = request.get_host().split(':')
-            if int(port) not in (80, 443):
-                domain = request.get_host()
-        else:
-            domain = request.get_host().split(':')[0]
-
-        # Domains are case insensitive
-        domain = domain.lower()
-
-        # We cache the SITE_ID
-        cache_key = 'Site:domain:%s' % domain
-        site = cache.get(cache_key)
-        if site:
-            SITE_ID.value = site
-        else:
-            try:
-                site = Site.objects.get(domain=domain)
-            except Site.DoesNotExist:
-                site = None
-
-            if not site:
-                # Fall back to with/without 'www.'
-                if domain.startswith('www.'):
-                    fallback_domain = domain[4:]
-                else:
-                    fallback_domain = 'www.' + domain
-
-                try:
-                    site = Site.objects.get(domain=fallback_domain)
-                except Site.DoesNotExist:
-                    site = None
-
-            # Add site if it doesn't exist
-            if not site and getattr(settings, 'CREATE_SITES_AUTOMATICALLY',
-                                    True):
-                site = Site(domain=domain, name=domain)
-                site.save()
-
-            # Set SITE_ID for this thread/request
-            if site:
-                SITE_ID.value = site.pk
-            else:
-                SITE_ID.value = _default_site_id
-
-            cache.set(cache_key, SITE_ID.value, 5*60)
+        # Set SITE_ID for this thread/request
+        SITE_ID.value = get_site_id(get_domain(request))
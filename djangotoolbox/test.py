@@ -1,4 +1,4 @@
-from .utils import object_list_to_table
+from .utils import object_list_to_table, diff_lists
 from django.test import TestCase
 from django.test.simple import DjangoTestSuiteRunner
 from django.utils.unittest import TextTestRunner
@@ -27,18 +27,31 @@ class ModelTestCase(TestCase):
         'a', 'b', and 'c' attributes are 1, 2, 3 for one row and 11, 12, 13
         for the other row. The order of the rows doesn't matter.
         """
-        current_state = object_list_to_table(columns,
-            self.model.all())[1:]
-        if not equal_lists(current_state, state_table):
-            print 'DB state not valid:'
-            print 'Current state:'
-            print columns
-            for state in current_state:
-                print state
-            print 'Should be:'
-            for state in state_table:
-                print state
-            self.fail('DB state not valid')
+        current_state = self.get_state(columns)
+        missing, unexpected = diff_lists(state_table, current_state)
+        if missing or unexpected:
+            message = ['DB state not valid:', 'Columns: %r' % (columns,)]
+            if missing:
+                message.append('Missing rows:')
+                message.extend('    %r' % (row,) for row in missing)
+            if unexpected:
+                message.append('Unexpected rows:')
+                message.extend('    %r' % (row,) for row in unexpected)
+            self.fail('\n'.join(message))
+
+    def get_state(self, columns):
+        """
+        Returns the DB contents as a list of row tuples. Columns that are
+        plain fields are fetched with a values_list() query, so no model
+        instances have to be created.
+        """
+        queryset = self.model._default_manager.all()
+        fields = dict((field.name, field) for field in self.model._meta.fields)
+        if all(column == 'pk' or
+               (column in fields and not fields[column].rel)
+               for column in columns):
+            return [tuple(row) for row in queryset.values_list(*columns)]
+        return object_list_to_table(columns, queryset)[1:]
 
 class CapturingTestSuiteRunner(DjangoTestSuiteRunner):
     """Captures stdout/stderr during test and shows them next to tracebacks"""
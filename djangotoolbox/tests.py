@@ -1,4 +1,7 @@
-from .fields import ListField, SetField, DictField, EmbeddedModelField
+from array import array
+from .fields import ListField, SetField, DictField, EmbeddedModelField, \
+    BlobField, NestedQ, TrackedList, DenormalizedField, TrigramIndexField
+from django.conf import settings
 from django.db import models, connections
 from django.db.models import Q
 from django.db.models.signals import post_save
@@ -6,6 +9,7 @@ from django.db.utils import DatabaseError
 from django.dispatch.dispatcher import receiver
 from django.test import TestCase
 from django.utils import unittest
+from .test import ModelTestCase
 
 def count_calls(func):
     def wrapper(*args, **kwargs):
@@ -36,6 +40,25 @@ class OrderedListModel(models.Model):
 class SetModel(models.Model):
     setfield = SetField(models.IntegerField())
 
+class CompressedModel(models.Model):
+    blob = BlobField(compress=True, compress_threshold=10, null=True)
+    names = ListField(models.CharField(max_length=500), compress='bz2')
+
+class IndexedModel(models.Model):
+    name = models.CharField(max_length=500, db_index=True)
+    slug = models.SlugField(unique=True)
+    tags = ListField(models.CharField(max_length=500), db_index=True)
+    category = models.IntegerField()
+    date = models.DateField()
+
+    class Meta:
+        unique_together = ('category', 'name')
+        ordering = ('category', '-date')
+
+class TrigramModel(models.Model):
+    name = models.CharField(max_length=500)
+    name_trigrams = TrigramIndexField('name')
+
 supports_dicts = getattr(connections['default'].features, 'supports_dicts', False)
 if supports_dicts:
     class DictModel(models.Model):
@@ -58,6 +81,14 @@ if supports_dicts:
         auto_now = models.DateTimeField(auto_now=True)
         auto_now_add = models.DateTimeField(auto_now_add=True)
 
+    class CompactEmbeddedModelFieldModel(models.Model):
+        simple = EmbeddedModelField('EmbeddedModel', compact=True, null=True)
+        untyped_list = ListField(EmbeddedModelField(compact=True))
+
+    class DenormalizedModel(models.Model):
+        target = models.ForeignKey(Target, null=True)
+        target_copy = DenormalizedField('target', ['index'])
+
 class FilterTest(TestCase):
     floats = [5.3, 2.6, 9.1, 1.58]
     names = [u'Kakashi', u'Naruto', u'Sasuke', u'Sakura',]
@@ -73,6 +104,19 @@ class FilterTest(TestCase):
                           dict([(3, ['Kakashi', 'Naruto', 'Sasuke',]),
                             (4, ['Kakashi', 'Naruto', 'Sasuke', 'Sakura',]), ]))
 
+    def test_emulated_startswith(self):
+        def matches(queryset, name):
+            query = queryset.query.get_compiler(queryset.db).build_query()
+            return query._matches_filters({'name': name}, queryset.query.where)
+        for lookup, value, matching in (('startswith', 'Sa', 'Sakura'),
+                                        ('istartswith', 'sa', 'Sakura'),
+                                        ('endswith', 'ra', 'Sakura'),
+                                        ('iendswith', 'RA', 'Sakura')):
+            queryset = IndexedModel.objects.filter(
+                **{'name__' + lookup: value})
+            self.assertTrue(matches(queryset, matching))
+            self.assertFalse(matches(queryset, 'Naruto'))
+
     def test_options(self):
         self.assertEqual([entity.names_with_default for entity in
                            ListModel.objects.filter(names__startswith='Sa')],
@@ -174,6 +218,27 @@ class FilterTest(TestCase):
                             names__startswith='Sa')], [['Kakashi', 'Naruto',
                             'Sasuke',],])
 
+    def test_set_lookups(self):
+        self.assertEqual(sorted(entity.pk for entity in
+                                ListModel.objects.filter(NestedQ(
+                                    names__contains_all=['Sakura', 'Naruto']))),
+                         [4])
+        self.assertEqual(sorted(entity.pk for entity in
+                                ListModel.objects.filter(NestedQ(
+                                    names__overlap=['Sasuke', 'Sakura']))),
+                         [3, 4])
+        self.assertEqual(ListModel.objects.filter(NestedQ(
+            names__overlap=['Orochimaru'])).count(), 0)
+        # Django's lookup types are left alone
+        from django.db.models.sql.constants import QUERY_TERMS
+        self.assertFalse('overlap' in QUERY_TERMS)
+
+    @unittest.skipIf(not connections['default'].features.supports_set_lookups,
+                     "Backend doesn't support size lookups")
+    def test_size(self):
+        self.assertEqual([entity.pk for entity in
+                          ListModel.objects.filter(NestedQ(names__size=2))], [2])
+
     def test_setfield(self):
         setdata = [1, 2, 3, 2, 1]
         # At the same time test value conversion
@@ -203,11 +268,998 @@ class FilterTest(TestCase):
         DictModel.add_to_class('new_dict_field', DictField())
         DictModel.objects.get()
 
+    @unittest.skipIf(not supports_dicts, "Backend doesn't support dicts")
+    def test_nested_dict_lookups(self):
+        DictModel(dictfield={'a': 1, 'b': 2}).save()
+        DictModel(dictfield={'a': 3}).save()
+        self.assertEqual(DictModel.objects.filter(
+            NestedQ(dictfield__a=1)).count(), 1)
+        self.assertEqual(DictModel.objects.filter(
+            NestedQ(dictfield__a__gte='1')).count(), 2)
+        self.assertEqual(DictModel.objects.filter(
+            NestedQ(dictfield__b__isnull=True)).count(), 1)
+        # Names of iterable lookups are keys in dicts
+        DictModel(dictfield={'size': 1}).save()
+        self.assertEqual(DictModel.objects.filter(
+            NestedQ(dictfield__size=1)).count(), 1)
+
     def test_Q_objects(self):
         self.assertEquals([entity.names for entity in
             ListModel.objects.exclude(Q(names__lt='Sakura') | Q(names__gte='Sasuke'))],
                 [['Kakashi', 'Naruto', 'Sasuke', 'Sakura']])
 
+class PackedListModel(models.Model):
+    ints = ListField(models.IntegerField(), packed=True,
+                     ordering=lambda x: x)
+    floats = ListField(models.FloatField(), packed=True, compress=True,
+                       null=True)
+
+class CompressionTest(TestCase):
+    def test_roundtrip(self):
+        names = [u'Kakashi', u'Naruto'] * 100
+        CompressedModel(blob='x' * 1000, names=names).save()
+        item = CompressedModel.objects.get()
+        self.assertEqual(item.blob, 'x' * 1000)
+        self.assertEqual(item.names, names)
+
+    def test_small_and_legacy_values(self):
+        blob_field, names_field = CompressedModel._meta.fields[1:]
+        connection = connections['default']
+        # Small blobs are stored as they are
+        self.assertEqual(blob_field.get_db_prep_value('x',
+                                                      connection=connection), 'x')
+        self.assertNotEqual(blob_field.get_db_prep_value('x' * 10,
+                                                         connection=connection),
+                            'x' * 10)
+        # Values stored without compression can still be read
+        self.assertEqual(blob_field.get_db_decoder()('legacy'), 'legacy')
+        self.assertEqual(names_field.get_db_decoder()([u'a', u'b']), [u'a', u'b'])
+
+    def test_json_encoding(self):
+        from datetime import datetime
+        from decimal import Decimal
+        connection = connections['default']
+        names_field = CompressedModel._meta.get_field('names')
+        value = names_field.get_db_prep_save([u'a', u'b'],
+                                             connection=connection)
+        self.assertEqual(names_field.compressor.decompress(value),
+                         '["a","b"]')
+        for item_field, items in (
+                (models.DateTimeField(), [datetime(2011, 1, 2, 3, 4, 5, 6)]),
+                (models.DecimalField(max_digits=5, decimal_places=2),
+                 [Decimal('1.25')])):
+            field = ListField(item_field, compress=True)
+            value = field.get_db_prep_save(items, connection=connection)
+            self.assertEqual(field.get_db_decoder()(value), items)
+        field = SetField(models.IntegerField(), compress=True)
+        value = field.get_db_prep_save(set([1, 2]), connection=connection)
+        self.assertEqual(field.get_db_decoder()(value), set([1, 2]))
+
+    def test_no_lookups(self):
+        CompressedModel(names=['Naruto']).save()
+        self.assertRaises(TypeError,
+            lambda: CompressedModel.objects.filter(names='Naruto').count())
+
+class PackedListTest(TestCase):
+    def test_roundtrip(self):
+        floats = [i / 3.0 for i in xrange(1000)]
+        PackedListModel(ints=[3, 1, 2], floats=floats).save()
+        item = PackedListModel.objects.get()
+        self.assertIsInstance(item.ints, array)
+        self.assertEqual(list(item.ints), [1, 2, 3])
+        self.assertEqual(list(item.floats), floats)
+        item.ints.append(0)
+        item.save()
+        self.assertEqual(list(PackedListModel.objects.get().ints), [0, 1, 2, 3])
+
+    def test_conversion(self):
+        field = PackedListModel._meta.get_field('ints')
+        self.assertEqual(list(field.to_python(['1', 2])), [1, 2])
+        # Lists stored before packing got enabled can still be read
+        self.assertEqual(list(field.get_db_decoder()([4, 5])), [4, 5])
+        self.assertRaises(TypeError, ListField, models.CharField(),
+                          packed=True)
+
+class ChangeTrackingTest(TestCase):
+    def setUp(self):
+        ListModel(integer=1, floating_point=1.0, names=['a', 'b']).save()
+        self.field = ListModel._meta.get_field('names')
+
+    def test_unchanged(self):
+        item = ListModel.objects.get()
+        self.assertIsInstance(item.names, TrackedList)
+        self.assertTrue(self.field.pre_save(item, False).unchanged)
+        item.floating_point = 2.0
+        item.save()
+        self.assertEqual(ListModel.objects.get().names, ['a', 'b'])
+
+    def test_changes(self):
+        item = ListModel.objects.get()
+        item.names.append('c')
+        delta = self.field.pre_save(item, False)
+        self.assertEqual((delta.added, delta.removed), (['c'], []))
+        item.save()
+        self.assertTrue(self.field.pre_save(item, False).unchanged)
+
+        item.names[0] = 'x'
+        self.assertFalse(self.field.pre_save(item, False).partial)
+        item.save()
+        self.assertEqual(ListModel.objects.get().names, ['x', 'b', 'c'])
+
+    def test_insert(self):
+        item = ListModel.objects.get()
+        item.names.append('c')
+        ListModel.objects.all().delete()
+        # The entity doesn't exist anymore, so it gets inserted
+        item.save()
+        self.assertTrue(self.field.pre_save(item, False).unchanged)
+        item.names.append('d')
+        self.assertEqual(self.field.pre_save(item, False).added, ['d'])
+
+    @unittest.skipIf(
+        connections['default'].features.supports_collection_deltas,
+        "Backend supports collection deltas")
+    def test_delta_prep(self):
+        item = ListModel.objects.get()
+        item.names.append('c')
+        self.assertEqual(self.field.get_db_prep_save(
+            self.field.pre_save(item, False),
+            connection=connections['default']), ['a', 'b', 'c'])
+
+    def test_assignment_to_other_instance(self):
+        item = ListModel.objects.get()
+        other = ListModel(integer=2, floating_point=1.0)
+        other.names = item.names
+        self.assertNotIsInstance(other.names, TrackedList)
+        other.save()
+        self.assertEqual(ListModel.objects.get(pk=2).names, ['a', 'b'])
+
+class DenormalizedFieldTest(TestCase):
+    def test_copy(self):
+        target = Target.objects.create(index=1)
+        obj = DenormalizedModel.objects.create(target=target)
+        self.assertEqual(obj.target_copy, {'index': 1, 'pk': target.pk})
+        obj = DenormalizedModel.objects.get()
+        self.assertEqual(obj.target_copy['index'], 1)
+
+        # Saving the related object refreshes the copy
+        target.index = 2
+        target.save()
+        self.assertEqual(DenormalizedModel.objects.get().target_copy['index'], 2)
+
+        # Changing the foreign key refreshes the copy
+        obj.target = Target.objects.create(index=3)
+        obj.save()
+        self.assertEqual(DenormalizedModel.objects.get().target_copy['index'], 3)
+        obj.target = None
+        obj.save()
+        self.assertEqual(DenormalizedModel.objects.get().target_copy, None)
+
+    def test_skip_current_copies(self):
+        from .db.profiler import Profiler
+        target = Target.objects.create(index=1)
+        current = DenormalizedModel.objects.create(target=target)
+        stale = DenormalizedModel.objects.create(target=target)
+        DenormalizedModel.objects.filter(pk=stale.pk).update(
+            target_copy={'index': 0, 'pk': target.pk})
+        def count_updates():
+            with Profiler() as profiler:
+                target.save()
+            return sum(calls for (model, _, phase), (calls, _, _)
+                       in profiler.stats.items()
+                       if model == 'djangotoolbox.DenormalizedModel' and
+                       phase == 'update')
+        self.assertEqual(count_updates(), 1)
+        for obj in DenormalizedModel.objects.all():
+            self.assertEqual(obj.target_copy['index'], 1)
+        self.assertEqual(count_updates(), 0)
+
+    def test_resync_command(self):
+        from django.core.management import call_command
+        target = Target.objects.create(index=1)
+        DenormalizedModel.objects.create(target=target)
+        Target.objects.filter(pk=target.pk).update(index=5)
+        self.assertEqual(DenormalizedModel.objects.get().target_copy['index'], 1)
+        call_command('resync_denormalized', 'djangotoolbox.DenormalizedModel',
+                     verbosity=0)
+        self.assertEqual(DenormalizedModel.objects.get().target_copy['index'], 5)
+
+DenormalizedFieldTest = unittest.skipIf(
+    not supports_dicts, "Backend doesn't support dicts")(
+    DenormalizedFieldTest)
+
+class ShardedCounterTest(TestCase):
+    def test_counter(self):
+        from .counter import ShardedCounter
+        from .counter.models import CounterShard
+        counter = ShardedCounter('views', num_shards=3)
+        counter.reset()
+        self.assertEqual(counter.value, 0)
+        for i in range(10):
+            counter.increment()
+        counter.decrement(2)
+        self.assertEqual(counter.value, 8)
+        self.assertEqual(counter.get_value(use_cache=False), 8)
+        self.assertTrue(1 <= CounterShard.objects.filter(name='views').count() <= 3)
+
+        # More shards can be added while the counter is in use
+        counter = ShardedCounter('views', num_shards=30)
+        for i in range(20):
+            counter.increment()
+        self.assertEqual(counter.get_value(use_cache=False), 28)
+        self.assertEqual(ShardedCounter('other').value, 0)
+
+    def test_cache_and_queries(self):
+        from django.core.cache import cache
+        from .counter import ShardedCounter
+        from .db.profiler import Profiler
+        counter = ShardedCounter('likes', num_shards=1)
+        counter.reset()
+        self.assertEqual(counter.value, 0)
+        calls = []
+        original_incr = cache.incr
+        def incr(key, delta=1, version=None):
+            calls.append(('incr', delta))
+            return original_incr(key, delta, version)
+        def decr(key, delta=1, version=None):
+            calls.append(('decr', delta))
+            return original_incr(key, -delta, version)
+        cache.incr, cache.decr = incr, decr
+        try:
+            with Profiler() as profiler:
+                counter.increment(5)
+                counter.increment(5)
+                counter.decrement(3)
+        finally:
+            del cache.incr, cache.decr
+        # memcached doesn't accept negative deltas
+        self.assertEqual(calls, [('incr', 5), ('incr', 5), ('decr', 3)])
+        self.assertEqual(counter.value, 7)
+        self.assertEqual(counter.get_value(use_cache=False), 7)
+        # Saving a shard doesn't check whether it exists
+        self.assertEqual([phase for (_, _, phase) in profiler.stats
+                          if phase == 'count'], [])
+        # Decrementing to zero drops the cached value
+        counter.decrement(7)
+        self.assertEqual(cache.get(counter.cache_key), None)
+        self.assertEqual(counter.value, 0)
+
+ShardedCounterTest = unittest.skipIf(
+    'djangotoolbox.counter' not in settings.INSTALLED_APPS,
+    "djangotoolbox.counter isn't installed")(ShardedCounterTest)
+
+class IndexSpecTest(TestCase):
+    def test_index_specs(self):
+        from .db.creation import NonrelDatabaseCreation, IndexSpec, \
+            ASCENDING, DESCENDING
+        creation = NonrelDatabaseCreation(connections['default'])
+        specs = creation.index_specs_for_model(IndexedModel)
+        self.assertEqual(specs, [
+            IndexSpec([('name', ASCENDING)]),
+            IndexSpec([('slug', ASCENDING)], unique=True),
+            IndexSpec([('tags', ASCENDING)], multi_valued=['tags']),
+            IndexSpec([('category', ASCENDING), ('name', ASCENDING)],
+                      unique=True),
+            IndexSpec([('category', ASCENDING), ('date', DESCENDING)]),
+        ])
+        self.assertEqual(creation.index_specs_for_model(SetModel), [])
+
+    def test_created_on_syncdb(self):
+        from django.core.management.sql import emit_post_sync_signal, \
+            sql_indexes
+        from django.db.models import get_app
+        creation = connections['default'].creation
+        created = []
+        creation.create_indexes = lambda model, specs: created.append(model)
+        try:
+            # Only syncdb creates indexes, not e.g. the sqlindexes command
+            sql_indexes(get_app('djangotoolbox'), None, connections['default'])
+            self.assertEqual(created, [])
+            emit_post_sync_signal([IndexedModel], 0, False, 'default')
+            self.assertEqual(created, [IndexedModel])
+        finally:
+            del creation.create_indexes
+
+class ConverterRegistryTest(TestCase):
+    def test_converters(self):
+        from decimal import Decimal
+        from .db.base import NonrelDatabaseOperations
+        ops = NonrelDatabaseOperations(connections['default'])
+        ops.register_converter('integer', for_db=str, from_db=int)
+        ops.register_converter('decimal',
+            for_db=lambda value, max_digits, decimal_places:
+                '%.*f' % (int(decimal_places), value))
+        self.assertEqual(ops.get_converter('integer')(5), '5')
+        self.assertEqual(ops.get_converter('integer', for_db=False)('5'), 5)
+        self.assertEqual(ops.get_converter('integer')(None), None)
+        self.assertEqual(ops.get_converter('decimal:10,2')(Decimal('1.5')), '1.50')
+        self.assertEqual(ops.get_converter('ListField:integer')([1, None]),
+                         ['1', None])
+        self.assertEqual(ops.get_converter('SetField:integer', False)(['1']),
+                         set([1]))
+        self.assertEqual(ops.get_converter('DictField:ListField:integer')(
+            {'a': [1, 2]}), {'a': ['1', '2']})
+        # Types without converters don't have to be converted at all
+        self.assertEqual(ops.get_converter('text'), None)
+        self.assertEqual(ops.get_converter('DictField:RawField'), None)
+        self.assertIs(ops.get_converter('ListField:integer'),
+                      ops.get_converter('ListField:integer'))
+
+        # Converters of collection types get the whole collection
+        ops.register_converter('SetField', for_db=sorted, from_db=set)
+        self.assertEqual(ops.get_converter('SetField:text')(set(['b', 'a'])),
+                         ['a', 'b'])
+        self.assertEqual(ops.get_converter('SetField:integer')(set([2, 1])),
+                         ['1', '2'])
+        self.assertEqual(ops.get_converter('SetField:text', False)(['a']),
+                         set(['a']))
+        self.assertEqual(ops.get_converter('SetField:text')(None), None)
+
+class KeyCodecTest(TestCase):
+    def test_order(self):
+        from datetime import date, datetime, time
+        from decimal import Decimal
+        from .db.keycodec import encode, decode
+        for values in (
+            [-2 ** 70, -256, -255, -1, 0, 1, 255, 256, 2 ** 70],
+            [float('-inf'), -1e10, -1.5, -0.0, 0.0, 1e-10, 2.5, float('inf')],
+            [Decimal('-10.5'), Decimal('-1.23'), Decimal('-1.2'),
+             Decimal('-0.001'), Decimal(0), Decimal('0.001'), Decimal('1.2'),
+             Decimal('1.23'), Decimal('10.5'), Decimal('100')],
+            [date(1999, 12, 31), date(2000, 1, 1), date(2000, 2, 1)],
+            [datetime(2000, 1, 1), datetime(2000, 1, 1, 0, 0, 0, 1),
+             datetime(2011, 3, 4, 5, 6, 7)],
+            [time(0, 0), time(0, 0, 1), time(23, 59, 59, 999999)],
+            ['', '\x00', '\x00a', 'a', 'a\x00', 'a\x01', 'ab', 'b'],
+            [u'', u'a', u'ab', u'\xe4', u'\u20ac', u'\U0001f600'],
+            [(1,), (1, 'a'), (1, 'b'), (2,), (2, None)],
+            [None, False, True, 0, 0.0, Decimal(0), date.today(), 'a', u'a'],
+        ):
+            encoded = [encode(value) for value in values]
+            self.assertEqual(sorted(encoded), encoded)
+            self.assertEqual([decode(key) for key in encoded], values)
+            for value, key in zip(values, encoded):
+                self.assertEqual(type(decode(key)), type(value))
+
+    def test_keys(self):
+        from .db.keycodec import encode, encode_key, decode_key, key_range
+        self.assertEqual(decode_key(encode_key(u'x', 5, None)), (u'x', 5, None))
+        self.assertTrue(encode_key(u'a', 9) < encode_key(u'a', 10) <
+                        encode_key(u'ab', 1))
+        keys = [encode(i) for i in range(-5, 5)]
+        def matching(lookup_type, value):
+            start, end = key_range(lookup_type, value)
+            return [key for key in keys if (start is None or key >= start)
+                    and (end is None or key < end)]
+        self.assertEqual(matching('exact', 2), [encode(2)])
+        self.assertEqual(matching('lt', -3), [encode(-5), encode(-4)])
+        self.assertEqual(matching('gte', 3), [encode(3), encode(4)])
+        self.assertEqual(matching('gt', 3), [encode(4)])
+        self.assertEqual(matching('range', (0, 1)), [encode(0), encode(1)])
+
+class TrigramIndexTest(TestCase):
+    def setUp(self):
+        for name in (u'Naruto', u'Sasuke', u'Sakura', u'abcxbcd'):
+            TrigramModel.objects.create(name=name)
+
+    def test_trigrams(self):
+        obj = TrigramModel.objects.get(name=u'Naruto')
+        self.assertEqual(obj.name_trigrams, [u'aru', u'nar', u'rut', u'uto'])
+        obj.name = u'Kakashi'
+        obj.save()
+        self.assertIn(u'kak', TrigramModel.objects.get(pk=obj.pk).name_trigrams)
+
+    def test_contains(self):
+        def names(**kwargs):
+            return sorted(obj.name for obj in
+                          TrigramModel.objects.filter(**kwargs))
+        self.assertEqual(names(name__icontains='SAK'), [u'Sakura'])
+        self.assertEqual(names(name__contains='asuk'), [u'Sasuke'])
+        self.assertEqual(names(name__contains='ASUK'), [])
+        # Candidates that have all trigrams must be checked
+        self.assertEqual(names(name__contains='abcd'), [])
+        self.assertEqual(TrigramModel.objects.filter(
+            name__icontains='a').count(), 4)
+        self.assertEqual(TrigramModel.objects.filter(
+            name_trigrams='aku').count(), 1)
+        self.assertEqual(len(TrigramModel.objects.filter(
+            name__icontains='uto')[:1]), 1)
+
+    def test_update(self):
+        from django.db.models import F
+        TrigramModel.objects.filter(name=u'Naruto').update(name=u'Kakashi')
+        self.assertIn(u'kas', TrigramModel.objects.get(
+            name=u'Kakashi').name_trigrams)
+        self.assertEqual(len(TrigramModel.objects.filter(
+            name__contains='kash')), 1)
+        self.assertRaises(DatabaseError,
+            TrigramModel.objects.filter(name=u'Sasuke').update,
+            name=F('name'))
+
+    def test_resync(self):
+        from django.core.management import call_command
+        # E.g. rows that were saved before the field was added
+        TrigramModel.objects.filter(name=u'Sakura').update(name_trigrams=[])
+        call_command('resync_trigrams', 'djangotoolbox.TrigramModel',
+                     verbosity=0)
+        self.assertEqual(TrigramModel.objects.get(
+            name=u'Sakura').name_trigrams, [u'aku', u'kur', u'sak', u'ura'])
+        self.assertEqual(len(TrigramModel.objects.filter(
+            name__contains='kura')), 1)
+
+class WriteBatchTest(TestCase):
+    def setUp(self):
+        from .db.batch import WriteBatch
+        self.batch = WriteBatch
+        self.calls = []
+        compilers = [connections['default'].ops.compiler(name)
+                     for name in ('SQLInsertCompiler', 'SQLUpdateCompiler',
+                                  'SQLDeleteCompiler')]
+        self.originals = []
+        for compiler in compilers:
+            for method in ('insert', 'insert_batch', 'update', 'update_batch',
+                           'delete_batch'):
+                if hasattr(compiler, method):
+                    self._record(compiler, method)
+
+    def _record(self, compiler, method):
+        original = getattr(compiler, method)
+        self.originals.append((compiler, method, original))
+        def wrapper(self_, *args, **kwargs):
+            self.calls.append(method)
+            return original.im_func(self_, *args, **kwargs)
+        setattr(compiler, method, wrapper)
+
+    def tearDown(self):
+        for compiler, method, original in reversed(self.originals):
+            setattr(compiler, method, original)
+
+    def test_batch(self):
+        with self.batch():
+            for i in range(3):
+                ListModel(integer=i, floating_point=0, names=[]).save(
+                    force_insert=True)
+            obj = ListModel(integer=3, floating_point=0, names=['a'])
+            obj.save(force_insert=True)
+            ListModel.objects.filter(pk=3).update(floating_point=1.5)
+            self.assertEqual(self.calls, [])
+            # Reads see buffered writes
+            self.assertEqual(ListModel.objects.get(pk=3).floating_point, 1.5)
+            self.assertEqual(self.calls, ['insert_batch'] + ['insert'] * 4)
+
+            self.calls = []
+            # QuerySet.delete() reads the entities before deleting them
+            ListModel.objects.filter(pk=2).delete()
+            ListModel.objects.filter(pk=1).update(floating_point=2)
+            ListModel.objects.filter(pk=1).update(names=['b'])
+            self.assertEqual(self.calls, [])
+        self.assertEqual(self.calls, ['update_batch', 'update', 'delete_batch'])
+        obj = ListModel.objects.get(pk=1)
+        self.assertEqual((obj.floating_point, obj.names), (2, ['b']))
+        self.assertEqual(ListModel.objects.count(), 3)
+
+    def test_plain_save(self):
+        with self.batch():
+            for i in range(3):
+                ListModel(integer=i, floating_point=0, names=[]).save()
+            # Entities with auto-generated primary keys are inserted
+            # immediately, without executing the buffered writes
+            Target.objects.create(index=1)
+            self.assertEqual(self.calls, ['insert'])
+            obj = ListModel(integer=1, floating_point=1.5, names=['a'])
+            obj.save()
+            self.assertEqual(self.calls, ['insert'])
+        self.assertEqual(self.calls, ['insert', 'insert_batch'] + ['insert'] * 3)
+        self.assertEqual(ListModel.objects.get(pk=1).floating_point, 1.5)
+        self.assertEqual(ListModel.objects.count(), 3)
+
+    def test_update_count(self):
+        query = ListModel.objects.filter(pk=5)
+        with self.batch():
+            self.assertEqual(query.update(floating_point=1), 0)
+            self.assertRaises(DatabaseError, ListModel(
+                integer=5, floating_point=0, names=[]).save, force_update=True)
+            ListModel(integer=5, floating_point=0, names=[]).save(
+                force_insert=True)
+            self.assertEqual(query.update(floating_point=1), 1)
+            query.delete()
+            self.assertEqual(query.update(floating_point=2), 0)
+        self.assertEqual(self.calls, ['insert_batch', 'insert',
+                                      'delete_batch'])
+        self.assertEqual(query.count(), 0)
+
+    def test_save_existing(self):
+        from .db.profiler import Profiler
+        ListModel(integer=1, floating_point=0, names=[]).save()
+        self.calls = []
+        with Profiler() as profiler:
+            with self.batch():
+                ListModel(integer=1, floating_point=1, names=[]).save()
+        # The update reuses save()'s existence check
+        self.assertEqual(profiler.get_phase_totals()['count'][0], 1)
+        self.assertEqual(self.calls, ['update_batch', 'update'])
+
+        # Deletes are executed before inserts of the same entity
+        self.calls = []
+        with self.batch():
+            ListModel.objects.filter(pk=1).delete()
+            ListModel(integer=1, floating_point=2, names=[]).save(
+                force_insert=True)
+        self.assertEqual(self.calls, ['delete_batch', 'insert_batch',
+                                      'insert'])
+        self.assertEqual(ListModel.objects.get(pk=1).floating_point, 2)
+
+    def test_discard_on_error(self):
+        try:
+            with self.batch():
+                ListModel(integer=1, floating_point=0, names=[]).save(
+                    force_insert=True)
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(ListModel.objects.count(), 0)
+
+class QueryCountingTestCase(TestCase):
+    def setUp(self):
+        self.queries = []
+        compiler = connections['default'].ops.compiler('SQLCompiler')
+        original = compiler.build_query
+        def build_query(compiler_, *args, **kwargs):
+            self.queries.append(compiler_.query.model)
+            return original.im_func(compiler_, *args, **kwargs)
+        compiler.build_query = build_query
+        self.restore = lambda: setattr(compiler, 'build_query', original)
+        for i in range(3):
+            ListModel(integer=i, floating_point=i, names=['a']).save()
+        self.queries = []
+
+    def tearDown(self):
+        self.restore()
+
+class EntityCacheTest(QueryCountingTestCase):
+    def test_identity_map(self):
+        from .db.cache import IdentityMap
+        with IdentityMap():
+            self.assertEqual(ListModel.objects.get(pk=1).floating_point, 1)
+            obj = ListModel.objects.get(pk=1)
+            obj.names.append('b')
+            self.assertEqual(len(self.queries), 1)
+            # Cached values aren't shared
+            self.assertEqual(ListModel.objects.get(pk=1).names, ['a'])
+            self.assertEqual([o.pk for o in ListModel.objects.filter(
+                pk__in=[1, 2])], [1, 2])
+            self.assertEqual(len(self.queries), 2)
+            self.assertEqual([o.pk for o in ListModel.objects.filter(
+                pk__in=[1, 2, 1]).order_by('-integer')], [2, 1])
+            self.assertEqual(len(self.queries), 2)
+
+            # Writes invalidate the cached entities
+            obj.save(force_update=True)
+            queries = len(self.queries)
+            self.assertEqual(ListModel.objects.get(pk=1).names, ['a', 'b'])
+            ListModel.objects.get(pk=1)
+            self.assertEqual(len(self.queries), queries + 1)
+            ListModel.objects.filter(floating_point__gt=0).update(names=[])
+            queries = len(self.queries)
+            self.assertEqual(ListModel.objects.get(pk=2).names, [])
+            self.assertEqual(len(self.queries), queries + 1)
+        ListModel.objects.get(pk=2)
+        self.assertEqual(len(self.queries), queries + 2)
+
+    def test_shared_cache(self):
+        from .db import cache
+        from .utils import LRUCache
+        cache.shared_cache = LRUCache(2)
+        try:
+            ListModel.objects.get(pk=0)
+            ListModel.objects.get(pk=0)
+            self.assertEqual(len(self.queries), 1)
+            ListModel.objects.get(pk=0).delete()
+            self.assertRaises(ListModel.DoesNotExist,
+                              ListModel.objects.get, pk=0)
+
+            # Existence checks don't trust the shared cache, which doesn't
+            # see deletes of other processes
+            cache.store_entity('default', ListModel, 5,
+                               {'integer': 5, 'floating_point': 0})
+            ListModel(integer=5, floating_point=5, names=[]).save()
+            self.assertEqual(ListModel.objects.get(pk=5).floating_point, 5)
+        finally:
+            cache.shared_cache = None
+
+    @unittest.skipIf(not supports_dicts, "Backend doesn't support dicts")
+    def test_values_not_shared(self):
+        from .db.cache import IdentityMap
+        embedded = EmbeddedModelFieldModel.objects.create(
+            simple_untyped=EmbeddedModel(someint=5))
+        dicts = DictModel.objects.create(dictfield={},
+                                         dictfield_nullable={'a': 1})
+        with IdentityMap():
+            # Loading untyped embedded instances mustn't change the cached
+            # entity (e.g. remove the model name from it)
+            for i in range(2):
+                obj = EmbeddedModelFieldModel.objects.get(pk=embedded.pk)
+                self.assertEqual(obj.simple_untyped.someint, 5)
+            obj = DictModel.objects.get(pk=dicts.pk)
+            obj.dictfield_nullable['a'] = 2
+            self.assertEqual(DictModel.objects.get(
+                pk=dicts.pk).dictfield_nullable, {'a': 1})
+
+class QueryCacheTest(QueryCountingTestCase):
+    def _test_query_cache(self, query_cache):
+        from .db import querycache
+        querycache.query_cache = query_cache
+        try:
+            query = ListModel.objects.filter(floating_point__gt=0)
+            self.assertEqual(query.count(), 2)
+            self.assertEqual(query.count(), 2)
+            self.assertEqual(len(self.queries), 1)
+            objs = list(query.order_by('integer'))
+            objs[0].names.append('x')
+            self.assertEqual([obj.names for obj in query.order_by('integer')],
+                             [['a'], ['a']])
+            self.assertEqual(len(self.queries), 2)
+            self.assertEqual(len(query.order_by('-integer')), 2)
+            self.assertEqual(len(self.queries), 3)
+            # Nested and set lookups get cached, too
+            nested = ListModel.objects.filter(
+                NestedQ(names__overlap=['a', 'x']))
+            self.assertEqual(nested.count(), 3)
+            self.assertEqual(nested.count(), 3)
+            self.assertEqual(len(self.queries), 4)
+
+            # Writes invalidate all cached results of the model
+            ListModel(integer=3, floating_point=3, names=[]).save()
+            queries = len(self.queries)
+            self.assertEqual(query.count(), 3)
+            self.assertEqual(len(query.order_by('integer')), 3)
+            self.assertEqual(len(self.queries), queries + 2)
+            OrderedListModel.objects.create()
+            self.assertEqual(query.count(), 3)
+            self.assertEqual(len(self.queries), queries + 2)
+
+            # Also inserts with an auto-generated primary key
+            self.assertEqual(Target.objects.count(), 0)
+            Target.objects.create(index=1)
+            self.assertEqual(Target.objects.count(), 1)
+            self.assertEqual(len(Target.objects.all()), 1)
+        finally:
+            querycache.query_cache = None
+
+    def test_local(self):
+        from .db.querycache import LocalQueryCache
+        self._test_query_cache(LocalQueryCache())
+
+    def test_django_cache(self):
+        from .db.querycache import DjangoQueryCache
+        self._test_query_cache(DjangoQueryCache(key_prefix='test'))
+
+class DynamicSiteTest(TestCase):
+    def setUp(self):
+        from django.contrib.sites.models import Site
+        from django.core.cache import cache
+        from django.test.client import RequestFactory
+        from .sites import dynamicsite
+        self.dynamicsite = dynamicsite
+        dynamicsite.clear_site_id_cache()
+        dynamicsite._creation_times.clear()
+        self.create_sites = dynamicsite.CREATE_SITES_AUTOMATICALLY
+        cache.clear()
+        self.site = Site.objects.create(domain='mysite.com', name='mysite')
+        self.middleware = dynamicsite.DynamicSiteIDMiddleware()
+        self.factory = RequestFactory()
+
+    def tearDown(self):
+        self.dynamicsite.SITE_ID.value = self.dynamicsite._default_site_id
+        self.dynamicsite.CREATE_SITES_AUTOMATICALLY = self.create_sites
+
+    def site_id(self, host):
+        self.middleware.process_request(self.factory.get('/', HTTP_HOST=host))
+        return self.dynamicsite.SITE_ID.value
+
+    def test_site_id(self):
+        from django.contrib.sites.models import Site
+        self.assertEqual(self.site_id('MySite.com'), self.site.pk)
+        self.assertEqual(self.site_id('www.mysite.com:80'), self.site.pk)
+        # Cached, so changes in the datastore aren't seen
+        Site.objects.filter(pk=self.site.pk).update(domain='other.com')
+        self.assertEqual(self.site_id('mysite.com'), self.site.pk)
+
+    def test_negative_caching(self):
+        from django.contrib.sites.models import Site
+        from time import time
+        self.dynamicsite.CREATE_SITES_AUTOMATICALLY = False
+        default = self.dynamicsite._default_site_id
+        self.assertEqual(self.site_id('unknown.com'), default)
+        self.assertTrue('unknown.com' in self.dynamicsite._site_ids)
+        # Entries from the shared cache keep the negative timeout
+        self.dynamicsite.clear_site_id_cache()
+        self.assertEqual(self.site_id('unknown.com'), default)
+        expires = self.dynamicsite._site_ids._items['unknown.com'][1]
+        self.assertTrue(expires <=
+            time() + self.dynamicsite.SITE_NEGATIVE_CACHE_TIMEOUT)
+        # New Sites invalidate the cached default
+        site = Site.objects.create(domain='unknown.com', name='unknown')
+        self.assertEqual(self.site_id('unknown.com'), site.pk)
+
+    def test_preloading(self):
+        from django.contrib.sites.models import Site
+        self.dynamicsite.CREATE_SITES_AUTOMATICALLY = False
+        self.dynamicsite.load_domain_map()
+        try:
+            Site.objects.filter(pk=self.site.pk).update(domain='other.com')
+            self.assertEqual(self.site_id('www.mysite.com'), self.site.pk)
+            self.assertEqual(self.site_id('unknown.com'),
+                             self.dynamicsite._default_site_id)
+            # Saving and deleting Sites refreshes the map
+            site = Site.objects.create(domain='www.unknown.com')
+            self.assertEqual(self.site_id('unknown.com'), site.pk)
+            site.delete()
+            self.assertEqual(self.site_id('unknown.com'),
+                             self.dynamicsite._default_site_id)
+            self.assertEqual(self.site_id('other.com'), self.site.pk)
+        finally:
+            self.dynamicsite._domain_map = None
+
+    def test_creation_limit(self):
+        from django.contrib.sites.models import Site
+        count = Site.objects.count()
+        for i in range(self.dynamicsite.SITE_CREATION_LIMIT + 5):
+            self.site_id('bogus%d.com' % i)
+        self.assertEqual(Site.objects.count(),
+                         count + self.dynamicsite.SITE_CREATION_LIMIT)
+
+class PrefixMatcherTest(TestCase):
+    def test_prefix_matcher(self):
+        from .utils import make_prefix_matcher
+        matches = make_prefix_matcher(('/a/', '/ab/', '/a/b', '/c.d/'))
+        for path in ('/a/', '/a/x', '/ab/', '/c.d/e'):
+            self.assertTrue(matches(path))
+        for path in ('', '/', '/ab', '/c', '/cxd/', '/b/a/'):
+            self.assertFalse(matches(path))
+        self.assertTrue(make_prefix_matcher(('/a', ''))('/b'))
+        self.assertFalse(make_prefix_matcher(())('/'))
+
+class JSONResponseTest(TestCase):
+    def test_lazy_encoding(self):
+        from django.utils.translation import ugettext_lazy
+        from .http import JSONResponse
+        response = JSONResponse({'a': [ugettext_lazy('Yes'), 1]})
+        self.assertEqual(response.content, '{"a": ["Yes", 1]}')
+        self.assertTrue(response['Content-Type'].startswith(
+            'application/json'))
+
+    def test_type_handlers(self):
+        from datetime import datetime, date, time
+        from decimal import Decimal
+        from django.core.serializers.json import DjangoJSONEncoder
+        from django.utils import simplejson
+        from .http import LazyEncoder
+        values = [datetime(2011, 2, 3, 4, 5, 6), date(1850, 2, 3),
+                  time(4, 5, 6), Decimal('1.50')]
+        self.assertEqual(simplejson.dumps(values, cls=LazyEncoder),
+                         simplejson.dumps(values, cls=DjangoJSONEncoder))
+
+    def test_streaming(self):
+        from datetime import date
+        from django.contrib.sites.models import Site
+        from .http import StreamingJSONResponse
+        items = iter([{'a': 1}, date(2011, 1, 2)])
+        response = StreamingJSONResponse(items)
+        self.assertEqual(list(response),
+                         ['[', '{"a": 1}', ', "2011-01-02"', ']'])
+        self.assertEqual(StreamingJSONResponse([]).content, '[]')
+        site = Site.objects.create(domain='json.com', name='json')
+        response = StreamingJSONResponse(
+            Site.objects.filter(pk=site.pk).values('domain'))
+        self.assertEqual(response.content, '[{"domain": "json.com"}]')
+
+class ETagTest(TestCase):
+    def setUp(self):
+        from django.test.client import RequestFactory
+        from .middleware import ETagMiddleware
+        self.factory = RequestFactory()
+        self.middleware = ETagMiddleware()
+
+    def process(self, response, etag=None):
+        request = self.factory.get('/', HTTP_IF_NONE_MATCH=etag or '')
+        return self.middleware.process_response(request, response)
+
+    def test_content_etag(self):
+        from .http import JSONResponse, TextResponse
+        etag = JSONResponse([1, 2], etag=True)['ETag']
+        self.assertEqual(JSONResponse([1, 2], etag=True)['ETag'], etag)
+        self.assertNotEqual(JSONResponse([1], etag=True)['ETag'], etag)
+        self.assertFalse('ETag' in JSONResponse([1, 2]))
+        response = self.process(JSONResponse([1, 2], etag=True), etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        response = self.process(JSONResponse([1], etag=True), etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, '[1]')
+        etag = TextResponse('a', etag=True)['ETag']
+        response = self.process(TextResponse('a', etag=True), '"x", ' + etag)
+        self.assertEqual(response.status_code, 304)
+
+    def test_version(self):
+        from .http import JSONResponse
+        calls = []
+        def get_data():
+            calls.append(1)
+            return {'a': 1}
+        etag = JSONResponse(get_data, version=5)['ETag']
+        response = self.process(JSONResponse(get_data, version=5), etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(calls, [])
+        response = self.process(JSONResponse(get_data, version=6), etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, '{"a": 1}')
+        self.assertEqual(calls, [1])
+        # The content can be read more than once (e.g. by middleware)
+        self.assertEqual(response.content, '{"a": 1}')
+        self.assertEqual(''.join(response), '{"a": 1}')
+        self.assertEqual(calls, [1])
+
+    def test_no_history_cache(self):
+        from django.contrib.auth.models import AnonymousUser, User
+        from .http import TextResponse
+        from .middleware import NoHistoryCacheMiddleware
+        request = self.factory.get('/')
+        request.session = {}
+        request.user = User(username='user')
+        middleware = NoHistoryCacheMiddleware()
+        response = middleware.process_response(request,
+                                               TextResponse('a', etag=True))
+        self.assertEqual(
+            sorted(response['Cache-Control'].split(', ')),
+            ['max-age=0', 'must-revalidate', 'no-cache', 'private'])
+        response = middleware.process_response(request, TextResponse('a'))
+        self.assertTrue('no-store' in response['Cache-Control'])
+        request.user = AnonymousUser()
+        response = middleware.process_response(request,
+                                               TextResponse('a', etag=True))
+        self.assertFalse('Cache-Control' in response)
+
+class TLSPropertyTest(TestCase):
+    def test_tls_property(self):
+        from threading import Thread
+        from .utils import TLSProperty
+        class Holder(object):
+            value = TLSProperty(1)
+        holder = Holder()
+        holder.value = 2
+        values = []
+        def run():
+            values.append(holder.value)
+            holder.value = 3
+            values.append(Holder.value.value)
+        thread = Thread(target=run)
+        thread.start()
+        thread.join()
+        self.assertEqual(values, [1, 3])
+        self.assertEqual(holder.value, 2)
+
+class ValidateStateTest(ModelTestCase):
+    model = Source
+
+    def test_diff_lists(self):
+        from .utils import diff_lists, equal_lists
+        self.assertEqual(diff_lists([1, 2, 2, [3]], [2, 1, [3], [4]]),
+                         ([2], [[4]]))
+        self.assertTrue(equal_lists([(1, 2), [3], (1, 2)],
+                                    [[3], (1, 2), (1, 2)]))
+        self.assertFalse(equal_lists([1, 1, 2], [1, 2, 2]))
+
+    def test_validate_state(self):
+        target = Target.objects.create(index=1)
+        Source.objects.create(target=target, index=2)
+        Source.objects.create(target=target, index=3)
+        self.validate_state(('index',), (3,), (2,))
+        self.validate_state(('index', 'target.index'), (2, 1), (3, 1))
+        try:
+            self.validate_state(('index',), (2,), (4,))
+        except AssertionError, e:
+            self.assertTrue('Missing rows:\n    (4,)\n'
+                            'Unexpected rows:\n    (3,)' in str(e))
+        else:
+            self.fail('Invalid state was accepted')
+
+class TableTest(TestCase):
+    def test_object_table(self):
+        from .utils import object_list_to_table, iter_object_table
+        target = Target.objects.create(index=1)
+        Source.objects.create(target=target, index=2)
+        headings = ('index', 'target.index', 'target.missing')
+        self.assertEqual(object_list_to_table(headings, Source.objects.all()),
+                         [headings, (2, 1, None)])
+        rows = iter_object_table(('index',), iter([target]))
+        self.assertEqual(rows.next(), ('index',))
+        self.assertEqual(list(rows), [(1,)])
+        # A foreign key to a missing object gives the default, too
+        self.assertEqual(object_list_to_table(headings,
+                                              [Source(target_id=999, index=3)]),
+                         [headings, (3, None, None)])
+
+    def test_dict_table(self):
+        from .utils import dict_list_to_table, iter_dict_table
+        rows = [{'a': 1, 'b': 2}, {'a': 11, 'b': 12}]
+        self.assertEqual(dict_list_to_table(('b', 'a'), rows),
+                         [('b', 'a'), (2, 1), (12, 11)])
+        self.assertEqual(dict_list_to_table(('a',), rows),
+                         [('a',), (1,), (11,)])
+        Target.objects.create(index=1)
+        queryset = Target.objects.values('index')
+        self.assertEqual(list(iter_dict_table(('index',), queryset)),
+                         [('index',), (1,)])
+        self.assertEqual(queryset._result_cache, None)
+
+    def test_write_table(self):
+        from StringIO import StringIO
+        from .utils import write_table
+        output = StringIO()
+        write_table(output, [('a', 'b'), (u'\xe4', None), (1, 'x,y')])
+        self.assertEqual(output.getvalue(),
+                         'a,b\r\n\xc3\xa4,\r\n1,"x,y"\r\n')
+        output = StringIO()
+        write_table(output, [('a', 'b'), (1, 2)], delimiter='\t')
+        self.assertEqual(output.getvalue(), 'a\tb\r\n1\t2\r\n')
+
+class ProfilerTest(TestCase):
+    def test_profiler(self):
+        from .db.profiler import Profiler
+        target = Target.objects.create(index=1)
+        Source.objects.create(target=target, index=2)
+        with Profiler() as profiler:
+            self.assertEqual(
+                [source.index for source in
+                 Source.objects.filter(index__gte=1).order_by('-index')],
+                [2])
+            Source.objects.filter(index=2).update(index=3)
+            self.assertEqual(Source.objects.count(), 1)
+        phases = dict(((model, shape, phase), stats[0]) for
+                      (model, shape, phase), stats in profiler.stats.items())
+        shape = 'index__gte ORDER BY -index'
+        for phase in ('build_query', 'fetch', 'make_result', 'model_init'):
+            self.assertTrue(('djangotoolbox.Source', shape, phase) in phases)
+        self.assertEqual(phases['djangotoolbox.Source', shape, 'fetch'], 1)
+        self.assertEqual(
+            phases['djangotoolbox.Source', shape, 'make_result'], 1)
+        self.assertEqual(phases['djangotoolbox.Source', 'ALL', 'count'], 1)
+        self.assertTrue(('djangotoolbox.Source', 'index__exact', 'update')
+                        in phases)
+        self.assertTrue('model_init=1/' in profiler.summary())
+        # Queries outside of the block aren't recorded
+        list(Source.objects.all())
+        self.assertEqual(len(profiler.stats), len(phases))
+
+    def test_middleware(self):
+        from django.conf import settings
+        from django.core.cache import cache
+        from django.http import HttpResponse
+        from django.test.client import RequestFactory
+        from .db.profiler import QueryProfilerMiddleware, get_report
+        cache.clear()
+        middleware = QueryProfilerMiddleware()
+        request = RequestFactory().get('/', {'profile_queries': 1},
+                                       REMOTE_ADDR='10.0.0.1')
+        middleware.process_request(request)
+        list(Target.objects.all())
+        response = middleware.process_response(request, HttpResponse())
+        self.assertFalse('X-Query-Profile' in response)
+        self.assertEqual(get_report(), {})
+
+        internal_ips = settings.INTERNAL_IPS
+        settings.INTERNAL_IPS = ('10.0.0.1',)
+        try:
+            middleware.process_request(request)
+            list(Target.objects.all())
+            response = middleware.process_response(request, HttpResponse())
+        finally:
+            settings.INTERNAL_IPS = internal_ips
+        self.assertTrue('build_query=1/' in response['X-Query-Profile'])
+        self.assertEqual(get_report()[
+            'djangotoolbox.Target', 'ALL', 'build_query'][0], 1)
+
 class BaseModel(models.Model):
     pass
 
@@ -254,6 +1306,23 @@ class EmbeddedModelFieldTest(TestCase):
         instance = EmbeddedModelFieldModel.objects.get()
         self.assertEqual(instance.simple.id, instance.id)
 
+    def test_resave_tracked_collections(self):
+        EmbeddedModelFieldModel.objects.create(
+            typed_list=[SetModel(setfield=[1, 2])],
+            simple_untyped=ListModel(integer=1, floating_point=1.5,
+                                     names=['a']))
+        instance = EmbeddedModelFieldModel.objects.get()
+        instance.typed_list[0].setfield.add(3)
+        instance.save()
+        instance = EmbeddedModelFieldModel.objects.get()
+        self.assertEqual(instance.typed_list[0].setfield, set([1, 2, 3]))
+        self.assertEqual(instance.simple_untyped.names, ['a'])
+        # Unchanged collections are written, too
+        instance.save()
+        instance = EmbeddedModelFieldModel.objects.get()
+        self.assertEqual(instance.typed_list[0].setfield, set([1, 2, 3]))
+        self.assertEqual(instance.simple_untyped.names, ['a'])
+
     def _test_pre_save(self, instance, get_field):
         # Make sure field.pre_save is called for embedded objects
         from time import sleep
@@ -352,6 +1421,81 @@ class EmbeddedModelFieldTest(TestCase):
         self.assertIsInstance(data['a'], SetModel)
         self.assertNotEqual(data['c'].auto_now['y'], None)
 
+    def test_nested_lookups(self):
+        EmbeddedModelFieldModel.objects.create(
+            simple=EmbeddedModel(someint=5),
+            typed_list2=[EmbeddedModel(someint=1), EmbeddedModel(someint=2)])
+        EmbeddedModelFieldModel.objects.create(simple=EmbeddedModel(someint=7))
+        self.assertEqual(EmbeddedModelFieldModel.objects.filter(
+            NestedQ(simple__someint='5')).count(), 1)
+        self.assertEqual(EmbeddedModelFieldModel.objects.filter(
+            NestedQ(simple__someint__gt=4)).count(), 2)
+        self.assertEqual(EmbeddedModelFieldModel.objects.filter(
+            NestedQ(typed_list2__someint=2)).count(), 1)
+        self.assertEqual(EmbeddedModelFieldModel.objects.filter(
+            NestedQ(typed_list2__someint__gt=1)).count(), 1)
+
+    def test_emulated_nested_lookups(self):
+        entity = {'typed_list2': [{'custom': 1}, {'custom': 3}]}
+        def matches(**lookup):
+            queryset = EmbeddedModelFieldModel.objects.filter(NestedQ(**lookup))
+            query = queryset.query.get_compiler(queryset.db).build_query()
+            return query._matches_filters(entity, queryset.query.where)
+        # Collections match if any of their items matches
+        self.assertTrue(matches(typed_list2__someint__gt=2))
+        self.assertTrue(matches(typed_list2__someint__lte=1))
+        self.assertFalse(matches(typed_list2__someint__gt=3))
+        self.assertFalse(matches(typed_list2__someint__lt=1))
+        self.assertTrue(matches(typed_list2__someint=3))
+        self.assertFalse(matches(typed_list2__someint=2))
+
+    def test_compact(self):
+        field = CompactEmbeddedModelFieldModel._meta.get_field('simple')
+        embedded = EmbeddedModel(someint=5)
+        value = field.get_db_prep_save(field.pre_save(
+            CompactEmbeddedModelFieldModel(simple=embedded), True),
+            connection=connections['default'])
+        self.assertIsInstance(value, list)
+        self.assertEqual(len(value), 1 + len(EmbeddedModel._meta.fields))
+        self.assertIn(5, value)
+
+        CompactEmbeddedModelFieldModel.objects.create(
+            simple=EmbeddedModel(someint=5),
+            untyped_list=[EmbeddedModel(someint=7), SetModel(setfield=[1, 2])])
+        obj = CompactEmbeddedModelFieldModel.objects.get()
+        self.assertEqual(obj.simple.someint, 5)
+        self.assertEqual(obj.simple.id, None)
+        self.assertNotEqual(obj.simple.auto_now_add, None)
+        self.assertIsInstance(obj.untyped_list[0], EmbeddedModel)
+        self.assertEqual(obj.untyped_list[0].someint, 7)
+        self.assertEqual(obj.untyped_list[1].setfield, set([1, 2]))
+        self.assertEqual(CompactEmbeddedModelFieldModel.objects.filter(
+            NestedQ(simple__someint=5)).count(), 1)
+        self.assertEqual(CompactEmbeddedModelFieldModel.objects.filter(
+            NestedQ(simple__someint__gt=5)).count(), 0)
+
+    def test_compact_legacy_values(self):
+        field = CompactEmbeddedModelFieldModel._meta.get_field('simple')
+        # Values stored in the default dict format
+        instance = field.to_python({'custom': 3, 'auto_now': None})
+        self.assertEqual(instance.someint, 3)
+        # Values stored with an older version of the model
+        from .fields import get_embedded_manifest, register_embedded_manifest, \
+            _manifests
+        version = register_embedded_manifest(EmbeddedModel,
+            ['custom', 'removed', 'id']).version
+        try:
+            instance = field.to_python([version, 4, 'x', 9])
+            self.assertEqual((instance.someint, instance.id), (4, 9))
+            self.assertRaises(ValueError, field.to_python,
+                [get_embedded_manifest(EmbeddedModel).version + 1, 4])
+            # Older values have the keys at other positions
+            self.assertRaises(TypeError, list,
+                CompactEmbeddedModelFieldModel.objects.filter(
+                    NestedQ(simple__someint=4)))
+        finally:
+            del _manifests[EmbeddedModel, version]
+
     def test_foreignkey_in_embedded_object(self):
         simple = EmbeddedModel(some_relation=DictModel.objects.create())
         obj = EmbeddedModelFieldModel.objects.create(simple=simple)
@@ -1,25 +1,117 @@
+from collections import Counter, OrderedDict
+from operator import itemgetter
+from threading import Lock, local
+from time import time
+import csv
+import re
+
+class TLSProperty(object):
+    """
+    A class-wide instance property with a value that's specific to the
+    current thread (stored in a ``threading.local``). The value can be
+    accessed via the `value` attribute, too.
+    """
+    def __init__(self, default=None):
+        # The class attribute is the default of threads that haven't set a
+        # value yet
+        values = type('TLSLocal', (local,), {'value': default})()
+        self._get_value = lambda: values.value
+        self._set_value = lambda value: setattr(values, 'value', value)
+
+    def __get__(self, instance, cls):
+        if instance is None:
+            return self
+        return self._get_value()
+
+    def __set__(self, instance, value):
+        self._set_value(value)
+
+    def _get(self):
+        return self._get_value()
+    def _set(self, value):
+        self._set_value(value)
+    value = property(_get, _set)
+
 def make_tls_property(default=None):
     """Creates a class-wide instance property with a thread-specific value."""
-    class TLSProperty(object):
-        def __init__(self):
-            from threading import local
-            self.local = local()
+    return TLSProperty(default)
+
+class LRUCache(object):
+    """
+    A thread-safe cache that keeps the `max_size` most recently used items,
+    each for at most `timeout` seconds (if given).
+    """
+    def __init__(self, max_size, timeout=None):
+        self.max_size = max_size
+        self.timeout = timeout
+        self._items = OrderedDict()
+        self._lock = Lock()
 
-        def __get__(self, instance, cls):
-            if not instance:
-                return self
-            return self.value
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires = self._items.pop(key)
+            except KeyError:
+                return default
+            if expires is not None and expires <= time():
+                return default
+            # Move the item to the end (most recently used)
+            self._items[key] = value, expires
+            return value
 
-        def __set__(self, instance, value):
-            self.value = value
+    def set(self, key, value, timeout=None):
+        timeout = timeout or self.timeout
+        expires = timeout and time() + timeout or None
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value, expires
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
 
-        def _get_value(self):
-            return getattr(self.local, 'value', default)
-        def _set_value(self, value):
-            self.local.value = value
-        value = property(_get_value, _set_value)
+    def delete(self, key):
+        with self._lock:
+            self._items.pop(key, None)
 
-    return TLSProperty()
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def __len__(self):
+        return len(self._items)
+
+def make_prefix_matcher(prefixes):
+    """
+    Returns a function that checks if a string starts with any of the given
+    prefixes in time proportional to the string's length. The prefixes get
+    compiled into a single regular expression shaped like a trie, e.g.
+    ('/a/', '/ab/', '/c/') results in ``/(?:a(?:/|b/)|c/)``.
+    """
+    trie = {}
+    for prefix in prefixes:
+        node = trie
+        for char in prefix:
+            if node.get('') is not None:
+                # A shorter prefix already matches
+                break
+            node = node.setdefault(char, {})
+        else:
+            node.clear()
+            node[''] = True
+    if not trie:
+        return lambda value: False
+    return re.compile(_trie_to_regex(trie), re.DOTALL).match
+
+def _trie_to_regex(node):
+    if '' in node:
+        return ''
+    branches = [re.escape(char) + _trie_to_regex(child)
+                for char, child in sorted(node.items())]
+    if len(branches) == 1:
+        return branches[0]
+    return '(?:%s)' % '|'.join(branches)
 
 def getattr_by_path(obj, attr, *default):
     """Like getattr(), but can go down a hierarchy like 'attr.subattr'"""
@@ -32,26 +124,113 @@ def getattr_by_path(obj, attr, *default):
             value = value()
     return value
 
+def make_path_getter(attr, *default):
+    """
+    Returns a function that does the same as getattr_by_path(obj, attr,
+    *default), but splits `attr` only once. Use it to get the same attribute
+    of many objects.
+    """
+    parts = attr.split('.')
+    if default:
+        default = default[0]
+        def getter(obj):
+            value = obj
+            for part in parts:
+                # Like hasattr(), return the default on any exception (e.g.
+                # DoesNotExist for a foreign key to a deleted object)
+                try:
+                    value = getattr(value, part)
+                except Exception:
+                    return default
+                if callable(value):
+                    value = value()
+            return value
+    else:
+        def getter(obj):
+            value = obj
+            for part in parts:
+                value = getattr(value, part)
+                if callable(value):
+                    value = value()
+            return value
+    return getter
+
 def subdict(data, *attrs):
     """Returns a subset of the keys of a dictionary."""
     result = {}
     result.update([(key, data[key]) for key in attrs])
     return result
 
+def _count_items(items):
+    counts = Counter()
+    unhashable = []
+    for item in items:
+        try:
+            counts[item] += 1
+        except TypeError:
+            unhashable.append(item)
+    return counts, unhashable
+
+def diff_lists(left, right):
+    """
+    Compares two lists as multisets (i.e., ignoring their order) and returns
+    the elements only contained in `left` and those only contained in
+    `right`. Takes linear time unless the lists contain unhashable elements.
+    """
+    left_counts, left_unhashable = _count_items(left)
+    right_counts, right_unhashable = _count_items(right)
+    only_left = list((left_counts - right_counts).elements())
+    only_right = list((right_counts - left_counts).elements())
+    for item in left_unhashable:
+        if item in right_unhashable:
+            right_unhashable.remove(item)
+        else:
+            only_left.append(item)
+    return only_left, only_right + right_unhashable
+
 def equal_lists(left, right):
     """
     Compares two lists and returs True if they contain the same elements, but
     doesn't require that they have the same order.
     """
-    right = list(right)
+    left, right = list(left), list(right)
     if len(left) != len(right):
         return False
-    for item in left:
-        if item in right:
-            del right[right.index(item)]
-        else:
-            return False
-    return True
+    only_left, only_right = diff_lists(left, right)
+    return not only_left and not only_right
+
+def _iter_rows(rows):
+    # Don't fill the result cache of querysets
+    iterator = getattr(rows, 'iterator', None)
+    return iterator() if iterator is not None else rows
+
+def iter_object_table(headings, object_list):
+    """
+    Like object_list_to_table(), but returns an iterator over the rows, so
+    the table doesn't have to be in memory at once.
+    """
+    getters = [make_path_getter(heading, None) for heading in headings]
+    yield headings
+    for obj in _iter_rows(object_list):
+        yield tuple([getter(obj) for getter in getters])
+
+def iter_dict_table(headings, dict_list):
+    """
+    Like dict_list_to_table(), but returns an iterator over the rows, so
+    the table doesn't have to be in memory at once.
+    """
+    yield headings
+    if not headings:
+        for row in _iter_rows(dict_list):
+            yield ()
+        return
+    getter = itemgetter(*headings)
+    if len(headings) == 1:
+        for row in _iter_rows(dict_list):
+            yield (getter(row),)
+    else:
+        for row in _iter_rows(dict_list):
+            yield getter(row)
 
 def object_list_to_table(headings, dict_list):
     """
@@ -72,9 +251,7 @@ def object_list_to_table(headings, dict_list):
         (11, 12, 13),
     ]
     """
-    return [headings] + [tuple([getattr_by_path(row, heading, None)
-                                for heading in headings])
-                         for row in dict_list]
+    return list(iter_object_table(headings, dict_list))
 
 def dict_list_to_table(headings, dict_list):
     """
@@ -90,5 +267,22 @@ def dict_list_to_table(headings, dict_list):
         (11, 12, 13),
     ]
     """
-    return [headings] + [tuple([row[heading] for heading in headings])
-                         for row in dict_list]
+    return list(iter_dict_table(headings, dict_list))
+
+def write_table(fileobj, rows, delimiter=',', encoding='utf-8'):
+    """
+    Writes the rows of a table (e.g. returned by iter_object_table()) to
+    `fileobj` as CSV, or as TSV with ``delimiter='\\t'``, one row at a time.
+    Unicode values get encoded with `encoding` and None becomes an empty
+    value.
+    """
+    writer = csv.writer(fileobj, delimiter=delimiter)
+    for row in rows:
+        writer.writerow([_encode_cell(value, encoding) for value in row])
+
+def _encode_cell(value, encoding):
+    if value is None:
+        return ''
+    if isinstance(value, unicode):
+        return value.encode(encoding)
+    return value
@@ -13,6 +13,8 @@ CLASSIFIERS = [
     'Intended Audience :: Developers',
     'Operating System :: OS Independent',
     'Programming Language :: Python',
+    'Programming Language :: Python :: 2',
+    'Programming Language :: Python :: 2.7',
     'Framework :: Django',
     'Topic :: Database',
     'Topic :: Software Development :: Libraries :: Python Modules',
@@ -20,7 +22,8 @@ CLASSIFIERS = [
 ]
 
 setup(name='djangotoolbox',
-      packages=find_packages(exclude=('tests', 'tests.*')),
+      packages=find_packages(exclude=('tests', 'tests.*',
+                                      'benchmarks', 'benchmarks.*')),
       author='Waldemar Kornewald',
       author_email='wkornewald@gmail.com',
       url='http://www.allbuttonspressed.com/projects/djangotoolbox',